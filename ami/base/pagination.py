@@ -1,11 +1,307 @@
+import base64
+import dataclasses
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models
+from django.forms import BooleanField
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 
 from .permissions import add_collection_level_permissions
 
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class KeysetCursor:
+    """
+    A position in a list ordered by (field, id).
+
+    The value of the ordering field is stored as a string, as returned by `Field.value_to_string`.
+    A reversed cursor fetches the page before the position, and an inclusive cursor includes the row
+    at the position itself (used to jump straight to a specific object).
+
+    >>> cursor = KeysetCursor(value="2023-01-01T22:00:00", pk=5, inclusive=True)
+    >>> KeysetCursor.decode(cursor.encode()) == cursor
+    True
+    """
+
+    value: str | None
+    pk: int
+    reverse: bool = False
+    inclusive: bool = False
+
+    def encode(self) -> str:
+        data = {"v": self.value, "pk": self.pk}
+        if self.reverse:
+            data["r"] = 1
+        if self.inclusive:
+            data["i"] = 1
+        return base64.urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode()).decode()
+
+    @classmethod
+    def decode(cls, encoded: str) -> "KeysetCursor":
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            return cls(value=data["v"], pk=int(data["pk"]), reverse=bool(data.get("r")), inclusive=bool(data.get("i")))
+        except (TypeError, ValueError, KeyError):
+            raise NotFound("Invalid cursor")
+
+
+def _keyset_filter(
+    field: str, value, pk: int, descending: bool, nulls_after: bool, inclusive: bool = False
+) -> models.Q:
+    """
+    Filter for the rows that come after a position, when ordering by (field, pk) in the same direction.
+    """
+    after = "lt" if descending else "gt"
+    after_pk = f"pk__{after}e" if inclusive else f"pk__{after}"
+    if value is None:
+        q = models.Q(**{f"{field}__isnull": True, after_pk: pk})
+        if not nulls_after:
+            q |= models.Q(**{f"{field}__isnull": False})
+    else:
+        q = models.Q(**{f"{field}__{after}": value}) | models.Q(**{field: value, after_pk: pk})
+        if nulls_after:
+            q |= models.Q(**{f"{field}__isnull": True})
+    return q
+
+
+def estimate_count(queryset: models.QuerySet) -> int | None:
+    """
+    Estimate the number of rows in a queryset from the Postgres statistics, without running it.
+
+    Unfiltered tables use the row count kept by the planner (pg_class.reltuples),
+    anything else uses the number of rows the query plan expects.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    queryset = queryset.order_by()
+    try:
+        if not queryset.query.where and not queryset.query.group_by and not queryset.query.annotations:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE oid = %s::regclass", [queryset.model._meta.db_table]
+                )
+                row = cursor.fetchone()
+            # The statistics are -1 for tables that have never been analyzed
+            if row and row[0] >= 0:
+                return int(row[0])
+        plan = json.loads(queryset.explain(format="json"))
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except Exception as e:
+        logger.warning(f"Could not estimate count for {queryset.model.__name__} queryset: {e}")
+        return None
+
 
 class LimitOffsetPaginationWithPermissions(LimitOffsetPagination):
+    """
+    Limit/offset pagination, with an optional keyset ("cursor") mode.
+
+    The keyset mode is used when the `cursor` query param is present (it is empty for the first page)
+    and the results are ordered by one of the view's `keyset_ordering_fields`. Pages are then selected
+    by filtering on the (ordering field, id) of the last row seen instead of with OFFSET, so deep pages
+    load as quickly as the first one. The total count is skipped unless `with_count` is requested.
+
+    Total counts are cached for a short time per query. Above a size threshold they are estimated
+    from the Postgres statistics instead, and `count_is_exact` is false in the response.
+    """
+
+    cursor_query_param = "cursor"
+    with_count_query_param = "with_count"
+
+    def get_count(self, queryset) -> int:
+        """
+        Return the number of results, which is either exact or an estimate for large querysets.
+
+        Sets `count_is_exact` to tell which.
+        """
+        queryset = queryset.order_by()
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except EmptyResultSet:
+            self.count_is_exact = True
+            return 0
+        key = "count:" + hashlib.md5(f"{queryset.db}:{sql}:{params}".encode()).hexdigest()
+        count = cache.get(key)
+        if count is not None:
+            self.count_is_exact = True
+            return count
+
+        estimate = estimate_count(queryset)
+        if estimate is not None and estimate > settings.PAGINATION_COUNT_ESTIMATE_THRESHOLD:
+            self.count_is_exact = False
+            return estimate
+
+        count = queryset.count()
+        cache.set(key, count, timeout=settings.PAGINATION_COUNT_CACHE_SECONDS)
+        self.count_is_exact = True
+        return count
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = self.cursor_query_param in request.query_params
+        self.count_is_exact = True
+        if not self.cursor_mode:
+            return self.paginate_queryset_by_offset(queryset, request, view)
+
+        self.request = request
+        self.limit = self.get_limit(request) or self.default_limit
+        ordering = self.get_keyset_ordering(queryset, view)
+        if not ordering:
+            raise ValidationError(
+                {
+                    self.cursor_query_param: "Cursor pagination is only supported when ordering by one of: "
+                    + ", ".join(getattr(view, "keyset_ordering_fields", []))
+                }
+            )
+        field, descending = ordering
+        self.keyset_field = queryset.model._meta.get_field(field)
+
+        self.count = None
+        if BooleanField(required=False).clean(request.query_params.get(self.with_count_query_param, False)):
+            self.count = self.get_count(queryset)
+
+        encoded = request.query_params.get(self.cursor_query_param)
+        cursor = KeysetCursor.decode(encoded) if encoded else None
+        reverse = cursor.reverse if cursor else False
+        # Rows with no value for the ordering field always come last
+        page_descending = descending != reverse
+        order = models.F(field).desc if page_descending else models.F(field).asc
+        queryset = queryset.order_by(
+            order(nulls_last=True) if not reverse else order(nulls_first=True),
+            "-pk" if page_descending else "pk",
+        )
+        if cursor:
+            value = self.keyset_field.to_python(cursor.value) if cursor.value is not None else None
+            queryset = queryset.filter(
+                _keyset_filter(
+                    field,
+                    value,
+                    cursor.pk,
+                    descending=page_descending,
+                    nulls_after=not reverse,
+                    inclusive=cursor.inclusive,
+                )
+            )
+
+        rows = list(queryset[: self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[: self.limit]
+        if reverse:
+            rows.reverse()
+
+        self.next_cursor = self.previous_cursor = None
+        if rows:
+            if has_more or reverse:
+                self.next_cursor = self.get_row_cursor(rows[-1])
+            if (has_more and reverse) or (cursor and not reverse):
+                self.previous_cursor = dataclasses.replace(self.get_row_cursor(rows[0]), reverse=True)
+        elif cursor:
+            # Nothing on this side of the cursor, allow going back the other way
+            position = dataclasses.replace(cursor, reverse=not cursor.reverse, inclusive=not cursor.inclusive)
+            if reverse:
+                self.next_cursor = position
+            else:
+                self.previous_cursor = position
+        return rows
+
+    def paginate_queryset_by_offset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.request = request
+        self.offset = self.get_offset(request)
+        self.count = self.get_count(queryset)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+
+        if self.count_is_exact:
+            if self.count == 0 or self.offset > self.count:
+                return []
+            return list(queryset[self.offset : self.offset + self.limit])  # noqa: E203
+
+        # The count is only an estimate, so don't rely on it to tell if there are more results
+        rows = list(queryset[self.offset : self.offset + self.limit + 1])  # noqa: E203
+        if len(rows) > self.limit:
+            self.count = max(self.count, self.offset + self.limit + 1)
+        elif rows or not self.offset:
+            # Reached the end, so the real count is known
+            self.count = self.offset + len(rows)
+            self.count_is_exact = True
+        else:
+            # Past the end, the real count is somewhere before the offset.
+            # Keep it below the offset so there is no next page.
+            self.count = min(self.count, self.offset)
+        return rows[: self.limit]
+
+    def get_keyset_ordering(self, queryset, view) -> tuple[str, bool] | None:
+        """
+        Return the field the queryset is ordered by and whether it is descending, if keyset pagination supports it.
+        """
+        ordering = []
+        for value in list(queryset.query.order_by) or list(queryset.model._meta.ordering):
+            # Orderings are either field names or expressions, like the ones from NullsLastOrderingFilter
+            if isinstance(value, models.OrderBy) and isinstance(value.expression, models.F):
+                ordering.append((value.expression.name, value.descending))
+            elif isinstance(value, str) and value != "?":
+                ordering.append((value.lstrip("-"), value.startswith("-")))
+            else:
+                return None
+        ordering = [(field, descending) for field, descending in ordering if field not in ["pk", "id"]]
+        if len(ordering) != 1 or ordering[0][0] not in getattr(view, "keyset_ordering_fields", []):
+            return None
+        return ordering[0]
+
+    def get_row_cursor(self, row: models.Model) -> KeysetCursor:
+        value = None if getattr(row, self.keyset_field.attname) is None else self.keyset_field.value_to_string(row)
+        return KeysetCursor(value=value, pk=row.pk)
+
+    def get_cursor_link(self, cursor: KeysetCursor | None) -> str | None:
+        if not cursor:
+            return None
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor.encode())
+
+    def get_paginated_response_schema(self, schema):
+        response_schema = super().get_paginated_response_schema(schema)
+        response_schema["properties"]["count_is_exact"] = {"type": "boolean", "nullable": True}
+        return response_schema
+
     def get_paginated_response(self, data):
-        paginated_response = super().get_paginated_response(data=data)
+        if getattr(self, "cursor_mode", False):
+            paginated_response = Response(
+                OrderedDict(
+                    [
+                        ("count", self.count),
+                        ("count_is_exact", self.count_is_exact if self.count is not None else None),
+                        ("next", self.get_cursor_link(self.next_cursor)),
+                        ("previous", self.get_cursor_link(self.previous_cursor)),
+                        ("results", data),
+                    ]
+                )
+            )
+        else:
+            paginated_response = Response(
+                OrderedDict(
+                    [
+                        ("count", self.count),
+                        ("count_is_exact", self.count_is_exact),
+                        ("next", self.get_next_link()),
+                        ("previous", self.get_previous_link()),
+                        ("results", data),
+                    ]
+                )
+            )
         paginated_response.data = add_collection_level_permissions(
             user=self.request.user, response_data=paginated_response.data
         )
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:03
+
+import ami.jobs.models
+from django.db import migrations, models
+import django_pydantic_field.fields
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0010_job_limit_job_shuffle"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="distributed",
+            field=models.BooleanField(
+                default=False,
+                help_text="Split the images into shards that are processed in parallel by multiple workers",
+                verbose_name="Distributed",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="job",
+            name="progress",
+            field=django_pydantic_field.fields.PydanticSchemaField(
+                config=None, default=ami.jobs.models.default_job_progress, schema=ami.jobs.models.JobProgress
+            ),
+        ),
+    ]
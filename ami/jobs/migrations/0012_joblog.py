@@ -0,0 +1,30 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0011_job_distributed"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JobLog",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("level", models.IntegerField(default=20)),
+                ("message", models.TextField()),
+                ("created_at", models.DateTimeField()),
+                (
+                    "job",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="logs", to="jobs.job"),
+                ),
+            ],
+            options={
+                "ordering": ["-created_at", "-id"],
+                "indexes": [models.Index(fields=["job", "-created_at", "-id"], name="jobs_joblog_job_id_6693e8_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.10 on 2026-10-16 22:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("jobs", "0012_joblog"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="shard_task_ids",
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -1,19 +1,23 @@
 import datetime
+import itertools
 import logging
-import random
 import time
 import typing
 
+import celery
 import pydantic
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.utils.text import slugify
 from django_pydantic_field import SchemaField
 
 from ami.base.models import BaseModel
 from ami.base.schemas import ConfigurableStage, ConfigurableStageParam
-from ami.jobs.tasks import run_job
-from ami.main.models import Deployment, Project, SourceImage, SourceImageCollection
+from ami.jobs.tasks import fail_distributed_job, finish_distributed_job, run_job
+from ami.main.models import Deployment, Project, SourceImage, SourceImageCollection, mark_deployment_stale
 from ami.ml.models import Pipeline
+from ami.ml.models.pipeline import iter_image_ids, iter_images
+from ami.ml.tasks import process_and_save_images
 from ami.utils.schemas import OrderedEnum
 
 logger = logging.getLogger(__name__)
@@ -113,6 +117,7 @@ class JobProgress(pydantic.BaseModel):
     summary: JobProgressSummary
     stages: list[JobProgressStageDetail]
     errors: list[str] = []
+    # Logs are written to the JobLog table, and added here by the API
     logs: list[str] = []
 
     def add_stage(self, name: str) -> JobProgressStageDetail:
@@ -220,33 +225,61 @@ def default_ml_job_progress() -> JobProgress:
 
 class JobLogHandler(logging.Handler):
     """
-    Class for handling logs from a job and writing them to the job instance.
+    Class for handling logs from a job and writing them to the job's log table.
+
+    Records are buffered and written in bulk once `JOB_LOG_FLUSH_SIZE` records are waiting or
+    `JOB_LOG_FLUSH_SECONDS` have passed, so logging doesn't save the whole job for every line.
+    Errors are written straight away. The buffer is also flushed whenever the job is saved.
     """
 
     max_log_length = 1000
 
     def __init__(self, job: "Job", *args, **kwargs):
         self.job = job
+        self.buffer: list[JobLog] = []
+        self.last_flush = time.monotonic()
         super().__init__(*args, **kwargs)
 
     def emit(self, record):
         # Log to the current app logger
         logger.log(record.levelno, self.format(record))
 
-        # Write to the logs field on the job instance
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        msg = f"[{timestamp}] {record.levelname} {self.format(record)}"
-        if msg not in self.job.progress.logs:
-            self.job.progress.logs.insert(0, msg)
+        if self.job.pk is None:
+            return
+
+        self.buffer.append(
+            JobLog(
+                job_id=self.job.pk,
+                level=record.levelno,
+                message=self.format(record),
+                created_at=datetime.datetime.fromtimestamp(record.created),
+            )
+        )
 
-        # Write a simpler copy of any errors to the errors field
+        # Write a simpler copy of any errors to the errors field, which is saved with the job
         if record.levelno >= logging.ERROR:
             if record.message not in self.job.progress.errors:
                 self.job.progress.errors.insert(0, record.message)
 
-        if len(self.job.progress.logs) > self.max_log_length:
-            self.job.progress.logs = self.job.progress.logs[: self.max_log_length]
-        self.job.save()
+        if (
+            record.levelno >= logging.ERROR
+            or len(self.buffer) >= settings.JOB_LOG_FLUSH_SIZE
+            or time.monotonic() - self.last_flush >= settings.JOB_LOG_FLUSH_SECONDS
+        ):
+            self.flush()
+
+    def flush(self):
+        self.acquire()
+        try:
+            records, self.buffer = self.buffer, []
+            self.last_flush = time.monotonic()
+            if records:
+                JobLog.objects.bulk_create(records)
+        except Exception as e:
+            # Losing a few log lines shouldn't fail the job
+            logger.warning(f"Could not write {len(records)} log records for job {self.job.pk}: {e}")
+        finally:
+            self.release()
 
 
 class Job(BaseModel):
@@ -262,7 +295,7 @@ class Job(BaseModel):
     finished_at = models.DateTimeField(null=True, blank=True)
     # @TODO can we use an Enum or Pydantic model for status?
     status = models.CharField(max_length=255, default=JobState.CREATED.name, choices=JobState.choices())
-    progress: JobProgress = SchemaField(JobProgress, default=default_job_progress())
+    progress: JobProgress = SchemaField(JobProgress, default=default_job_progress)
     result = models.JSONField(null=True, blank=True)
     task_id = models.CharField(max_length=255, null=True, blank=True)
     delay = models.IntegerField("Delay in seconds", default=0, help_text="Delay before running the job")
@@ -270,6 +303,13 @@ class Job(BaseModel):
         "Limit", null=True, blank=True, default=100, help_text="Limit the number of images to process"
     )
     shuffle = models.BooleanField("Shuffle", default=True, help_text="Process images in a random order")
+    distributed = models.BooleanField(
+        "Distributed",
+        default=False,
+        help_text="Split the images into shards that are processed in parallel by multiple workers",
+    )
+    # The Celery tasks of the shards of a distributed job, so they can be revoked when the job is canceled
+    shard_task_ids = models.JSONField(default=list, blank=True, editable=False)
 
     project = models.ForeignKey(
         Project,
@@ -342,6 +382,10 @@ class Job(BaseModel):
             self.progress.add_stage_param(pipeline_stage.key, "Remaining", "")
             self.progress.add_stage_param(pipeline_stage.key, "Detections", "")
             self.progress.add_stage_param(pipeline_stage.key, "Classifications", "")
+            self.progress.add_stage_param(pipeline_stage.key, "Images per second", "")
+            if self.distributed:
+                self.progress.add_stage_param(pipeline_stage.key, "Shards", "")
+                self.progress.add_stage_param(pipeline_stage.key, "Shards completed", "")
 
             saving_stage = self.progress.add_stage("Results")
             self.progress.add_stage_param(saving_stage.key, "Objects created", "")
@@ -393,77 +437,93 @@ class Job(BaseModel):
                 progress=0,
             )
 
-            images = list(
-                # @TODO return generator plus image count
-                # @TODO pass to celery group chain?
-                self.pipeline.collect_images(
-                    collection=self.source_image_collection,
-                    deployment=self.deployment,
-                    source_images=[self.source_image_single] if self.source_image_single else None,
-                    job_id=self.pk,
-                    skip_processed=True,
-                    # shuffle=self.shuffle,
-                )
+            # @TODO pass to celery group chain?
+            images = self.pipeline.collect_images(
+                collection=self.source_image_collection,
+                deployment=self.deployment,
+                source_images=[self.source_image_single] if self.source_image_single else None,
+                job_id=self.pk,
+                skip_processed=True,
             )
-            source_image_count = len(images)
+            source_image_count = images.count()
             self.progress.update_stage("collect", total_images=source_image_count)
 
-            if self.shuffle and source_image_count > 1:
-                self.logger.info("Shuffling images")
-                random.shuffle(images)
-
             # @TODO remove this temporary limit
             TEMPORARY_LIMIT = 200
             self.limit = self.limit or TEMPORARY_LIMIT
 
             if self.limit and source_image_count > self.limit:
                 self.logger.warn(f"Limiting number of images to {self.limit} (out of {source_image_count})")
-                images = images[: self.limit]
-                image_count = len(images)
+                image_count = self.limit
                 self.progress.add_stage_param("collect", "Limit", image_count)
             else:
                 image_count = source_image_count
 
+            shuffle = self.shuffle and source_image_count > 1
+            if shuffle:
+                self.logger.info("Shuffling images")
+
+            # Image IDs are streamed from the database and the limit is applied before any images are loaded
+            image_ids = iter_image_ids(
+                images,
+                limit=image_count if image_count < source_image_count else None,
+                shuffle=shuffle,
+            )
+
             self.progress.update_stage(
                 "collect",
                 status=JobState.SUCCESS,
                 progress=1,
             )
 
+            if self.distributed:
+                self.run_distributed(image_ids=image_ids)
+                # The job is finished by the chord callback once all shards have been processed
+                return
+
             total_detections = 0
             total_classifications = 0
-
-            CHUNK_SIZE = 4  # Keep it low to see more progress updates
-            chunks = [images[i : i + CHUNK_SIZE] for i in range(0, image_count, CHUNK_SIZE)]  # noqa
-
-            for i, chunk in enumerate(chunks):
-                try:
-                    results = self.pipeline.process_images(
-                        images=chunk,
-                        job_id=self.pk,
-                    )
-                except Exception as e:
+            total_processed = 0
+            batch_num = 0
+            deployment_ids = set()
+            processing_start = time.time()
+
+            # Several batches are sent to the ML backend at once. Results are saved here as they arrive,
+            # while the following batches are still being processed by the backend.
+            for batch in self.pipeline.process_images_pipelined(images=iter_images(image_ids)):
+                batch_num += 1
+                total_processed += len(batch.images)
+                deployment_ids.update(image.deployment_id for image in batch.images)
+                if batch.error or not batch.results:
                     # Log error about image batch and continue
-                    self.logger.error(f"Failed to process image batch {i} of {len(chunks)}: {e}")
+                    self.logger.error(f"Failed to process image batch {batch_num}: {batch.error}")
                     continue
+                results = batch.results
 
+                num_classifications = len([c for d in results.detections for c in d.classifications])
+                self.logger.info(
+                    f"Processed batch {batch_num} of {len(batch.images)} images in {batch.elapsed_seconds:.1f}s, "
+                    f"found {len(results.detections)} detections and {num_classifications} classifications"
+                )
                 total_detections += len(results.detections)
-                total_classifications += len([c for d in results.detections for c in d.classifications])
+                total_classifications += num_classifications
+                elapsed = time.time() - processing_start
                 self.progress.update_stage(
                     "process",
                     status=JobState.STARTED,
-                    progress=(i + 1) / len(chunks),
-                    processed=(i + 1) * CHUNK_SIZE,
-                    remaining=image_count - (i + 1) * CHUNK_SIZE,
+                    progress=total_processed / image_count,
+                    processed=total_processed,
+                    remaining=image_count - total_processed,
                     detections=total_detections,
                     classifications=total_classifications,
+                    images_per_second=round(total_processed / elapsed, 2) if elapsed else "",
                 )
                 self.save()
                 objects = self.pipeline.save_results(results=results, job_id=self.pk)
                 self.progress.update_stage(
                     "results",
                     status=JobState.STARTED,
-                    progress=(i + 1) / len(chunks),
+                    progress=total_processed / image_count,
                     objects_created=len(objects),
                 )
                 self.update_progress()
@@ -477,19 +537,158 @@ class Job(BaseModel):
                 "results",
                 status=JobState.SUCCESS,
             )
+            # Regenerate the charts once the counts of the processed deployments are refreshed
+            mark_deployment_stale(deployment_ids, "detections", "occurrences", warm_charts=True)
 
         self.update_status(JobState.SUCCESS)
         self.update_progress()
         self.finished_at = datetime.datetime.now()
         self.save()
 
+    def run_distributed(self, image_ids: typing.Iterable[int]):
+        """
+        Split the images into shards and process them in parallel Celery sub-tasks.
+
+        Each shard updates the job progress as it completes, and a chord callback
+        marks the job as finished once all of the shards are done.
+        The ids of the shard tasks are saved, so they can be revoked when the job is canceled.
+        """
+        assert self.pipeline, "Job must have a pipeline to be run in distributed mode"
+        shard_size = settings.JOB_SHARD_SIZE
+        image_ids = iter(image_ids)
+        shards = []
+        while shard := list(itertools.islice(image_ids, shard_size)):
+            shards.append(shard)
+        num_images = sum(len(shard) for shard in shards)
+        self.progress.update_stage(
+            "process",
+            status=JobState.STARTED,
+            processed=0,
+            remaining=num_images,
+            shards=len(shards),
+            shards_completed=0,
+        )
+        self.progress.update_stage("results", status=JobState.STARTED)
+
+        if not shards:
+            self.finish_distributed(shard_results=[])
+            return
+
+        self.logger.info(f"Processing {num_images} images in {len(shards)} shards of up to {shard_size} images")
+        self.shard_task_ids = [celery.uuid() for _ in shards]
+        self.save()
+        header = [
+            process_and_save_images.s(
+                pipeline_choice=self.pipeline.slug,
+                endpoint_url=self.pipeline.endpoint_url,
+                image_ids=shard,
+                job_id=self.pk,
+            ).set(task_id=task_id)
+            for shard, task_id in zip(shards, self.shard_task_ids)
+        ]
+        callback = finish_distributed_job.s(job_id=self.pk).on_error(fail_distributed_job.s(job_id=self.pk))
+        celery.chord(header)(callback)
+
+    @classmethod
+    def record_shard_result(cls, job_id: int, summary: dict):
+        """
+        Add the results of one shard to the progress of a distributed job.
+
+        Shards finish concurrently, so the job row is locked while its progress is updated.
+        """
+        with transaction.atomic():
+            job = cls.objects.select_for_update().get(pk=job_id)
+            stage = job.progress.get_stage("process")
+            counts = {param.key: param.value for param in stage.params}
+            processed = (counts.get("processed") or 0) + summary["images"]
+            remaining = max((counts.get("remaining") or 0) - summary["images"], 0)
+            job.progress.update_stage(
+                "process",
+                progress=processed / ((processed + remaining) or 1),
+                processed=processed,
+                remaining=remaining,
+                detections=(counts.get("detections") or 0) + summary["detections"],
+                classifications=(counts.get("classifications") or 0) + summary["classifications"],
+                shards_completed=(counts.get("shards_completed") or 0) + 1,
+            )
+            objects_created = job.progress.get_stage_param("results", "objects_created").value or 0
+            job.progress.update_stage(
+                "results",
+                progress=processed / ((processed + remaining) or 1),
+                objects_created=objects_created + summary["objects_created"],
+            )
+            for error in summary["errors"]:
+                if error not in job.progress.errors:
+                    job.progress.errors.insert(0, error)
+            job.save()
+
+    def finish_distributed(self, shard_results: list[dict]):
+        """
+        Mark a distributed job as finished, using the summaries returned by all of its shards.
+        """
+        if self.finished_at:
+            # Canceled while the last shards were running
+            return
+        num_errors = sum(len(result["errors"]) for result in shard_results)
+        num_failed = len([result for result in shard_results if result.get("failed")])
+        status = JobState.FAILURE if num_failed else JobState.SUCCESS
+        self.progress.update_stage(
+            "process",
+            status=status,
+            progress=1,
+            processed=sum(result["images"] for result in shard_results),
+            remaining=0,
+            detections=sum(result["detections"] for result in shard_results),
+            classifications=sum(result["classifications"] for result in shard_results),
+            shards_completed=len(shard_results),
+        )
+        self.progress.update_stage(
+            "results",
+            status=JobState.SUCCESS,
+            progress=1,
+            objects_created=sum(result["objects_created"] for result in shard_results),
+        )
+        if num_failed:
+            self.logger.error(f"{num_failed} of {len(shard_results)} shards failed")
+        elif num_errors:
+            self.logger.warning(f"Finished with {num_errors} errors across {len(shard_results)} shards")
+        mark_deployment_stale(
+            {pk for result in shard_results for pk in result.get("deployments", [])},
+            "detections",
+            "occurrences",
+            warm_charts=True,
+        )
+        self.update_status(status, save=False)
+        self.update_progress(save=False)
+        self.finished_at = datetime.datetime.now()
+        self.save()
+
+    def fail_distributed(self, error: str):
+        """
+        Mark a distributed job as failed when its shards could not all be processed.
+        """
+        if self.finished_at:
+            return
+        self.logger.error(error)
+        self.progress.update_stage("process", status=JobState.FAILURE)
+        self.update_status(JobState.FAILURE, save=False)
+        self.finished_at = datetime.datetime.now()
+        self.save()
+
     def cancel(self):
         """
-        Terminate the celery task.
+        Terminate the celery task, and the tasks of its shards if the job is distributed.
         """
         self.status = JobState.CANCELING
         self.save()
-        if self.task_id:
+        if self.distributed and self.shard_task_ids and not self.finished_at:
+            # The job's own task is done once the shards are queued, so the shards have to be revoked directly
+            process_and_save_images.app.control.revoke(self.shard_task_ids, terminate=True)
+            self.logger.info(f"Revoked {len(self.shard_task_ids)} shard tasks")
+            self.update_status(JobState.REVOKED, save=False)
+            self.finished_at = datetime.datetime.now()
+            self.save()
+        elif self.task_id:
             task = run_job.AsyncResult(self.task_id)
             if task:
                 task.revoke(terminate=True)
@@ -553,6 +752,22 @@ class Job(BaseModel):
         else:
             self.setup(save=False)
         super().save(*args, **kwargs)
+        self.flush_logs()
+
+    def flush_logs(self):
+        """
+        Write any buffered log records for this job to the log table.
+        """
+        for handler in logging.getLogger(f"ami.jobs.{self.pk}").handlers:
+            if isinstance(handler, JobLogHandler):
+                handler.flush()
+
+    def recent_logs(self, limit: int = JobLogHandler.max_log_length) -> list["JobLog"]:
+        """
+        Return the most recent log records of the job, newest first.
+        """
+        self.flush_logs()
+        return list(self.logs.all()[:limit])
 
     @classmethod
     def default_progress(cls) -> JobProgress:
@@ -562,8 +777,14 @@ class Job(BaseModel):
     @property
     def logger(self) -> logging.Logger:
         logger = logging.getLogger(f"ami.jobs.{self.pk}")
-        # Also log output to a field on thie model instance
-        logger.addHandler(JobLogHandler(self))
+        # Also log output to the job's log table, with a single handler per job
+        for handler in logger.handlers:
+            if isinstance(handler, JobLogHandler):
+                # Errors are added to the progress of the most recently loaded instance of the job
+                handler.job = self
+                break
+        else:
+            logger.addHandler(JobLogHandler(self))
         return logger
 
     class Meta:
@@ -572,3 +793,22 @@ class Job(BaseModel):
         #     ("run_job", "Can run a job"),
         #     ("cancel_job", "Can cancel a job"),
         # ]
+
+
+class JobLog(models.Model):
+    """A line of the log output of a job"""
+
+    job = models.ForeignKey(Job, on_delete=models.CASCADE, related_name="logs")
+    level = models.IntegerField(default=logging.INFO)
+    message = models.TextField()
+    created_at = models.DateTimeField()
+
+    def __str__(self) -> str:
+        timestamp = self.created_at.strftime("%Y-%m-%d %H:%M:%S")
+        return f"[{timestamp}] {logging.getLevelName(self.level)} {self.message}"
+
+    class Meta:
+        ordering = ["-created_at", "-id"]
+        indexes = [
+            models.Index(fields=["job", "-created_at", "-id"]),
+        ]
@@ -1,3 +1,5 @@
+import logging
+
 from django_pydantic_field.rest_framework import SchemaField
 from rest_framework import serializers
 
@@ -86,6 +88,7 @@ class JobListSerializer(DefaultSerializer):
             "delay",
             "limit",
             "shuffle",
+            "distributed",
             "project",
             "project_id",
             "deployment",
@@ -127,3 +130,16 @@ class JobSerializer(JobListSerializer):
         fields = JobListSerializer.Meta.fields + [
             "result",
         ]
+
+    def to_representation(self, instance: Job):
+        data = super().to_representation(instance)
+        # Logs are kept in their own table, and only loaded for the detail view
+        logs = instance.recent_logs()
+        if logs:
+            # Older jobs have their logs stored in the progress field
+            data["progress"]["logs"] = [str(log) for log in logs]
+        errors = data["progress"]["errors"]
+        for log in logs:
+            if log.level >= logging.ERROR and log.message not in errors:
+                errors.append(log.message)
+        return data
@@ -3,7 +3,7 @@ import logging
 from celery.result import AsyncResult
 from celery.signals import task_failure, task_postrun, task_prerun
 
-from ami.tasks import default_soft_time_limit, default_time_limit
+from ami.tasks import default_soft_time_limit, default_time_limit, one_hour
 from config import celery_app
 
 logger = logging.getLogger(__name__)
@@ -28,12 +28,39 @@ def run_job(self, job_id: int) -> None:
         else:
             job.refresh_from_db()
             job.logger.info(f"Finished job {job}")
+        finally:
+            job.flush_logs()
+
+
+@celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
+def finish_distributed_job(shard_results: list[dict], job_id: int) -> None:
+    """
+    Chord callback for a job that was split into shards, called once all of the shards are done.
+    """
+    from ami.jobs.models import Job
+
+    job = Job.objects.get(pk=job_id)
+    job.finish_distributed(shard_results)
+    job.logger.info(f"Finished job {job}")
+    job.flush_logs()
+
+
+@celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
+def fail_distributed_job(request, exc, traceback, job_id: int) -> None:
+    """
+    Errback of the chord callback, called if a shard of a distributed job was killed or raised an exception.
+    """
+    from ami.jobs.models import Job
+
+    job = Job.objects.get(pk=job_id)
+    job.fail_distributed(f"Failed to process shard: {exc}")
+    job.flush_logs()
 
 
 @task_postrun.connect(sender=run_job)
 @task_prerun.connect(sender=run_job)
 def update_job_status(sender, task_id, task, *args, **kwargs):
-    from ami.jobs.models import Job
+    from ami.jobs.models import Job, JobState
 
     job_id = task.request.kwargs["job_id"]
     if job_id is None:
@@ -49,6 +76,9 @@ def update_job_status(sender, task_id, task, *args, **kwargs):
             return
 
     task = AsyncResult(task_id)  # I'm not sure if this is reliable
+    if job.distributed and not job.finished_at and task.status == JobState.SUCCESS:
+        # The job's shards are still being processed by other tasks, the chord callback will finish the job
+        return
     job.update_status(task.status, save=False)
     job.save()
 
@@ -1,10 +1,18 @@
-from django.test import TestCase
+from unittest import mock
+
+from celery.exceptions import TimeLimitExceeded
+from django.test import TestCase, override_settings
 from rest_framework.test import APIRequestFactory, APITestCase
 
+import ami.ml.client
 from ami.base.serializers import reverse_with_params
-from ami.jobs.models import Job, JobProgress, JobState
-from ami.main.models import Project
+from ami.jobs.models import Job, JobLog, JobLogHandler, JobProgress, JobState
+from ami.jobs.tasks import fail_distributed_job, finish_distributed_job
+from ami.main.models import Project, SourceImage, SourceImageCollection
+from ami.ml.models import Pipeline
+from ami.ml.schemas import PipelineResponse, SourceImageResponse
 from ami.users.models import User
+from config import celery_app
 
 # from rich import print
 
@@ -38,6 +46,58 @@ class TestJobProgress(TestCase):
         self.assertEqual(job.progress.stages[0].status, JobState.SUCCESS)
 
 
+@override_settings(JOB_LOG_FLUSH_SIZE=5, JOB_LOG_FLUSH_SECONDS=60)
+class TestJobLogs(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="Job logs test")
+        self.job = Job.objects.create(project=self.project, name="Test job")
+
+    def test_single_handler_per_job(self):
+        for _ in range(3):
+            self.job.logger.info("Test")
+        handlers = [h for h in self.job.logger.handlers if isinstance(h, JobLogHandler)]
+        self.assertEqual(len(handlers), 1)
+
+        # Another instance of the same job reuses the handler
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertEqual(job.logger.handlers, handlers)
+        self.assertIs(handlers[0].job, job)
+        job.flush_logs()
+        self.assertEqual(JobLog.objects.filter(job=self.job).count(), 3)
+
+    def test_logs_are_buffered(self):
+        # Log lines don't save the job, and are written in batches
+        with self.assertNumQueries(0):
+            for i in range(4):
+                self.job.logger.info(f"Line {i}")
+        with self.assertNumQueries(1):
+            self.job.logger.info("Line 4")
+        self.assertEqual(JobLog.objects.filter(job=self.job).count(), 5)
+
+        # Errors are written straight away, and remaining lines are written when the job is saved
+        self.job.logger.info("Line 5")
+        self.job.logger.error("Failed")
+        self.assertEqual(JobLog.objects.filter(job=self.job).count(), 7)
+        self.assertEqual(self.job.progress.errors, ["Failed"])
+        self.job.logger.info("Line 6")
+        self.job.save()
+        self.assertEqual(JobLog.objects.filter(job=self.job).count(), 8)
+
+        logs = self.job.recent_logs(limit=3)
+        self.assertEqual([log.message for log in logs], ["Line 6", "Failed", "Line 5"])
+        self.assertTrue(str(logs[1]).endswith("ERROR Failed"))
+
+    def test_logs_in_api(self):
+        self.job.logger.info("Hello")
+        self.job.logger.error("Failed")
+        # The error was not saved to the progress field, but is still listed
+        resp = self.client.get(reverse_with_params("api:job-detail", args=[self.job.pk]))
+        progress = JobProgress(**resp.json()["progress"])
+        self.assertEqual(len(progress.logs), 2)
+        self.assertTrue(progress.logs[1].endswith("INFO Hello"))
+        self.assertEqual(progress.errors, ["Failed"])
+
+
 class TestJobView(APITestCase):
     """
     Test the jobs API endpoints.
@@ -121,3 +181,128 @@ class TestJobView(APITestCase):
         # This cannot be tested until we have a way to cancel jobs
         # and a way to run async tasks in tests.
         pass
+
+
+class TestDistributedJob(TestCase):
+    def setUp(self):
+        self.project = Project.objects.create(name="Distributed job test")
+        self.images = [SourceImage.objects.create(path=f"test-2024010100{i:02d}00.jpg") for i in range(5)]
+        self.collection = SourceImageCollection.objects.create(name="Test Collection", project=self.project)
+        self.collection.images.set(self.images)
+        self.pipeline = Pipeline.objects.create(name="Test Pipeline", endpoint_url="http://ml-backend/")
+
+    def fake_send(self, endpoint_url, request_data):
+        return PipelineResponse(
+            pipeline=request_data.pipeline,
+            total_time=0.0,
+            source_images=[SourceImageResponse(id=image.id, url=image.url) for image in request_data.source_images],
+            detections=[],
+        )
+
+    @override_settings(JOB_SHARD_SIZE=2)
+    def test_run_distributed_job(self):
+        job = Job.objects.create(
+            project=self.project,
+            name="Test distributed job",
+            pipeline=self.pipeline,
+            source_image_collection=self.collection,
+            distributed=True,
+        )
+        celery_app.conf.task_always_eager = True
+        try:
+            with mock.patch("ami.ml.client.send_pipeline_request", self.fake_send):
+                job.run()
+        finally:
+            celery_app.conf.task_always_eager = False
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobState.SUCCESS.value)
+        self.assertEqual(job.progress.summary.progress, 1)
+        self.assertEqual(job.progress.get_stage_param("process", "shards").value, 3)
+        self.assertEqual(job.progress.get_stage_param("process", "shards_completed").value, 3)
+        self.assertEqual(job.progress.get_stage_param("process", "processed").value, len(self.images))
+        self.assertEqual(job.progress.get_stage_param("process", "remaining").value, 0)
+
+    @override_settings(JOB_SHARD_SIZE=2)
+    def test_failed_shard(self):
+        job = Job.objects.create(
+            project=self.project,
+            name="Test distributed job",
+            pipeline=self.pipeline,
+            source_image_collection=self.collection,
+            distributed=True,
+        )
+        process_images_pipelined = ami.ml.client.process_images_pipelined
+
+        def fail_first_shard(images, **kwargs):
+            if self.images[0] in images:
+                raise ValueError("Backend exploded")
+            return process_images_pipelined(images=images, **kwargs)
+
+        celery_app.conf.task_always_eager = True
+        try:
+            with mock.patch("ami.ml.client.send_pipeline_request", self.fake_send), mock.patch(
+                "ami.ml.client.process_images_pipelined", fail_first_shard
+            ):
+                job.run()
+        finally:
+            celery_app.conf.task_always_eager = False
+
+        # The job is still finished, and the failure is recorded
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobState.FAILURE.value)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(job.progress.get_stage("process").status, JobState.FAILURE)
+        self.assertEqual(job.progress.get_stage_param("process", "shards_completed").value, 3)
+        # The images are shuffled, so the failed shard is either one of the full shards or the last one
+        self.assertIn("1 of 3 shards failed", job.progress.errors)
+        self.assertTrue(
+            any(
+                error in job.progress.errors
+                for error in [f"Failed to process shard of {n} images: Backend exploded" for n in [1, 2]]
+            )
+        )
+
+    @override_settings(JOB_SHARD_SIZE=2)
+    def test_cancel_revokes_shards(self):
+        job = Job.objects.create(
+            project=self.project,
+            name="Test distributed job",
+            pipeline=self.pipeline,
+            source_image_collection=self.collection,
+            distributed=True,
+        )
+        # Queue the shards without running them
+        with mock.patch("celery.chord") as chord:
+            job.run()
+        job.refresh_from_db()
+        self.assertEqual(len(job.shard_task_ids), 3)
+        header = chord.call_args.args[0]
+        self.assertEqual([signature.options["task_id"] for signature in header], job.shard_task_ids)
+
+        with mock.patch.object(celery_app.control, "revoke") as revoke:
+            job.cancel()
+        revoke.assert_called_once_with(job.shard_task_ids, terminate=True)
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobState.REVOKED.value)
+
+        # The chord callback doesn't finish a canceled job
+        finish_distributed_job([], job_id=job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobState.REVOKED.value)
+
+    def test_chord_error(self):
+        job = Job.objects.create(
+            project=self.project,
+            name="Test distributed job",
+            pipeline=self.pipeline,
+            source_image_collection=self.collection,
+            distributed=True,
+        )
+        job.update_status(JobState.STARTED)
+        fail_distributed_job(None, TimeLimitExceeded(3660), None, job_id=job.pk)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, JobState.FAILURE.value)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(len(job.progress.errors), 1)
@@ -1,6 +1,9 @@
 import logging
 import pathlib
+import time
+import typing
 
+from django.conf import settings
 from django.db import models
 from django.utils.text import slugify
 from rest_framework.renderers import JSONRenderer
@@ -60,47 +63,71 @@ class LabelStudioConfig(models.Model):
             endpoint_url=self.s3_endpoint,
         )
 
-    def write_tasks(self):
+    @staticmethod
+    def task_key(source_image) -> str:
+        """
+        Use the original filename as the key, made path safe.
+        """
+        original_path = str(pathlib.Path(source_image.path).with_suffix(""))
+        original_path = original_path.replace("/", "-")
+        return slugify(original_path) + ".json"
+
+    def write_tasks(self, batch_size: int | None = None, max_workers: int | None = None) -> int:
         """
         Serialize and write tasks to S3.
 
-        :param collection: Source image collection
+        The existing tasks are listed once up front and skipped without being serialized.
+        New tasks are serialized in batches and uploaded with several requests in flight at once.
+        Returns the number of new tasks that were published.
         """
         from ami.labelstudio.serializers import LabelStudioSourceImageSerializer
 
         if not self.task_collection:
             raise ValueError("Task collection must be set")
 
+        batch_size = batch_size or settings.LABEL_STUDIO_EXPORT_BATCH_SIZE
+        max_workers = max_workers or settings.LABEL_STUDIO_EXPORT_MAX_WORKERS
         bucket_config = self.task_bucket_config()
+        start_time = time.time()
+
+        # The subdir is specified as the prefix in the S3 URI
+        existing_keys = ami.utils.s3.list_keys(bucket_config)
+        logger.info(f"Found {len(existing_keys)} existing tasks in S3")
 
         # Setup JSON renderer from Django REST Framework
         renderer = JSONRenderer()
+        images = self.task_collection.images.select_related("deployment__project").order_by("pk")
+        skipped = 0
+
+        def new_tasks() -> typing.Generator[tuple[str, bytes], None, None]:
+            nonlocal skipped
+            batch = []
+            for image in images.iterator(chunk_size=batch_size):
+                key = self.task_key(image)
+                if key in existing_keys:
+                    skipped += 1
+                    continue
+                # Only the first image with a given filename is published, later ones would overwrite it
+                existing_keys.add(key)
+                batch.append((key, image))
+                if len(batch) >= batch_size:
+                    yield from render(batch)
+                    batch = []
+            yield from render(batch)
+
+        def render(batch: list) -> typing.Generator[tuple[str, bytes], None, None]:
+            serialized_tasks = LabelStudioSourceImageSerializer([image for _, image in batch], many=True).data
+            for (key, _), serialized_task in zip(batch, serialized_tasks):
+                yield key, renderer.render(serialized_task, renderer_context={"indent": 2})
 
-        # Render and write tasks as individual JSON files to S3
         count = 0
-        for task in self.task_collection.images.all():
-            # Serialize task
-            serialized_task = LabelStudioSourceImageSerializer(task, many=False).data
-            task_json = renderer.render(serialized_task, renderer_context={"indent": 2})
-
-            # Use the original filename as the key, made path safe
-            original_path = str(pathlib.Path(task.path).with_suffix(""))
-            original_path = original_path.replace("/", "-")
-            key = slugify(original_path) + ".json"
-
-            if ami.utils.s3.file_exists(bucket_config, key):
-                logger.info(f"Skipping existing task: {key}")
-            else:
-                logger.info(f"Publishing new task to S3: {key}")
-
-                # The subdir is specified as the prefix in the S3 URI
-                result = ami.utils.s3.write_file(
-                    config=bucket_config,
-                    key=key,
-                    body=task_json,
-                )
-                if result:
-                    count += 1
-
-        logger.info(f"Published {count} new tasks to S3")
+        for key in ami.utils.s3.write_files_concurrently(bucket_config, new_tasks(), max_workers=max_workers):
+            logger.debug(f"Published new task to S3: {key}")
+            count += 1
+
+        elapsed = time.time() - start_time
+        logger.info(
+            f"Published {count} new tasks to S3 and skipped {skipped} existing tasks in {elapsed:.1f} seconds "
+            f"({count / elapsed if elapsed else 0:.1f} tasks per second)"
+        )
         return count
@@ -0,0 +1,86 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from ami.labelstudio.models import LabelStudioConfig
+from ami.labelstudio.views import get_taxonomy_xml, taxa_tree_to_xml
+from ami.main.models import DEFAULT_RANKS, SourceImageCollection, Taxon
+from ami.main.tests import FakeS3Client, create_captures, create_taxa, setup_test_project
+
+
+class TestTaxonomyConfig(TestCase):
+    def setUp(self) -> None:
+        project, deployment = setup_test_project(reuse=False)
+        self.taxa_list = create_taxa(project=project)
+        cache.clear()
+        return super().setUp()
+
+    def test_taxonomy_xml_is_cached(self):
+        expected = taxa_tree_to_xml(Taxon.objects.tree())
+        self.assertEqual(get_taxonomy_xml(), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_taxonomy_xml(), expected)
+
+        expected = taxa_tree_to_xml(self.taxa_list.taxa.tree())  # type: ignore
+        self.assertEqual(get_taxonomy_xml(self.taxa_list.pk), expected)
+
+    def test_taxonomy_subtree_requests(self):
+        genus = Taxon.objects.get(name="Vanessa")
+        expected = taxa_tree_to_xml(Taxon.objects.tree(root=genus, filter_ranks=DEFAULT_RANKS))
+
+        response = self.client.get("/api/v2/labelstudio/config/taxonomy/", {"path[]": ["Lepidoptera"]})
+        self.assertEqual(response.status_code, 200)
+        # Later requests for any part of the tree are served from the cache
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/api/v2/labelstudio/config/taxonomy/", {"path[]": ["Lepidoptera", genus.display_name]}
+            )
+        self.assertEqual([query["sql"] for query in queries if "main_taxon" in query["sql"]], [])
+        self.assertEqual(response.content.decode(), expected)
+
+        response = self.client.get("/api/v2/labelstudio/config/taxonomy/", {"path[]": ["Unknown taxon"]})
+        self.assertEqual(response.content.decode(), "")
+
+    def test_taxonomy_cache_is_invalidated(self):
+        self.assertNotIn("Vanessa virginiensis", get_taxonomy_xml())
+        Taxon.objects.create(name="Vanessa virginiensis", rank="SPECIES", parent=Taxon.objects.get(name="Vanessa"))
+        self.assertIn("Vanessa virginiensis", get_taxonomy_xml())
+
+        self.assertNotIn("Vanessa virginiensis", get_taxonomy_xml(self.taxa_list.pk))
+        self.taxa_list.taxa.add(Taxon.objects.get(name="Vanessa virginiensis"))
+        self.assertIn("Vanessa virginiensis", get_taxonomy_xml(self.taxa_list.pk))
+
+
+class TestWriteTasks(TestCase):
+    def setUp(self) -> None:
+        project, deployment = setup_test_project(reuse=False)
+        images = create_captures(deployment=deployment, num_nights=3, images_per_night=4)
+        collection = SourceImageCollection.objects.create(name="Test Collection", project=project)
+        collection.images.set(images)
+        self.config = LabelStudioConfig.objects.create(
+            task_collection=collection,
+            s3_uri="s3://test/tasks",
+            s3_key_id="test",
+            s3_key_secret="test",
+        )
+        self.client = FakeS3Client(["tasks/other.json"])
+        return super().setUp()
+
+    def write_tasks(self) -> int:
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.client):
+            return self.config.write_tasks(batch_size=5, max_workers=3)
+
+    def test_write_tasks(self):
+        self.assertEqual(self.write_tasks(), 12)
+        self.assertEqual(len(self.client.keys), 13)
+        self.assertIn("tasks/test-0_0.json", self.client.keys)
+
+        # Existing tasks are skipped, with a single listing instead of a request per task
+        self.client.keys.remove("tasks/test-2_3.json")
+        self.client.requests.clear()
+        self.assertEqual(self.write_tasks(), 1)
+        self.assertEqual(len(self.client.requests), 1)
+        self.assertEqual(len(self.client.keys), 13)
@@ -2,6 +2,8 @@ import html
 import logging
 
 import requests
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.template.loader import render_to_string
 from rest_framework import permissions, viewsets
@@ -15,8 +17,19 @@ from ami.labelstudio.serializers import (
     LabelStudioOccurrenceSerializer,
     LabelStudioSourceImageSerializer,
 )
+from ami.main import charts
 from ami.main.api.views import DefaultReadOnlyViewSet
-from ami.main.models import DEFAULT_RANKS, Deployment, Detection, Occurrence, Project, SourceImage, TaxaList, Taxon
+from ami.main.models import (
+    DEFAULT_RANKS,
+    Deployment,
+    Detection,
+    Occurrence,
+    Project,
+    SourceImage,
+    TaxaList,
+    Taxon,
+    TaxonRank,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -35,18 +48,88 @@ def taxa_tree_to_xml(taxa_tree):
     </Choice>
     """
 
+    return _choices_to_xml(
+        taxa_tree,
+        get_children=lambda node: node["children"],
+        get_choice=lambda node: (node["taxon"].get_display_name(), node["taxon"].rank),
+    )
+
+
+def _choices_to_xml(root, get_children, get_choice) -> str:
+    """
+    Render nested Choice elements, joining the parts once at the end rather than concatenating strings.
+    """
+    parts = []
+
     def _node_to_xml(node, level=0):
         indent = "  " * level
-        value = html.escape(str(node["taxon"].get_display_name()))
-        rank = html.escape(str(node["taxon"].rank))
-        xml = f'\n{indent}<Choice value="{value}" hint="{rank}">'
-        for child in node["children"]:
-            xml += _node_to_xml(child, level + 1)
-        xml += f"{indent}</Choice>\n"
-        return xml
+        value, rank = get_choice(node)
+        parts.append(f'\n{indent}<Choice value="{html.escape(str(value))}" hint="{html.escape(str(rank))}">')
+        for child in get_children(node):
+            _node_to_xml(child, level + 1)
+        parts.append(f"{indent}</Choice>\n")
+
+    _node_to_xml(root)
+    return "".join(parts)
+
+
+def _taxonomy_cache_key(taxa_list_id: int | str | None, filter_ranks: list[TaxonRank]) -> str:
+    ranks = ",".join(rank.name for rank in filter_ranks) or "all"
+    return f"labelstudio:taxonomy:{taxa_list_id or 'all'}:{ranks}:{charts.get_data_version('taxa')}"
+
 
-    taxonomy_choices_xml = _node_to_xml(taxa_tree)
-    return taxonomy_choices_xml
+def get_taxonomy_tree(taxa_list_id: int | str | None = None, filter_ranks: list[TaxonRank] | None = None) -> dict:
+    """
+    Return the taxonomy tree of a taxa list (or of all taxa) as a flat index, from the cache if taxa have not changed.
+
+    The index has the display name & rank of each taxon, the IDs of the children of each taxon,
+    and the ID of each display name, so any subtree can be rendered without querying the database.
+    If taxa share a display name, the first one in the tree is used.
+    """
+    filter_ranks = filter_ranks or []
+    key = _taxonomy_cache_key(taxa_list_id, filter_ranks)
+    tree = cache.get(key)
+    if tree is None:
+        taxa = TaxaList.objects.get(id=taxa_list_id).taxa if taxa_list_id else Taxon.objects
+        taxa_tree = taxa.tree(filter_ranks=filter_ranks)  # type: ignore
+        tree = {"root": taxa_tree["taxon"].pk, "choices": {}, "children": {}, "ids": {}}
+        nodes = [taxa_tree]
+        while nodes:
+            node = nodes.pop()
+            taxon = node["taxon"]
+            tree["choices"][taxon.pk] = (taxon.get_display_name(), taxon.rank)
+            tree["children"][taxon.pk] = [child["taxon"].pk for child in node["children"]]
+            tree["ids"].setdefault(taxon.display_name, taxon.pk)
+            nodes.extend(node["children"])
+        cache.set(key, tree, timeout=settings.TAXONOMY_CACHE_TIMEOUT)
+    return tree
+
+
+def get_taxonomy_xml(
+    taxa_list_id: int | str | None = None,
+    filter_ranks: list[TaxonRank] | None = None,
+    root_name: str | None = None,
+) -> str | None:
+    """
+    Return the Choice elements of the taxonomy tree, or of the subtree under the taxon with a display name.
+
+    The XML of each subtree is cached once it has been rendered. Returns None if the taxon is not in the tree.
+    """
+    filter_ranks = filter_ranks or []
+    tree = get_taxonomy_tree(taxa_list_id, filter_ranks)
+    root_id = tree["root"] if root_name is None else tree["ids"].get(root_name)
+    if root_id is None:
+        return None
+    key = f"{_taxonomy_cache_key(taxa_list_id, filter_ranks)}:xml:{root_id}"
+    xml = cache.get(key)
+    if xml is None:
+        xml = _choices_to_xml(
+            root_id,
+            get_children=lambda taxon_id: tree["children"][taxon_id],
+            get_choice=lambda taxon_id: tree["choices"][taxon_id],
+        )
+        cache.set(key, xml, timeout=settings.TAXONOMY_CACHE_TIMEOUT)
+    return xml
 
 
 class LabelStudioFlatPaginator(LimitOffsetPagination):
@@ -196,15 +279,10 @@ class LabelStudioConfigViewSet(viewsets.ViewSet):
     def speciesclassification(self, request):
         """ """
         taxa_list_id = request.query_params.get("taxa_list", None)
-        if taxa_list_id:
-            taxa_list = TaxaList.objects.get(id=taxa_list_id)
-            taxa_tree = taxa_list.taxa.tree()  # type: ignore
-        else:
-            taxa_tree = Taxon.objects.tree()
 
         data = {
             "label_config": {
-                "taxonomy_choices_xml": taxa_tree_to_xml(taxa_tree),
+                "taxonomy_choices_xml": get_taxonomy_xml(taxa_list_id),
             }
         }
 
@@ -216,15 +294,10 @@ class LabelStudioConfigViewSet(viewsets.ViewSet):
     def all_in_one(self, request):
         """ """
         taxa_list_id = request.query_params.get("taxa_list", None)
-        if taxa_list_id:
-            taxa_list = TaxaList.objects.get(id=taxa_list_id)
-            taxa_tree = taxa_list.taxa.tree()  # type: ignore
-        else:
-            taxa_tree = Taxon.objects.tree()
 
         data = {
             "label_config": {
-                "taxonomy_choices_xml": taxa_tree_to_xml(taxa_tree),
+                "taxonomy_choices_xml": get_taxonomy_xml(taxa_list_id),
             }
         }
 
@@ -249,17 +322,17 @@ class LabelStudioConfigViewSet(viewsets.ViewSet):
         It is required to return the display name
         """
         path_parts = request.query_params.getlist("path[]")
-        if path_parts:
-            closest_parent = path_parts[-1]
+        closest_parent = path_parts[-1] if path_parts else None
+        content = get_taxonomy_xml(filter_ranks=DEFAULT_RANKS, root_name=closest_parent)
+        if content is None:
+            # Taxa that are not in the cached tree (e.g. inactive ones) are looked up directly
             parent = Taxon.objects.filter(display_name=closest_parent).first()
             if parent:
                 taxa_tree = Taxon.objects.tree(root=parent, filter_ranks=DEFAULT_RANKS)
+                content = taxa_tree_to_xml(taxa_tree)
             else:
                 # If a matching node is not found, return an empty response
                 return HttpResponse("", content_type="text/xml")
-        else:
-            taxa_tree = Taxon.objects.tree(filter_ranks=DEFAULT_RANKS)
-        content = taxa_tree_to_xml(taxa_tree)
         return HttpResponse(content, content_type="text/xml")
 
 
@@ -103,6 +103,12 @@ class DeploymentAdmin(admin.ModelAdmin[Deployment]):
         msg = f"Syncing captures for {len(queued_tasks)} deployments in background: {queued_tasks}"
         self.message_user(request, msg)
 
+    @admin.action(description="Sync new captures since the last sync from deployment's data source (async)")
+    def sync_new_captures(self, request: HttpRequest, queryset: QuerySet[Deployment]) -> None:
+        queued_tasks = [tasks.sync_source_images.delay(deployment.pk, incremental=True) for deployment in queryset]
+        msg = f"Syncing new captures for {len(queued_tasks)} deployments in background: {queued_tasks}"
+        self.message_user(request, msg)
+
     # Action that regroups all captures in the deployment into events
     @admin.action(description="Regroup captures into events")
     def regroup_events(self, request: HttpRequest, queryset: QuerySet[Deployment]) -> None:
@@ -113,7 +119,7 @@ class DeploymentAdmin(admin.ModelAdmin[Deployment]):
         self.message_user(request, f"Regrouped {queryset.count()} deployments.")
 
     list_filter = ("project",)
-    actions = [sync_captures, regroup_events]
+    actions = [sync_captures, sync_new_captures, regroup_events]
 
     def get_queryset(self, request: HttpRequest) -> QuerySet[Any]:
         qs = super().get_queryset(request)
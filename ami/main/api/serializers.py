@@ -1,8 +1,10 @@
 import datetime
 
 from django.db.models import QuerySet
+from django.forms import BooleanField
 from rest_framework import serializers
 
+from ami.base.pagination import KeysetCursor
 from ami.base.serializers import DefaultSerializer, get_current_user, reverse_with_params
 from ami.jobs.models import Job
 from ami.main.models import _create_source_image_from_upload
@@ -466,12 +468,15 @@ class TaxonListSerializer(DefaultSerializer):
 
     def get_occurrence_images(self, obj):
         """
-        Call the occurrence_images method on the Taxon model, with arguments.
+        Return the images loaded for the whole page by the view, or call the occurrence_images method
+        on the Taxon model, with arguments.
         """
 
-        # request = self.context.get("request")
-        # project_id = request.query_params.get("project") if request else None
-        project_id = self.context["request"].query_params["project"]
+        occurrence_images = self.context.get("occurrence_images")
+        if occurrence_images is not None and obj.pk in occurrence_images:
+            return occurrence_images[obj.pk]
+
+        project_id = self.context["request"].query_params.get("project")
         classification_threshold = get_active_classification_threshold(self.context["request"])
 
         return obj.occurrence_images(
@@ -719,17 +724,30 @@ class CaptureDetectionsSerializer(DefaultSerializer):
         )
 
 
+def get_thumbnail_url(obj: SourceImage) -> str:
+    """
+    Return the URL of the thumbnail of a source image, or of the original image until the thumbnail is created.
+    """
+    return obj.thumbnail_url() or obj.public_url()
+
+
 class DetectionCaptureNestedSerializer(DefaultSerializer):
+    thumbnail_url = serializers.SerializerMethodField()
+
     class Meta:
         model = SourceImage
         fields = [
             "id",
             "details",
             "url",
+            "thumbnail_url",
             "width",
             "height",
         ]
 
+    def get_thumbnail_url(self, obj) -> str:
+        return get_thumbnail_url(obj)
+
 
 class DetectionNestedSerializer(DefaultSerializer):
     classifications = ClassificationSerializer(many=True, read_only=True)
@@ -789,6 +807,7 @@ class SourceImageListSerializer(DefaultSerializer):
     detections = CaptureDetectionsSerializer(many=True, read_only=True, source="filtered_detections")
     deployment = DeploymentNestedSerializer(read_only=True)
     event = EventNestedSerializer(read_only=True)
+    thumbnail_url = serializers.SerializerMethodField()
     # file = serializers.ImageField(allow_empty_file=False, use_url=True)
 
     class Meta:
@@ -799,7 +818,7 @@ class SourceImageListSerializer(DefaultSerializer):
             "deployment",
             "event",
             "url",
-            # "thumbnail",
+            "thumbnail_url",
             "timestamp",
             "width",
             "height",
@@ -808,6 +827,9 @@ class SourceImageListSerializer(DefaultSerializer):
             "detections",
         ]
 
+    def get_thumbnail_url(self, obj) -> str:
+        return get_thumbnail_url(obj)
+
 
 class JobStatusSerializer(DefaultSerializer):
     class Meta:
@@ -1097,9 +1119,14 @@ class EventSerializer(DefaultSerializer):
     start = serializers.DateTimeField(read_only=True)
     end = serializers.DateTimeField(read_only=True)
     capture_page_offset = serializers.SerializerMethodField()
+    capture_cursor = serializers.SerializerMethodField()
     occurrences_count = serializers.SerializerMethodField()
     taxa_count = serializers.SerializerMethodField()
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._captures_with_subject: dict[int, SourceImage | None] = {}
+
     class Meta:
         model = Event
         fields = [
@@ -1123,18 +1150,25 @@ class EventSerializer(DefaultSerializer):
             "first_capture",
             "summary_data",
             "capture_page_offset",
+            "capture_cursor",
         ]
 
     def get_captures(self, obj):
         """
         Return URL to the captures endpoint filtered by this event.
+
+        If a capture, detection or occurrence is requested, the URL has a cursor that starts at its capture.
         """
 
         params = {"event": obj.pk, "ordering": "timestamp"}
 
-        initial_offset = self.get_capture_page_offset(obj)
-        if initial_offset:
-            params["offset"] = initial_offset
+        capture_cursor = self.get_capture_cursor(obj)
+        if capture_cursor:
+            params["cursor"] = capture_cursor
+        else:
+            initial_offset = self.context["request"].query_params.get("offset", None)
+            if initial_offset:
+                params["offset"] = initial_offset
 
         return reverse_with_params(
             "sourceimage-list",
@@ -1142,15 +1176,12 @@ class EventSerializer(DefaultSerializer):
             params=params,
         )
 
-    def get_capture_page_offset(self, obj) -> int | None:
+    def get_capture_with_subject(self, obj) -> SourceImage | None:
         """
         Look up the source image (capture) that contains a specific detection or occurrence.
-
-        Return the page offset for the capture to be used when requesting the capture list endpoint.
         """
         request = self.context["request"]
         event = obj
-        capture_with_subject = None
 
         occurrence_id = request.query_params.get("occurrence")
         detection_id = request.query_params.get("detection")
@@ -1166,6 +1197,8 @@ class EventSerializer(DefaultSerializer):
             capture_with_subject = Detection.objects.get(pk=detection_id).source_image
         elif occurrence_id:
             capture_with_subject = Occurrence.objects.get(pk=occurrence_id).first_appearance
+        else:
+            return None
 
         if capture_with_subject and capture_with_subject.event:
             # Assert that the capture is part of the event
@@ -1174,10 +1207,42 @@ class EventSerializer(DefaultSerializer):
                 f"Capture {capture_with_subject.pk} is not part of Event {event.pk} "
                 f"(It belongs to Event {capture_with_subject.event.pk})"
             )
+            return capture_with_subject
+        return None
+
+    def get_capture_cursor(self, obj) -> str | None:
+        """
+        Return a cursor for the captures endpoint that starts at the capture with the requested subject.
+
+        Unlike the page offset, this doesn't need to count the captures that come before it.
+        """
+        if obj.pk not in self._captures_with_subject:
+            self._captures_with_subject[obj.pk] = self.get_capture_with_subject(obj)
+        capture = self._captures_with_subject[obj.pk]
+        if not capture or not capture.timestamp:
+            return None
+        return KeysetCursor(value=capture.timestamp.isoformat(), pk=capture.pk, inclusive=True).encode()
+
+    def get_capture_page_offset(self, obj) -> int | None:
+        """
+        Return the page offset of the capture with the requested subject, to be used with the capture list endpoint.
+
+        This has to count all of the captures before the subject, so it is only done when the client asks
+        for it with `?capture_page_offset=true`, as the session view of the UI does. Otherwise the requested
+        `offset` is returned as is. Clients that page through captures with a cursor can use `capture_cursor`.
+        """
+        request = self.context["request"]
+        offset = request.query_params.get("offset", None)
+        if not BooleanField(required=False).clean(request.query_params.get("capture_page_offset", False)):
+            return offset
+
+        if obj.pk not in self._captures_with_subject:
+            self._captures_with_subject[obj.pk] = self.get_capture_with_subject(obj)
+        capture_with_subject = self._captures_with_subject[obj.pk]
+
+        if capture_with_subject:
             # This is only reliable if the captures are ordered by timestamp. Which is the default sort order.
-            offset = SourceImage.objects.filter(event=event, timestamp__lt=capture_with_subject.timestamp).count()
-        else:
-            offset = request.query_params.get("offset", None)
+            offset = SourceImage.objects.filter(event=obj, timestamp__lt=capture_with_subject.timestamp).count()
 
         return offset
 
@@ -2,10 +2,12 @@ import logging
 
 from django.contrib.postgres.search import TrigramSimilarity
 from django.core import exceptions
+from django.core.cache import cache
 from django.db import models
 from django.db.models import Prefetch
 from django.db.models.query import QuerySet
 from django.forms import BooleanField, CharField, IntegerField
+from django.http import HttpResponseRedirect
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import exceptions as api_exceptions
@@ -37,7 +39,11 @@ from ..models import (
     SourceImage,
     SourceImageCollection,
     SourceImageUpload,
+    SummaryStats,
     Taxon,
+    get_summary_stats_threshold,
+    get_taxa_occurrence_images,
+    prefetch_occurrence_details,
 )
 from .serializers import (
     ClassificationSerializer,
@@ -190,6 +196,19 @@ class EventViewSet(DefaultViewSet):
             duration=models.F("end") - models.F("start"),
         ).select_related("deployment", "project")
 
+        # Counts are read from the precalculated stats of each event when they exist
+        thresholds = {
+            get_summary_stats_threshold(None),
+            get_summary_stats_threshold(get_active_classification_threshold(self.request)),
+        }
+        qs = qs.prefetch_related(
+            Prefetch(
+                "summary_stats",
+                queryset=SummaryStats.objects.filter(threshold__in=thresholds - {None}),
+                to_attr="prefetched_summary_stats",
+            )
+        )
+
         return qs
 
 
@@ -249,6 +268,7 @@ class SourceImageViewSet(DefaultViewSet):
 
     serializer_class = SourceImageSerializer
     filterset_fields = ["event", "deployment", "deployment__project", "collections"]
+    keyset_ordering_fields = ["timestamp", "created_at"]
     ordering_fields = [
         "created_at",
         "updated_at",
@@ -281,6 +301,20 @@ class SourceImageViewSet(DefaultViewSet):
         else:
             raise api_exceptions.ValidationError(detail="Source image must be associated with a project")
 
+    @action(detail=True, methods=["get"], name="thumbnail")
+    def thumbnail(self, _request, pk=None) -> HttpResponseRedirect:
+        """
+        Redirect to the thumbnail of a source image.
+
+        Redirects to the original image if the thumbnail doesn't exist yet and queues a task to create it.
+        """
+        source_image: SourceImage = self.get_object()
+        if not source_image.thumbnail_path and cache.add(
+            f"source_image:{source_image.pk}:derivatives_queued", True, timeout=60 * 10
+        ):
+            tasks.create_image_derivatives.delay([source_image.pk])
+        return HttpResponseRedirect(source_image.thumbnail_url() or source_image.public_url())
+
     @action(detail=True, methods=["post"], name="unstar")
     def unstar(self, _request, pk=None) -> Response:
         """
@@ -409,6 +443,7 @@ class DetectionViewSet(DefaultViewSet):
     serializer_class = DetectionSerializer
     filterset_fields = ["source_image", "detection_algorithm"]
     ordering_fields = ["created_at", "updated_at", "detection_score", "timestamp"]
+    keyset_ordering_fields = ["timestamp", "created_at"]
 
     def get_serializer_class(self):
         """
@@ -455,6 +490,7 @@ class OccurrenceViewSet(DefaultViewSet):
         "detections_count",
         "created_at",
     ]
+    keyset_ordering_fields = ["determination_score", "first_appearance_timestamp", "created_at"]
 
     def get_serializer_class(self):
         """
@@ -465,25 +501,47 @@ class OccurrenceViewSet(DefaultViewSet):
         else:
             return OccurrenceSerializer
 
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None and self.action == "list":
+            # Load the related objects shown in the list for the whole page at once
+            page = prefetch_occurrence_details(list(page))
+        return page
+
+    def filter_by_taxon(self, queryset: QuerySet) -> QuerySet:
+        """
+        Filter occurrences by a taxon and all of the taxa below it, e.g. all occurrences in a family.
+        """
+        taxon_id = IntegerField(required=False).clean(self.request.query_params.get("taxon"))
+        if taxon_id:
+            taxon = Taxon.objects.filter(pk=taxon_id).first()
+            if not taxon:
+                raise api_exceptions.NotFound(detail=f"Taxon {taxon_id} not found")
+            if taxon.tree_path:
+                queryset = queryset.filter(determination__tree_path__startswith=taxon.tree_path)
+            else:
+                queryset = queryset.filter(determination_id__in=[taxon.pk, *taxon.descendant_ids_recursive()])
+        return queryset
+
     def get_queryset(self) -> QuerySet:
         qs = super().get_queryset()
         qs = qs.select_related(
-            "determination",
+            "determination__parent__parent",
             "deployment",
             "event",
         ).annotate(
-            detections_count=models.Count("detections", distinct=True),
-            duration=models.Max("detections__timestamp") - models.Min("detections__timestamp"),
-            first_appearance_timestamp=models.Min("detections__timestamp"),
-            first_appearance_time=models.Min("detections__timestamp__time"),
+            # Calculated from the detection fields stored on each occurrence, for ordering
+            duration=models.F("last_appearance_timestamp") - models.F("first_appearance_timestamp"),
+            first_appearance_time=models.F("first_appearance_timestamp__time"),
         )
+        qs = self.filter_by_taxon(qs)
         if self.action == "list":
             qs = (
                 qs.all()
-                .exclude(detections=None)
+                .filter(detections_count__gt=0)
                 .exclude(event=None)
                 .filter(determination_score__gte=get_active_classification_threshold(self.request))
-                .exclude(first_appearance_timestamp=None)  # This must come after annotations
+                .exclude(first_appearance_timestamp=None)
                 .order_by("-determination_score")
             )
         else:
@@ -565,6 +623,24 @@ class TaxonViewSet(DefaultViewSet):
         else:
             return TaxonSerializer
 
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None and self.action == "list":
+            # Load the occurrence images of all taxa on the page in one query
+            page = list(page)
+            self.occurrence_images = get_taxa_occurrence_images(
+                [taxon.pk for taxon in page],
+                project_id=self.request.query_params.get("project"),
+                classification_threshold=get_active_classification_threshold(self.request),
+            )
+        return page
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if getattr(self, "occurrence_images", None) is not None:
+            context["occurrence_images"] = self.occurrence_images
+        return context
+
     def filter_by_occurrence(self, queryset: QuerySet) -> tuple[QuerySet, bool]:
         """
         Filter taxa by when/where it has occurred.
@@ -632,18 +708,10 @@ class TaxonViewSet(DefaultViewSet):
 
         # @TODO this should check what the user has access to
         project_id = self.request.query_params.get("project")
-        taxon_occurrences_query = (
-            Occurrence.objects.filter(
-                determination_score__gte=get_active_classification_threshold(self.request),
-                event__isnull=False,
-            )
-            .distinct()
-            .annotate(
-                first_appearance_timestamp=models.Min("detections__timestamp"),
-                last_appearance_timestamp=models.Max("detections__timestamp"),
-            )
-            .order_by("-first_appearance_timestamp")
-        )
+        taxon_occurrences_query = Occurrence.objects.filter(
+            determination_score__gte=get_active_classification_threshold(self.request),
+            event__isnull=False,
+        ).order_by("-first_appearance_timestamp")
         taxon_occurrences_count_filter = models.Q(
             occurrences__determination_score__gte=get_active_classification_threshold(self.request),
             occurrences__event__isnull=False,
@@ -716,38 +784,70 @@ class SummaryView(GenericAPIView):
             data = {
                 "projects_count": Project.objects.count(),  # @TODO filter by current user, here and everywhere!
                 "deployments_count": Deployment.objects.filter(project=project).count(),
-                "events_count": Event.objects.filter(deployment__project=project, deployment__isnull=False).count(),
-                "captures_count": SourceImage.objects.filter(deployment__project=project).count(),
-                # "detections_count": Detection.objects.filter(occurrence__project=project).count(),
-                "occurrences_count": Occurrence.objects.filter(
-                    project=project,
-                    determination_score__gte=confidence_threshold,
-                    event__isnull=False,
-                ).count(),
-                "taxa_count": Taxon.objects.annotate(occurrences_count=models.Count("occurrences"))
-                .filter(
-                    occurrences_count__gt=0,
-                    occurrences__determination_score__gte=confidence_threshold,
-                    occurrences__project=project,
-                )
-                .distinct()
-                .count(),
             }
+            summary_stats = SummaryStats.get_for_scope(f"project:{project.pk}", confidence_threshold)
+            if summary_stats:
+                data.update(
+                    {
+                        "events_count": summary_stats.events_count,
+                        "captures_count": summary_stats.captures_count,
+                        "occurrences_count": summary_stats.occurrences_count,
+                        "taxa_count": summary_stats.taxa_count,
+                    }
+                )
+            else:
+                data.update(
+                    {
+                        "events_count": Event.objects.filter(
+                            deployment__project=project, deployment__isnull=False
+                        ).count(),
+                        "captures_count": SourceImage.objects.filter(deployment__project=project).count(),
+                        # "detections_count": Detection.objects.filter(occurrence__project=project).count(),
+                        "occurrences_count": Occurrence.objects.filter(
+                            project=project,
+                            determination_score__gte=confidence_threshold,
+                            event__isnull=False,
+                        ).count(),
+                        "taxa_count": Taxon.objects.annotate(occurrences_count=models.Count("occurrences"))
+                        .filter(
+                            occurrences_count__gt=0,
+                            occurrences__determination_score__gte=confidence_threshold,
+                            occurrences__project=project,
+                        )
+                        .distinct()
+                        .count(),
+                    }
+                )
         else:
             data = {
                 "projects_count": Project.objects.count(),
                 "deployments_count": Deployment.objects.count(),
-                "events_count": Event.objects.filter(deployment__isnull=False).count(),
-                "captures_count": SourceImage.objects.count(),
-                # "detections_count": Detection.objects.count(),
-                "occurrences_count": Occurrence.objects.filter(
-                    determination_score__gte=confidence_threshold, event__isnull=False
-                ).count(),
-                "taxa_count": Taxon.objects.annotate(occurrences_count=models.Count("occurrences"))
-                .filter(occurrences_count__gt=0, occurrences__determination_score__gte=confidence_threshold)
-                .count(),
-                "last_updated": timezone.now(),
             }
+            summary_stats = SummaryStats.get_for_scope("all", confidence_threshold)
+            if summary_stats:
+                data.update(
+                    {
+                        "events_count": summary_stats.events_count,
+                        "captures_count": summary_stats.captures_count,
+                        "occurrences_count": summary_stats.occurrences_count,
+                        "taxa_count": summary_stats.taxa_count,
+                    }
+                )
+            else:
+                data.update(
+                    {
+                        "events_count": Event.objects.filter(deployment__isnull=False).count(),
+                        "captures_count": SourceImage.objects.count(),
+                        # "detections_count": Detection.objects.count(),
+                        "occurrences_count": Occurrence.objects.filter(
+                            determination_score__gte=confidence_threshold, event__isnull=False
+                        ).count(),
+                        "taxa_count": Taxon.objects.annotate(occurrences_count=models.Count("occurrences"))
+                        .filter(occurrences_count__gt=0, occurrences__determination_score__gte=confidence_threshold)
+                        .count(),
+                    }
+                )
+            data["last_updated"] = summary_stats.updated_at if summary_stats else timezone.now()
 
         aliases = {
             "num_sessions": data["events_count"],
@@ -20,13 +20,65 @@ const EXAMPLE_PLOTS = [
 
 import datetime
 import itertools
+import time
+import typing
 
 from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 
 from ami.utils.dates import shift_to_nighttime
 
 
+def _data_version_key(scope: str) -> str:
+    return f"charts:version:{scope}"
+
+
+def get_data_version(scope: str) -> int:
+    """
+    Return the current version of the data in a scope, e.g. "project:1" or "deployment:1".
+    """
+    key = _data_version_key(scope)
+    version = cache.get(key)
+    if version is None:
+        # Start from the current time, so versions used before the key was evicted are never reused
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key, 0)
+    return version
+
+
+def bump_data_version(*scopes: str) -> None:
+    """
+    Invalidate the cached charts, and anything else cached by data version, of the given scopes.
+    """
+    for scope in scopes:
+        try:
+            cache.incr(_data_version_key(scope))
+        except ValueError:
+            cache.add(_data_version_key(scope), time.time_ns(), timeout=None)
+
+
+def cached_chart(chart: typing.Callable[..., dict], scope: str, **kwargs) -> dict:
+    """
+    Return the data for a chart, from the cache unless the data in its scope has changed.
+
+    >>> from unittest import mock
+    >>> chart = mock.Mock(__name__="chart", return_value={"title": "Test"})
+    >>> cached_chart(chart, "project:0", project_pk=0) == cached_chart(chart, "project:0", project_pk=0)
+    True
+    >>> chart.call_count
+    1
+    """
+    arguments = ",".join(f"{name}={value}" for name, value in sorted(kwargs.items()))
+    key = f"charts:{chart.__name__}:{arguments}:{get_data_version(scope)}"
+    data = cache.get(key)
+    if data is None:
+        data = chart(**kwargs)
+        cache.set(key, data, timeout=settings.CHART_CACHE_TIMEOUT)
+    return data
+
+
 def captures_per_hour(project_pk: int):
     # Captures per hour
     SourceImage = apps.get_model("main", "SourceImage")
@@ -0,0 +1,43 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError  # noqa
+
+from ami import tasks
+
+from ...models import SourceImage, create_image_derivatives
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    r"""Create the missing thumbnails of source images and crops of their detections."""
+
+    help = "Create the missing thumbnails of source images and crops of their detections"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, help="Only process the source images of this project")
+        parser.add_argument("--deployment", type=int, help="Only process the source images of this deployment")
+        parser.add_argument(
+            "--batch-size", type=int, default=1000, help="Number of source images to process in each batch"
+        )
+        parser.add_argument(
+            "--queue", action="store_true", help="Queue a background task for each batch instead of waiting"
+        )
+
+    def handle(self, *args, **options):
+        images = SourceImage.objects.all()
+        if options["project"]:
+            images = images.filter(project=options["project"])
+        if options["deployment"]:
+            images = images.filter(deployment=options["deployment"])
+        image_ids = list(images.order_by("pk").values_list("pk", flat=True))
+        batch_size = options["batch_size"]
+        num_created = 0
+        for i in range(0, len(image_ids), batch_size):
+            batch = image_ids[i : i + batch_size]  # noqa: E203
+            if options["queue"]:
+                tasks.create_image_derivatives.delay(batch)
+                self.stdout.write(f"Queued batch of {len(batch)} source images")
+            else:
+                num_created += create_image_derivatives(SourceImage.objects.filter(pk__in=batch))
+                self.stdout.write(f"Created derivatives of {num_created} source images")
@@ -274,6 +274,10 @@ class Command(BaseCommand):
             root_taxon_parent.parent = None
             root_taxon_parent.save()
 
+        # Taxa keep their tree paths up to date as they are saved, this catches anything that was missed
+        logger.info("Updating tree paths for all taxa")
+        Taxon.objects.update_tree_paths()
+
     def create_taxon(self, taxon_data: dict, root_taxon_parent: Taxon) -> tuple[set[Taxon], set[Taxon]]:
         taxa_in_row = []
         created_taxa = set()
@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError  # noqa
+
+from ...models import Deployment, refresh_rollup_summary_stats, refresh_summary_stats
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    r"""Recalculate the precalculated summary stats of deployments, events and projects."""
+
+    help = "Recalculate the precalculated summary stats of deployments, events and projects"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, help="Only refresh the deployments of this project")
+
+    def handle(self, *args, **options):
+        deployments = Deployment.objects.all()
+        if options["project"]:
+            deployments = deployments.filter(project=options["project"])
+        for deployment in deployments:
+            num_rows = refresh_summary_stats(deployment, rollup=False)
+            self.stdout.write(f"Refreshed {num_rows} summary stats for {deployment}")
+        # The projects and overall totals are added up from the deployments once, at the end
+        num_rows = refresh_rollup_summary_stats()
+        self.stdout.write(f"Refreshed {num_rows} summary stats for projects and overall totals")
@@ -0,0 +1,31 @@
+import logging
+
+from django.core.management.base import BaseCommand, CommandError  # noqa
+
+from ...models import Occurrence, update_occurrence_detection_fields
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    r"""Recalculate the fields that occurrences store about their detections."""
+
+    help = "Recalculate the fields that occurrences store about their detections"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--project", type=int, help="Only update the occurrences of this project")
+        parser.add_argument(
+            "--batch-size", type=int, default=10_000, help="Number of occurrences to update in each query"
+        )
+
+    def handle(self, *args, **options):
+        occurrences = Occurrence.objects.all()
+        if options["project"]:
+            occurrences = occurrences.filter(project=options["project"])
+        occurrence_ids = list(occurrences.order_by("pk").values_list("pk", flat=True))
+        batch_size = options["batch_size"]
+        num_updated = 0
+        for i in range(0, len(occurrence_ids), batch_size):
+            batch = occurrence_ids[i : i + batch_size]  # noqa: E203
+            num_updated += update_occurrence_detection_fields(Occurrence.objects.filter(pk__in=batch))
+            self.stdout.write(f"Updated {num_updated} of {len(occurrence_ids)} occurrences")
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0030_identification_comment"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="deployment",
+            name="data_source_watermarks",
+            field=models.JSONField(
+                blank=True,
+                default=dict,
+                help_text="The last key listed under each prefix of the data source, used for incremental syncs",
+            ),
+        ),
+    ]
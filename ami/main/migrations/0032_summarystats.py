@@ -0,0 +1,64 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0031_deployment_data_source_watermarks"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SummaryStats",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "scope",
+                    models.CharField(help_text='e.g. "event:1", "deployment:1", "project:1" or "all"', max_length=255),
+                ),
+                ("threshold", models.FloatField()),
+                ("events_count", models.IntegerField(default=0)),
+                ("captures_count", models.IntegerField(default=0)),
+                ("detections_count", models.IntegerField(default=0)),
+                ("detections_max_count", models.IntegerField(null=True)),
+                ("detections_min_count", models.IntegerField(null=True)),
+                ("occurrences_count", models.IntegerField(default=0)),
+                ("taxa_count", models.IntegerField(default=0)),
+                (
+                    "deployment",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="summary_stats",
+                        to="main.deployment",
+                    ),
+                ),
+                (
+                    "event",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="summary_stats",
+                        to="main.event",
+                    ),
+                ),
+                (
+                    "project",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="summary_stats",
+                        to="main.project",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="summarystats",
+            constraint=models.UniqueConstraint(fields=("scope", "threshold"), name="unique_summary_stats"),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0032_summarystats"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="detection",
+            index=models.Index(fields=["timestamp", "id"], name="main_detect_timesta_6a6493_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="occurrence",
+            index=models.Index(fields=["determination_score", "id"], name="main_occurr_determi_0918ad_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="sourceimage",
+            index=models.Index(fields=["event", "timestamp", "id"], name="main_source_event_i_282686_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="sourceimage",
+            index=models.Index(fields=["timestamp", "id"], name="main_source_timesta_a9bada_idx"),
+        ),
+        # Replaced by the indexes above, which also include the id
+        migrations.RemoveIndex(
+            model_name="sourceimage",
+            name="main_source_event_i_ab7d5d_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="sourceimage",
+            name="main_source_timesta_979028_idx",
+        ),
+    ]
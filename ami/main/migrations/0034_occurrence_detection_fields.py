@@ -0,0 +1,56 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0033_keyset_pagination_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="occurrence",
+            name="best_classification",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="main.classification",
+            ),
+        ),
+        migrations.AddField(
+            model_name="occurrence",
+            name="best_detection",
+            field=models.ForeignKey(
+                blank=True,
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="main.detection",
+            ),
+        ),
+        migrations.AddField(
+            model_name="occurrence",
+            name="detections_count",
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="occurrence",
+            name="first_appearance_timestamp",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="occurrence",
+            name="last_appearance_timestamp",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="occurrence",
+            index=models.Index(fields=["first_appearance_timestamp", "id"], name="main_occurr_first_a_216623_idx"),
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+# Fill in the detection fields of all occurrences with bulk update queries
+# (the same as `update_occurrence_detection_fields` at the time of this migration)
+def update_occurrence_detection_fields(apps, schema_editor):
+    Occurrence = apps.get_model("main", "Occurrence")
+    Detection = apps.get_model("main", "Detection")
+    Classification = apps.get_model("main", "Classification")
+
+    detections = Detection.objects.filter(occurrence_id=models.OuterRef("pk"))
+    detection_aggregates = detections.order_by().values("occurrence_id")
+    classifications = Classification.objects.filter(detection__occurrence_id=models.OuterRef("pk"))
+    max_scores_per_algorithm = (
+        Classification.objects.filter(detection__occurrence_id=models.OuterRef(models.OuterRef("pk")))
+        .values("algorithm")
+        .annotate(max_score=models.Max("score"))
+        .values("max_score")
+    )
+    Occurrence.objects.update(
+        first_appearance_timestamp=models.Subquery(
+            detection_aggregates.annotate(first=models.Min("timestamp")).values("first")
+        ),
+        last_appearance_timestamp=models.Subquery(
+            detection_aggregates.annotate(last=models.Max("timestamp")).values("last")
+        ),
+        detections_count=Coalesce(
+            models.Subquery(detection_aggregates.annotate(count=models.Count("id")).values("count")), 0
+        ),
+        best_detection=Coalesce(
+            models.Subquery(classifications.order_by("-score", "pk").values("detection_id")[:1]),
+            models.Subquery(detections.order_by("frame_num", "timestamp", "pk").values("pk")[:1]),
+        ),
+        best_classification=models.Subquery(
+            classifications.filter(score__in=models.Subquery(max_scores_per_algorithm))
+            .order_by("-created_at", "-pk")
+            .values("pk")[:1]
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0034_occurrence_detection_fields"),
+    ]
+
+    operations = [
+        migrations.RunPython(update_occurrence_detection_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0035_update_occurrence_detection_fields"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="taxon",
+            name="tree_path",
+            field=models.CharField(blank=True, default="", editable=False, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="taxon",
+            index=models.Index(
+                fields=["tree_path"], name="main_taxon_tree_path_idx", opclasses=["varchar_pattern_ops"]
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations
+
+
+# A frozen copy of `build_tree_paths` from `ami.main.models` at the time of this migration. It is copied here on
+# purpose rather than imported, so that later changes to the app code can't change what this migration does.
+def build_tree_paths(parent_ids):
+    paths = {}
+    for taxon_id in parent_ids:
+        lineage = [taxon_id]
+        parent_id = parent_ids[taxon_id]
+        while parent_id is not None and parent_id in parent_ids and parent_id not in paths:
+            if parent_id in lineage:
+                parent_id = None
+                break
+            lineage.append(parent_id)
+            parent_id = parent_ids[parent_id]
+        prefix = paths.get(parent_id, "") if parent_id is not None else ""
+        for ancestor_id in reversed(lineage):
+            if ancestor_id not in paths:
+                prefix = paths[ancestor_id] = f"{prefix}{ancestor_id}/"
+            else:
+                prefix = paths[ancestor_id]
+    return paths
+
+
+# Fill in the tree paths of all taxa by following their parents in memory
+def update_taxon_tree_paths(apps, schema_editor):
+    Taxon = apps.get_model("main", "Taxon")
+
+    paths = build_tree_paths(dict(Taxon.objects.values_list("pk", "parent_id")))
+    taxa = [Taxon(pk=taxon_id, tree_path=tree_path) for taxon_id, tree_path in paths.items()]
+    Taxon.objects.bulk_update(taxa, ["tree_path"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0036_taxon_tree_path"),
+    ]
+
+    operations = [
+        migrations.RunPython(update_taxon_tree_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.10 on 2026-10-16 21:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0037_update_taxon_tree_paths"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="sourceimage",
+            name="thumbnail_path",
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+    ]
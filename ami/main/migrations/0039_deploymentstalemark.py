@@ -0,0 +1,33 @@
+# Generated by Django 4.2.10 on 2026-10-16 22:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0038_sourceimage_thumbnail_path"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeploymentStaleMark",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("aggregate", models.CharField(max_length=255)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "deployment",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name="stale_marks", to="main.deployment"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="deploymentstalemark",
+            constraint=models.UniqueConstraint(
+                fields=("deployment", "aggregate"), name="unique_deployment_stale_mark"
+            ),
+        ),
+    ]
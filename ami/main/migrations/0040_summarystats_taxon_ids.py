@@ -0,0 +1,21 @@
+# Generated by Django 4.2.10 on 2026-10-16 22:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0039_deploymentstalemark"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="summarystats",
+            name="taxon_ids",
+            field=models.JSONField(
+                blank=True,
+                help_text="The taxa of a deployment, so the taxa of a project can be counted without scanning its occurrences",
+                null=True,
+            ),
+        ),
+    ]
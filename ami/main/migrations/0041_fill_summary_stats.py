@@ -0,0 +1,160 @@
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Fill in the summary stats of every deployment, project and the overall totals, so the rollup that runs
+# after a deployment recompute starts from complete deployment rows. The stats of events are filled in by
+# the next recompute of their deployment. The queries are frozen copies of `refresh_summary_stats` and
+# `refresh_rollup_summary_stats` at the time of this migration, with one grouped query for all deployments.
+def fill_summary_stats(apps, schema_editor):
+    Deployment = apps.get_model("main", "Deployment")
+    Event = apps.get_model("main", "Event")
+    Occurrence = apps.get_model("main", "Occurrence")
+    SourceImage = apps.get_model("main", "SourceImage")
+    SummaryStats = apps.get_model("main", "SummaryStats")
+
+    thresholds = sorted({round(i / 10, 1) for i in range(10)} | {settings.DEFAULT_CONFIDENCE_THRESHOLD})
+
+    captures = {
+        row["deployment_id"]: row
+        for row in SourceImage.objects.filter(deployment__isnull=False)
+        .order_by()
+        .values("deployment_id")
+        .annotate(
+            num_captures=models.Count("pk"),
+            num_detections=models.Sum("detections_count"),
+            max_detections=models.Max("detections_count"),
+            min_detections=models.Min("detections_count"),
+        )
+    }
+    events = dict(
+        Event.objects.filter(deployment__isnull=False)
+        .order_by()
+        .values("deployment_id")
+        .annotate(num_events=models.Count("pk"))
+        .values_list("deployment_id", "num_events")
+    )
+    max_scores = {}
+    for deployment_id, taxon_id, max_score in (
+        Occurrence.objects.filter(deployment__isnull=False, event__isnull=False)
+        .exclude(determination=None)
+        .order_by()
+        .values("deployment_id", "determination_id")
+        .annotate(max_score=models.Max("determination_score"))
+        .values_list("deployment_id", "determination_id", "max_score")
+    ):
+        if max_score is not None:
+            max_scores.setdefault(deployment_id, {})[taxon_id] = max_score
+    occurrences = {
+        row["deployment_id"]: row
+        for row in Occurrence.objects.filter(deployment__isnull=False, event__isnull=False)
+        .order_by()
+        .values("deployment_id")
+        .annotate(
+            **{
+                f"occurrences_{i}": models.Count("pk", filter=models.Q(determination_score__gte=threshold))
+                for i, threshold in enumerate(thresholds)
+            }
+        )
+    }
+
+    rows = []
+    totals = {}
+    for deployment_id, project_id in Deployment.objects.values_list("pk", "project_id"):
+        deployment_captures = captures.get(deployment_id, {})
+        for i, threshold in enumerate(thresholds):
+            taxon_ids = sorted(
+                taxon_id for taxon_id, score in max_scores.get(deployment_id, {}).items() if score >= threshold
+            )
+            counts = {
+                "events_count": events.get(deployment_id, 0),
+                "captures_count": deployment_captures.get("num_captures") or 0,
+                "detections_count": deployment_captures.get("num_detections") or 0,
+                "detections_max_count": deployment_captures.get("max_detections"),
+                "detections_min_count": deployment_captures.get("min_detections"),
+                "occurrences_count": occurrences.get(deployment_id, {}).get(f"occurrences_{i}") or 0,
+            }
+            rows.append(
+                SummaryStats(
+                    scope=f"deployment:{deployment_id}",
+                    threshold=threshold,
+                    deployment_id=deployment_id,
+                    project_id=project_id,
+                    taxa_count=len(taxon_ids),
+                    taxon_ids=taxon_ids,
+                    **counts,
+                )
+            )
+            for key in [(project_id, threshold), (None, threshold)] if project_id else [(None, threshold)]:
+                total = totals.setdefault(
+                    key,
+                    {
+                        "events_count": 0,
+                        "captures_count": 0,
+                        "detections_count": 0,
+                        "detections_max_count": None,
+                        "detections_min_count": None,
+                        "occurrences_count": 0,
+                        "taxon_ids": set(),
+                    },
+                )
+                for field in ["events_count", "captures_count", "detections_count", "occurrences_count"]:
+                    total[field] += counts[field]
+                if counts["detections_max_count"] is not None:
+                    total["detections_max_count"] = max(
+                        total["detections_max_count"] or 0, counts["detections_max_count"]
+                    )
+                if counts["detections_min_count"] is not None:
+                    current = total["detections_min_count"]
+                    total["detections_min_count"] = (
+                        counts["detections_min_count"]
+                        if current is None
+                        else min(current, counts["detections_min_count"])
+                    )
+                total["taxon_ids"].update(taxon_ids)
+
+    project_ids = set(apps.get_model("main", "Project").objects.values_list("pk", flat=True))
+    for project_id in [*project_ids, None]:
+        for threshold in thresholds:
+            total = dict(totals.get((project_id, threshold)) or {"taxon_ids": set()})
+            taxon_ids = total.pop("taxon_ids")
+            rows.append(
+                SummaryStats(
+                    scope=f"project:{project_id}" if project_id else "all",
+                    threshold=threshold,
+                    project_id=project_id,
+                    taxa_count=len(taxon_ids),
+                    **total,
+                )
+            )
+
+    SummaryStats.objects.bulk_create(
+        rows,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["scope", "threshold"],
+        update_fields=[
+            "events_count",
+            "captures_count",
+            "detections_count",
+            "detections_max_count",
+            "detections_min_count",
+            "occurrences_count",
+            "taxa_count",
+            "taxon_ids",
+            "project",
+            "deployment",
+            "event",
+            "updated_at",
+        ],
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("main", "0040_summarystats_taxon_ids"),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_summary_stats, migrations.RunPython.noop),
+    ]
@@ -11,11 +11,13 @@ from typing import Final, final  # noqa: F401
 
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError, models
+from django.db import IntegrityError, models, transaction
 from django.db.models import Q
 from django.db.models.fields.files import ImageFieldFile
-from django.db.models.signals import pre_delete
+from django.db.models.functions import Coalesce, Concat, RowNumber, Substr
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 
 import ami.tasks
@@ -125,12 +127,14 @@ class Project(BaseModel):
 
         plots = []
 
-        plots.append(charts.captures_per_hour(project_pk=self.pk))
+        # Charts are cached until the data of the project changes
+        scope = f"project:{self.pk}"
+        plots.append(charts.cached_chart(charts.captures_per_hour, scope, project_pk=self.pk))
         if self.occurrences.exists():
-            plots.append(charts.detections_per_hour(project_pk=self.pk))
-            plots.append(charts.occurrences_accumulated(project_pk=self.pk))
+            plots.append(charts.cached_chart(charts.detections_per_hour, scope, project_pk=self.pk))
+            plots.append(charts.cached_chart(charts.occurrences_accumulated, scope, project_pk=self.pk))
         else:
-            plots.append(charts.events_per_month(project_pk=self.pk))
+            plots.append(charts.cached_chart(charts.events_per_month, scope, project_pk=self.pk))
             # plots.append(charts.captures_per_month(project_pk=self.pk))
 
         return plots
@@ -221,23 +225,57 @@ class DeploymentManager(models.Manager):
         )
 
 
-def _create_source_image_for_sync(
+def _create_source_images_for_sync(
     deployment: "Deployment",
-    obj: ami.utils.s3.ObjectTypeDef,
-) -> typing.Union["SourceImage", None]:
-    assert "Key" in obj, f"File in object store response has no Key: {obj}"
+    objects: list[ami.utils.s3.ObjectTypeDef],
+    timestamp_parser: ami.utils.dates.FilenameTimestampParser,
+    timestamp_counts: collections.Counter,
+    max_workers: int = 8,
+) -> list["SourceImage"]:
+    """
+    Prepare a batch of source images from the files listed in a deployment's data source.
 
-    source_image = SourceImage(
-        deployment=deployment,
-        path=obj["Key"],
-        last_modified=obj.get("LastModified"),
-        size=obj.get("Size"),
-        checksum=obj.get("ETag", "").strip('"'),
-        checksum_algorithm=obj.get("ChecksumAlgorithm"),
-    )
-    logger.debug(f"Preparing to create or update SourceImage {source_image.path}")
-    source_image.update_calculated_fields()
-    return source_image
+    The timestamps are parsed from the filenames with the patterns learned by the parser for the deployment.
+    For new files without a timestamp in their name, the EXIF data is read instead, for several files at once.
+    The number of timestamps found in filenames & EXIF data, and of new files without one, are added to
+    `timestamp_counts` instead of logging every file.
+    """
+    for obj in objects:
+        assert "Key" in obj, f"File in object store response has no Key: {obj}"
+    timestamps = timestamp_parser.parse_many(obj["Key"] for obj in objects)
+    unparsed_keys = [key for key, timestamp in timestamps.items() if not timestamp]
+    timestamp_counts["filename"] += len(timestamps) - len(unparsed_keys)
+
+    if unparsed_keys and deployment.data_source:
+        # Only for new files, since the timestamps of existing source images are not updated by the sync
+        existing_keys = set(
+            SourceImage.objects.filter(deployment=deployment, path__in=unparsed_keys).values_list("path", flat=True)
+        )
+        new_keys = [key for key in unparsed_keys if key not in existing_keys]
+        if new_keys:
+            exif_timestamps = ami.utils.s3.read_exif_timestamps(
+                deployment.data_source.config, new_keys, max_workers=max_workers
+            )
+            timestamps.update(exif_timestamps)
+            num_exif = sum(1 for timestamp in exif_timestamps.values() if timestamp)
+            timestamp_counts["exif"] += num_exif
+            timestamp_counts["unparsed"] += len(new_keys) - num_exif
+
+    source_images = []
+    for obj in objects:
+        source_image = SourceImage(
+            deployment=deployment,
+            project=deployment.project,
+            path=obj["Key"],
+            timestamp=timestamps[obj["Key"]],
+            last_modified=obj.get("LastModified"),
+            size=obj.get("Size"),
+            checksum=obj.get("ETag", "").strip('"'),
+            checksum_algorithm=obj.get("ChecksumAlgorithm"),
+        )
+        source_image.public_base_url = source_image.get_base_url()
+        source_images.append(source_image)
+    return source_images
 
 
 def _insert_or_update_batch_for_sync(
@@ -247,8 +285,17 @@ def _insert_or_update_batch_for_sync(
     total_size: int,
     sql_batch_size=500,
     regroup_events_per_batch=False,
-):
+) -> list[str]:
+    """
+    Insert the new source images of a batch and update the existing ones, returning the paths of the new ones.
+    """
     logger.info(f"Bulk inserting or updating batch of {len(source_images)} SourceImages")
+    existing_paths = set(
+        SourceImage.objects.filter(
+            deployment=deployment, path__in=[source_image.path for source_image in source_images]
+        ).values_list("path", flat=True)
+    )
+    new_paths = [source_image.path for source_image in source_images if source_image.path not in existing_paths]
     try:
         SourceImage.objects.bulk_create(
             source_images,
@@ -259,6 +306,7 @@ def _insert_or_update_batch_for_sync(
         )
     except IntegrityError as e:
         logger.error(f"Error bulk inserting batch of SourceImages: {e}")
+        new_paths = []
 
     if total_files > (deployment.data_source_total_files or 0):
         deployment.data_source_total_files = total_files
@@ -270,6 +318,7 @@ def _insert_or_update_batch_for_sync(
         group_images_into_events(deployment)
 
     deployment.save(update_calculated_fields=False)
+    return new_paths
 
 
 def _compare_totals_for_sync(deployment: "Deployment", total_files_found: int):
@@ -284,6 +333,167 @@ def _compare_totals_for_sync(deployment: "Deployment", total_files_found: int):
         )
 
 
+# Calculated fields of a deployment, in groups that can be marked as stale and recomputed independently
+DEPLOYMENT_AGGREGATES: dict[str, list[str]] = {
+    "captures": [
+        "data_source_total_files",
+        "data_source_total_size",
+        "captures_count",
+        "first_capture_timestamp",
+        "last_capture_timestamp",
+    ],
+    "events": ["events_count"],
+    "detections": ["detections_count"],
+    "occurrences": ["occurrences_count", "taxa_count"],
+}
+
+
+# A stale mark that asks for the charts of a deployment to be regenerated after its recompute
+WARM_CHARTS_MARK = "warm_charts"
+
+
+def _deployment_recompute_key(deployment_id: int) -> str:
+    return f"deployment:{deployment_id}:recompute_scheduled"
+
+
+class _OnCommitBatch:
+    """
+    Collect work from many rows within a transaction, and handle all of it in one callback once it commits.
+
+    The pending batch is kept on the database connection until it is flushed. Each addition registers
+    a callback with `transaction.on_commit` and the first one to run flushes the whole batch, so the batch
+    is still flushed when the callbacks of a rolled back savepoint are dropped. Outside of a transaction
+    the callback runs straight away. Work added in a transaction that was rolled back is flushed along with
+    the next batch, which only repeats a recalculation.
+    """
+
+    def __init__(self, new: typing.Callable[[], typing.Any], flush: typing.Callable[[typing.Any], None]):
+        self._new = new
+        self._flush = flush
+
+    def _pending(self) -> dict["_OnCommitBatch", typing.Any]:
+        # Connections are not shared between threads, so neither are the batches kept on them
+        return transaction.get_connection().__dict__.setdefault("_on_commit_batches", {})
+
+    def add(self, update: typing.Callable[[typing.Any], None]) -> None:
+        pending = self._pending()
+        if self not in pending:
+            pending[self] = self._new()
+        batch = pending[self]
+        update(batch)
+        transaction.on_commit(functools.partial(self._run, batch), robust=True)
+
+    def _run(self, batch) -> None:
+        pending = self._pending()
+        if pending.get(self) is not batch:
+            # Already flushed by an earlier callback
+            return
+        del pending[self]
+        self._flush(batch)
+
+
+def mark_deployment_stale(
+    deployment_ids: int | None | typing.Iterable[int | None], *aggregates: str, warm_charts: bool = False
+) -> None:
+    """
+    Mark calculated fields of deployments as out of date and schedule a background task to recompute them.
+
+    The marks made within a transaction are collected and saved to the database in one query once it commits.
+    Marks are coalesced: a single recompute is scheduled per deployment within the debounce period,
+    and it only updates the aggregates that were marked. All aggregates are marked if none are given.
+    Cached charts are invalidated by the recompute, and regenerated afterwards if `warm_charts` is set.
+
+    The debounce uses the Django cache. With a cache that isn't shared between processes (e.g. LocMemCache),
+    each process schedules its own recompute, and the ones that run after the marks were handled do nothing.
+    """
+    aggregates = aggregates or tuple(DEPLOYMENT_AGGREGATES)
+    if warm_charts:
+        aggregates = (*aggregates, WARM_CHARTS_MARK)
+    if deployment_ids is None or isinstance(deployment_ids, int):
+        deployment_ids = [deployment_ids]
+    deployment_ids = list(filter(None, deployment_ids))
+
+    def update(marks: tuple[dict[int, set[str]], dict[int, set[str]]]):
+        for deployment_id in deployment_ids:
+            marks[0][deployment_id].update(aggregates)
+
+    _stale_marks.add(update)
+
+
+def mark_source_images_stale(source_image_ids: typing.Iterable[int | None], *aggregates: str) -> None:
+    """
+    Mark calculated fields of the deployments of these source images as out of date.
+
+    The deployments are looked up once the transaction commits, with a single query for all of the marks.
+    """
+    source_image_ids = list(filter(None, source_image_ids))
+    aggregates = aggregates or tuple(DEPLOYMENT_AGGREGATES)
+
+    def update(marks: tuple[dict[int, set[str]], dict[int, set[str]]]):
+        for source_image_id in source_image_ids:
+            marks[1][source_image_id].update(aggregates)
+
+    _stale_marks.add(update)
+
+
+def _flush_stale_marks(marks: tuple[dict[int, set[str]], dict[int, set[str]]]) -> None:
+    deployment_marks, source_image_marks = marks
+    if source_image_marks:
+        for source_image_id, deployment_id in SourceImage.objects.filter(
+            pk__in=source_image_marks, deployment__isnull=False
+        ).values_list("pk", "deployment_id"):
+            deployment_marks[deployment_id].update(source_image_marks[source_image_id])
+    # Skip deployments that were deleted in the meantime
+    deployment_ids = list(Deployment.objects.filter(pk__in=deployment_marks).values_list("pk", flat=True))
+    DeploymentStaleMark.objects.bulk_create(
+        [
+            DeploymentStaleMark(deployment_id=deployment_id, aggregate=aggregate)
+            for deployment_id in deployment_ids
+            for aggregate in deployment_marks[deployment_id]
+        ],
+        ignore_conflicts=True,
+    )
+    countdown = settings.DEPLOYMENT_RECOMPUTE_DEBOUNCE_SECONDS
+    for deployment_id in deployment_ids:
+        if cache.add(_deployment_recompute_key(deployment_id), True, timeout=countdown * 2 + 60):
+            ami.tasks.update_deployment_calculated_fields.apply_async((deployment_id,), countdown=countdown)
+
+
+_stale_marks = _OnCommitBatch(
+    new=lambda: (collections.defaultdict(set), collections.defaultdict(set)),
+    flush=_flush_stale_marks,
+)
+
+
+def _pop_stale_marks(deployment_id: int, aggregates: typing.Iterable[str]) -> set[str]:
+    marks = list(
+        DeploymentStaleMark.objects.filter(deployment_id=deployment_id, aggregate__in=aggregates).values_list(
+            "pk", "aggregate"
+        )
+    )
+    # Only the marks that were read are deleted, newer ones are left for the next recompute
+    DeploymentStaleMark.objects.filter(pk__in=[pk for pk, _ in marks]).delete()
+    return {aggregate for _, aggregate in marks}
+
+
+def pop_deployment_warm_charts(deployment_id: int) -> bool:
+    """
+    Return whether the charts of a deployment should be regenerated after its recompute, and clear the request.
+    """
+    return bool(_pop_stale_marks(deployment_id, [WARM_CHARTS_MARK]))
+
+
+def pop_stale_deployment_aggregates(deployment_id: int) -> list[str]:
+    """
+    Return the aggregates of a deployment that were marked as stale, and clear the marks.
+
+    Marks made after this call schedule a new recompute.
+    """
+    cache.delete(_deployment_recompute_key(deployment_id))
+    stale = _pop_stale_marks(deployment_id, DEPLOYMENT_AGGREGATES)
+    return [aggregate for aggregate in DEPLOYMENT_AGGREGATES if aggregate in stale]
+
+
 @final
 class Deployment(BaseModel):
     """
@@ -309,6 +519,11 @@ class Deployment(BaseModel):
     data_source_subdir = models.CharField(max_length=255, blank=True, null=True)
     data_source_regex = models.CharField(max_length=255, blank=True, null=True)
     data_source_last_checked = models.DateTimeField(blank=True, null=True)
+    data_source_watermarks = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="The last key listed under each prefix of the data source, used for incremental syncs",
+    )
     # data_source_start_date = models.DateTimeField(blank=True, null=True)
     # data_source_end_date = models.DateTimeField(blank=True, null=True)
     # data_source_last_check_duration = models.DurationField(blank=True, null=True)
@@ -390,8 +605,24 @@ class Deployment(BaseModel):
             uri = None
         return uri
 
-    def sync_captures(self, batch_size=1000, regroup_events_per_batch=False) -> int:
-        """Import images from the deployment's data source"""
+    def sync_captures(
+        self,
+        batch_size=1000,
+        regroup_events_per_batch=False,
+        max_workers: int | None = None,
+        incremental: bool = False,
+    ) -> int:
+        """
+        Import images from the deployment's data source
+
+        With more than one worker, each top level folder of the data source (e.g. one per night)
+        is listed in parallel and progress is logged as each folder is completed.
+
+        The last key listed under each folder is saved as a watermark. An incremental sync
+        only lists keys after the watermarks and skips folders that were completely listed before,
+        then regroups events only for the time range of the new captures.
+        The watermarks are reset when the data source, subdir or regex is changed.
+        """
 
         deployment = self
         assert deployment.data_source, f"Deployment {deployment.name} has no data source configured"
@@ -399,37 +630,110 @@ class Deployment(BaseModel):
         s3_config = deployment.data_source.config
         total_size = 0
         total_files = 0
-        source_images = []
+        batch: list[ami.utils.s3.ObjectTypeDef] = []
         django_batch_size = batch_size
         sql_batch_size = 1000
+        max_workers = max_workers or settings.S3_SYNC_MAX_WORKERS
+        # The filename patterns are learned once for the whole deployment
+        timestamp_parser = ami.utils.dates.FilenameTimestampParser()
+        timestamp_counts: collections.Counter = collections.Counter()
+        unparsed_examples: list[str] = []
+        previous_watermarks = self.data_source_watermarks if incremental else {}
+        watermarks = {}
+        first_timestamp, last_timestamp = None, None
+        num_new_files = 0
+
+        def update_watermark(progress: ami.utils.s3.PrefixListed):
+            if progress.last_key:
+                watermarks[progress.prefix] = progress.last_key
+
+        if max_workers > 1:
+            objects = ami.utils.s3.list_files_concurrently(
+                s3_config,
+                subdir=self.data_source_subdir,
+                regex_filter=self.data_source_regex,
+                max_workers=max_workers,
+                on_prefix_listed=update_watermark,
+                watermarks=previous_watermarks,
+            )
+        else:
+            # Keys are listed in order, so a single listing can start after the oldest watermark.
+            # Starting after the newest one would skip new keys under any prefix that lags behind it.
+            base_prefix = ami.utils.s3.list_prefix_key(s3_config, self.data_source_subdir)
+            objects = ami.utils.s3.list_files_paginated(
+                s3_config,
+                subdir=self.data_source_subdir,
+                regex_filter=self.data_source_regex,
+                start_after=min(previous_watermarks.values(), default=None),
+            )
 
-        for obj in ami.utils.s3.list_files_paginated(
-            s3_config,
-            subdir=self.data_source_subdir,
-            regex_filter=self.data_source_regex,
-        ):
-            source_image = _create_source_image_for_sync(deployment, obj)
-            if source_image:
-                total_files += 1
-                total_size += obj.get("Size", 0)
-                source_images.append(source_image)
-
-            if len(source_images) >= django_batch_size:
-                _insert_or_update_batch_for_sync(
-                    deployment, source_images, total_files, total_size, sql_batch_size, regroup_events_per_batch
-                )
-                source_images = []
-
-        if source_images:
-            # Insert/update the last batch
-            _insert_or_update_batch_for_sync(
+        def save_batch(batch_objects: list[ami.utils.s3.ObjectTypeDef]):
+            nonlocal first_timestamp, last_timestamp, num_new_files
+            source_images = _create_source_images_for_sync(
+                deployment, batch_objects, timestamp_parser, timestamp_counts, max_workers=max_workers
+            )
+            for source_image in source_images:
+                if source_image.timestamp:
+                    first_timestamp = min(first_timestamp or source_image.timestamp, source_image.timestamp)
+                    last_timestamp = max(last_timestamp or source_image.timestamp, source_image.timestamp)
+                elif len(unparsed_examples) < 5:
+                    unparsed_examples.append(source_image.path)
+            new_paths = _insert_or_update_batch_for_sync(
                 deployment, source_images, total_files, total_size, sql_batch_size, regroup_events_per_batch
             )
+            num_new_files += len(new_paths)
+            if new_paths:
+                # Thumbnails are created in the background, the original images are shown until then
+                queue_image_derivatives(deployment.captures.filter(path__in=new_paths))
+
+        for obj in objects:
+            total_files += 1
+            total_size += obj.get("Size", 0)
+            batch.append(obj)
+            if max_workers <= 1:
+                watermarks[base_prefix] = max(watermarks.get(base_prefix, ""), obj.get("Key", ""))
+
+            if len(batch) >= django_batch_size:
+                save_batch(batch)
+                batch = []
+
+        if batch:
+            # Insert/update the last batch
+            save_batch(batch)
+
+        logger.info(
+            f"Found timestamps for {timestamp_counts['filename']} files in their names "
+            f"and {timestamp_counts['exif']} files in their EXIF data"
+        )
+        if timestamp_counts["unparsed"]:
+            logger.warning(
+                f"Could not find timestamps for {timestamp_counts['unparsed']} new files. "
+                f"Some of the files without a timestamp: {', '.join(unparsed_examples)}"
+            )
 
-        _compare_totals_for_sync(deployment, total_files)
+        # Only save the watermarks once everything that was listed has been saved
+        if max_workers > 1:
+            self.data_source_watermarks = {**previous_watermarks, **watermarks}
+        else:
+            # Everything after the oldest watermark was listed, so the last key replaces all of them
+            last_key = max([*previous_watermarks.values(), *watermarks.values()], default=None)
+            self.data_source_watermarks = {base_prefix: last_key} if last_key else {}
 
-        # @TODO decide if we should delete SourceImages that are no longer in the data source
-        self.save()
+        self.save(update_calculated_fields=False, update_fields=["data_source_watermarks"])
+
+        if not incremental:
+            _compare_totals_for_sync(deployment, total_files)
+            # @TODO decide if we should delete SourceImages that are no longer in the data source
+            ami.tasks.regroup_events.delay(self.pk)
+        else:
+            logger.info(f"Found {num_new_files} new files for deployment {deployment} since the last sync")
+            if first_timestamp and last_timestamp:
+                ami.tasks.regroup_events.delay(
+                    self.pk, start=first_timestamp.isoformat(), end=last_timestamp.isoformat()
+                )
+        # Update the capture counts, summary stats and charts in the background,
+        # the captures were bulk inserted without signals
+        mark_deployment_stale(self.pk, "captures", warm_charts=True)
 
         return total_files
 
@@ -457,48 +761,105 @@ class Deployment(BaseModel):
                 )
             model.objects.filter(deployment=self).exclude(project=self.project).update(project=self.project)
 
-    def update_calculated_fields(self, save=False):
-        """Update calculated fields on the deployment."""
-
-        self.data_source_total_files = self.captures.count()
-        self.data_source_total_size = self.captures.aggregate(total_size=models.Sum("size")).get("total_size")
-
-        self.events_count = self.events.count()
-        self.captures_count = self.data_source_total_files or self.captures.count()
-        self.detections_count = Detection.objects.filter(Q(source_image__deployment=self)).count()
-        self.occurrences_count = (
-            self.occurrences.filter(
-                determination_score__gte=settings.DEFAULT_CONFIDENCE_THRESHOLD,
-                event__isnull=False,
+    def update_calculated_fields(self, save=False, only: typing.Iterable[str] | None = None):
+        """
+        Update calculated fields on the deployment.
+
+        Pass the names of groups in `DEPLOYMENT_AGGREGATES` as `only` to update just those fields.
+        """
+        aggregates = set(only) if only is not None else set(DEPLOYMENT_AGGREGATES)
+
+        if "captures" in aggregates:
+            captures = self.captures.aggregate(count=models.Count("pk"), total_size=models.Sum("size"))
+            self.data_source_total_files = captures["count"]
+            self.data_source_total_size = captures["total_size"]
+            self.captures_count = captures["count"]
+            self.first_capture_timestamp, self.last_capture_timestamp = self.get_first_and_last_timestamps()
+
+        if "events" in aggregates:
+            self.events_count = self.events.count()
+
+        if "detections" in aggregates:
+            self.detections_count = Detection.objects.filter(Q(source_image__deployment=self)).count()
+
+        if "occurrences" in aggregates:
+            self.occurrences_count = (
+                self.occurrences.filter(
+                    determination_score__gte=settings.DEFAULT_CONFIDENCE_THRESHOLD,
+                    event__isnull=False,
+                )
+                .distinct()
+                .count()
             )
-            .distinct()
-            .count()
-        )
-        self.taxa_count = (
-            Taxon.objects.filter(
-                occurrences__deployment=self,
-                occurrences__determination_score__gte=settings.DEFAULT_CONFIDENCE_THRESHOLD,
-                occurrences__event__isnull=False,
+            self.taxa_count = (
+                Taxon.objects.filter(
+                    occurrences__deployment=self,
+                    occurrences__determination_score__gte=settings.DEFAULT_CONFIDENCE_THRESHOLD,
+                    occurrences__event__isnull=False,
+                )
+                .distinct()
+                .count()
             )
-            .distinct()
-            .count()
-        )
-
-        self.first_capture_timestamp, self.last_capture_timestamp = self.get_first_and_last_timestamps()
 
         if save:
-            self.save(update_calculated_fields=False)
+            if only is not None:
+                fields = [field for aggregate in aggregates for field in DEPLOYMENT_AGGREGATES[aggregate]]
+                self.save(update_calculated_fields=False, update_fields=fields)
+            else:
+                self.save(update_calculated_fields=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the project as loaded, so child objects are only updated when it changes
+        instance._loaded_project_id = instance.__dict__.get("project_id")
+        instance._loaded_data_source = instance.get_data_source_settings()
+        return instance
+
+    def get_data_source_settings(self) -> tuple:
+        """
+        The settings that decide which keys are listed from the data source.
+        """
+        return (
+            self.__dict__.get("data_source_id"),
+            self.__dict__.get("data_source_subdir"),
+            self.__dict__.get("data_source_regex"),
+        )
 
     def save(self, update_calculated_fields=True, *args, **kwargs):
+        loaded_data_source = getattr(self, "_loaded_data_source", None)
+        if loaded_data_source and loaded_data_source != self.get_data_source_settings():
+            # Keys after the watermarks may no longer be the only new keys, so the next sync lists everything
+            self.data_source_watermarks = {}
+            if kwargs.get("update_fields") is not None:
+                kwargs["update_fields"] = {*kwargs["update_fields"], "data_source_watermarks"}
         super().save(*args, **kwargs)
+        self._loaded_data_source = self.get_data_source_settings()
         if self.pk and update_calculated_fields:
-            self.update_calculated_fields(save=True)
-            if self.project:
+            if self.project and self.project_id != getattr(self, "_loaded_project_id", None):
+                # The summary stats of the project include everything in the deployment
+                mark_deployment_stale(self.pk)
                 self.update_children()
                 # @TODO this isn't working as a background task
                 # ami.tasks.model_task.delay("Project", self.project.pk, "update_children_project")
-            # @TODO Use "dirty" flag strategy to only update when needed
-            ami.tasks.regroup_events.delay(self.pk)
+            self._loaded_project_id = self.project_id
+
+
+class DeploymentStaleMark(models.Model):
+    """
+    A calculated field of a deployment that is out of date, and will be recomputed by a background task.
+
+    See `mark_deployment_stale`.
+    """
+
+    deployment = models.ForeignKey(Deployment, on_delete=models.CASCADE, related_name="stale_marks")
+    aggregate = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["deployment", "aggregate"], name="unique_deployment_stale_mark"),
+        ]
 
 
 @final
@@ -525,6 +886,7 @@ class Event(BaseModel):
 
     captures: models.QuerySet["SourceImage"]
     occurrences: models.QuerySet["Occurrence"]
+    summary_stats: models.QuerySet["SummaryStats"]
 
     class Meta:
         ordering = ["start"]
@@ -588,7 +950,24 @@ class Event(BaseModel):
         # return self.captures.distinct().count()
         return None
 
-    def occurrences_count(self, classification_threshold: int | None = None) -> int | None:
+    def get_summary_stats(self, classification_threshold: float | None = None) -> "SummaryStats | None":
+        """
+        Return the precalculated stats for this event, if they exist for the threshold.
+
+        Uses the stats prefetched by EventViewSet when available.
+        """
+        threshold = get_summary_stats_threshold(classification_threshold or settings.DEFAULT_CONFIDENCE_THRESHOLD)
+        if threshold is None:
+            return None
+        prefetched = getattr(self, "prefetched_summary_stats", None)
+        if prefetched is not None:
+            return next((stats for stats in prefetched if stats.threshold == threshold), None)
+        return self.summary_stats.filter(threshold=threshold).first()
+
+    def occurrences_count(self, classification_threshold: float | None = None) -> int | None:
+        summary_stats = self.get_summary_stats(classification_threshold)
+        if summary_stats:
+            return summary_stats.occurrences_count
         return (
             self.occurrences.distinct()
             .filter(determination_score__gte=classification_threshold or settings.DEFAULT_CONFIDENCE_THRESHOLD)
@@ -596,10 +975,19 @@ class Event(BaseModel):
         )
 
     def detections_count(self) -> int | None:
+        summary_stats = self.get_summary_stats()
+        if summary_stats:
+            return summary_stats.detections_count
         # return Detection.objects.filter(Q(source_image__event=self)).count()
         return None
 
     def stats(self) -> dict[str, int | None]:
+        summary_stats = self.get_summary_stats()
+        if summary_stats:
+            return {
+                "detections_max_count": summary_stats.detections_max_count,
+                "detections_min_count": summary_stats.detections_min_count,
+            }
         return (
             SourceImage.objects.filter(event=self)
             .annotate(count=models.Count("detections"))
@@ -610,7 +998,10 @@ class Event(BaseModel):
             )
         )
 
-    def taxa_count(self, classification_threshold: int | None = None) -> int:
+    def taxa_count(self, classification_threshold: float | None = None) -> int:
+        summary_stats = self.get_summary_stats(classification_threshold)
+        if summary_stats:
+            return summary_stats.taxa_count
         return self.taxa(classification_threshold).count()
 
     def taxa(self, classification_threshold: int | None = None) -> models.QuerySet["Taxon"]:
@@ -631,8 +1022,10 @@ class Event(BaseModel):
         """
         plots = []
 
-        plots.append(charts.event_detections_per_hour(event_pk=self.pk))
-        plots.append(charts.event_top_taxa(event_pk=self.pk))
+        # Charts are cached until the data of the deployment changes
+        scope = f"deployment:{self.deployment_id}"
+        plots.append(charts.cached_chart(charts.event_detections_per_hour, scope, event_pk=self.pk))
+        plots.append(charts.cached_chart(charts.event_top_taxa, scope, event_pk=self.pk))
 
         return plots
 
@@ -661,18 +1054,38 @@ class Event(BaseModel):
         if update_calculated_fields:
             self.update_calculated_fields(save=True)
 
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        mark_deployment_stale(self.deployment_id, "events", "occurrences")
+        return result
+
 
 def group_images_into_events(
-    deployment: Deployment, max_time_gap=datetime.timedelta(minutes=120), delete_empty=True
+    deployment: Deployment,
+    max_time_gap=datetime.timedelta(minutes=120),
+    delete_empty=True,
+    start: datetime.datetime | None = None,
+    end: datetime.datetime | None = None,
 ) -> list[Event]:
+    """
+    Group the captures of a deployment into events, based on the time gaps between them.
+
+    If `start` and `end` are given, only captures around that time range are regrouped.
+    The range is extended by the max time gap and to include any existing events it touches,
+    so that events are never split by the edges of the range.
+    """
+    captures = SourceImage.objects.filter(deployment=deployment)
+    if start and end:
+        window_start, window_end = start - max_time_gap, end + max_time_gap
+        touched_events = Event.objects.filter(deployment=deployment, start__lte=window_end, end__gte=window_start)
+        bounds = touched_events.aggregate(start=models.Min("start"), end=models.Max("end"))
+        window_start = min(filter(None, [window_start, bounds["start"]]))
+        window_end = max(filter(None, [window_end, bounds["end"]]))
+        logger.info(f"Regrouping captures of deployment {deployment} from {window_start} to {window_end}")
+        captures = captures.filter(timestamp__gte=window_start, timestamp__lte=window_end)
+
     # Log a warning if multiple SourceImages have the same timestamp
-    dupes = (
-        SourceImage.objects.filter(deployment=deployment)
-        .values("timestamp")
-        .annotate(count=models.Count("id"))
-        .filter(count__gt=1)
-        .exclude(timestamp=None)
-    )
+    dupes = captures.values("timestamp").annotate(count=models.Count("id")).filter(count__gt=1).exclude(timestamp=None)
     if dupes.count():
         values = "\n".join(
             [f'{d.strftime("%Y-%m-%d %H:%M:%S")} x{c}' for d, c in dupes.values_list("timestamp", "count")]
@@ -684,11 +1097,7 @@ def group_images_into_events(
         )
 
     image_timestamps = list(
-        SourceImage.objects.filter(deployment=deployment)
-        .exclude(timestamp=None)
-        .values_list("timestamp", flat=True)
-        .order_by("timestamp")
-        .distinct()
+        captures.exclude(timestamp=None).values_list("timestamp", flat=True).order_by("timestamp").distinct()
     )
 
     timestamp_groups = ami.utils.dates.group_datetimes_by_gap(image_timestamps, max_time_gap)
@@ -712,26 +1121,52 @@ def group_images_into_events(
         )
 
         # Creating events & assigning images
+        # Each group is a continuous time range, so its captures are selected by range rather than by timestamp
         group_by = start_date.date()
-        event, _ = Event.objects.get_or_create(
-            deployment=deployment,
-            group_by=group_by,
-            defaults={"start": start_date, "end": end_date},
-        )
+        group_captures = captures.filter(timestamp__gte=start_date, timestamp__lte=end_date)
+        # Existing events that already hold some of these captures are merged into one
+        existing_event_ids = set(group_captures.exclude(event=None).values_list("event_id", flat=True).distinct())
+        event = Event.objects.filter(deployment=deployment, group_by=group_by).first()
+        if not event and existing_event_ids:
+            # Captures were added before the start of an existing event, keep that event with a new start day
+            event = Event.objects.filter(pk__in=existing_event_ids).order_by("start").first()
+            assert event
+            event.group_by = group_by
+            event.save(update_calculated_fields=False)
+        elif not event:
+            event = Event(
+                deployment=deployment,
+                project=deployment.project,
+                group_by=group_by,
+                start=start_date,
+                end=end_date,
+            )
+            event.save(update_calculated_fields=False)
         events.append(event)
-        SourceImage.objects.filter(deployment=deployment, timestamp__in=group).update(event=event)
-        event.save()  # Update start and end times and other cached fields
+        num_moved = group_captures.exclude(event=event).update(event=event)
+
+        merged_event_ids = existing_event_ids - {event.pk}
+        if merged_event_ids:
+            # Move the occurrences of events that no longer have any captures
+            Occurrence.objects.filter(event__in=merged_event_ids).exclude(
+                models.Exists(SourceImage.objects.filter(event=models.OuterRef("event")))
+            ).update(event=event)
         logger.info(
             f"Created/updated event {event} with {len(group)} images for deployment {deployment}. "
-            f"Duration: {event.duration_label()}"
+            f"{num_moved} images were added to the event."
         )
 
+    # Update the start and end times of all of the events at once
+    update_event_bounds(Event.objects.filter(pk__in=[event.pk for event in events]))
+    events = list(Event.objects.filter(pk__in=[event.pk for event in events]).order_by("start"))
+
     if delete_empty:
-        delete_empty_events()
+        delete_empty_events(deployment=deployment)
+    # Occurrences are only counted once they belong to an event
+    mark_deployment_stale(deployment.pk, "events", "occurrences")
 
-    for event in events:
-        # Set the width and height of all images in each event based on the first image
-        set_dimensions_for_collection(event)
+    # Set the width and height of all images in each event based on the first image
+    set_dimensions_for_events(events)
 
     events_over_24_hours = Event.objects.filter(
         deployment=deployment, start__lt=models.F("end") - datetime.timedelta(days=1)
@@ -749,9 +1184,28 @@ def group_images_into_events(
     return events
 
 
-def delete_empty_events(dry_run=False):
+def update_event_bounds(events: models.QuerySet[Event]) -> int:
+    """
+    Set the start and end of events to the timestamps of their first and last captures, in one query.
+    """
+    captures = SourceImage.objects.filter(event=models.OuterRef("pk")).exclude(timestamp=None)
+    return events.update(
+        start=Coalesce(
+            models.Subquery(captures.order_by("timestamp").values("timestamp")[:1]),
+            models.F("start"),
+        ),
+        end=Coalesce(
+            models.Subquery(captures.order_by("-timestamp").values("timestamp")[:1]),
+            models.F("end"),
+        ),
+    )
+
+
+def delete_empty_events(dry_run=False, deployment: Deployment | None = None):
     """
     Delete events that have no images, occurrences or other related records.
+
+    Only the events of one deployment are checked if a deployment is given.
     """
 
     # @TODO Search all models that have a foreign key to Event
@@ -761,15 +1215,22 @@ def delete_empty_events(dry_run=False):
     #     if f.one_to_many or f.one_to_one or (f.many_to_many and f.auto_created)
     # ]
 
-    events = Event.objects.annotate(num_images=models.Count("captures")).filter(num_images=0)
-    events = events.annotate(num_occurrences=models.Count("occurrences")).filter(num_occurrences=0)
+    events = Event.objects.all()
+    if deployment:
+        events = events.filter(deployment=deployment)
+    events = events.filter(
+        ~models.Exists(SourceImage.objects.filter(event=models.OuterRef("pk"))),
+        ~models.Exists(Occurrence.objects.filter(event=models.OuterRef("pk"))),
+    )
 
     if dry_run:
         for event in events:
             logger.debug(f"Would delete event {event} (dry run)")
     else:
         logger.info(f"Deleting {events.count()} empty events")
+        deployment_ids = set(events.values_list("deployment_id", flat=True))
         events.delete()
+        mark_deployment_stale(deployment_ids, "events", "occurrences")
 
 
 def sample_events(deployment: Deployment, day_interval: int = 3) -> typing.Generator[Event, None, None]:
@@ -864,6 +1325,9 @@ class S3StorageSource(BaseModel):
             if old.public_base_url != self.public_base_url:
                 for deployment in self.deployments.all():
                     ami.tasks.update_public_urls.delay(deployment.pk, self.public_base_url)
+            # The keys listed before are no longer the keys in this data source
+            if (old.endpoint_url, old.bucket, old.prefix) != (self.endpoint_url, self.bucket, self.prefix):
+                self.deployments.update(data_source_watermarks={})
         super().save(*args, **kwargs)
 
 
@@ -927,8 +1391,11 @@ class SourceImageUpload(BaseModel):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        # @TODO Use a "dirty" flag to mark the deployment as having new uploads, needs refresh
-        self.deployment.save()
+        mark_deployment_stale(self.deployment_id, "captures")
+        if self.source_image and self.source_image.timestamp:
+            # Only regroup the captures around the new image
+            timestamp = self.source_image.timestamp.isoformat()
+            ami.tasks.regroup_events.delay(self.deployment.pk, start=timestamp, end=timestamp)
 
 
 @receiver(pre_delete, sender=SourceImageUpload)
@@ -943,8 +1410,7 @@ def delete_source_image(sender, instance, **kwargs):
         instance.source_image = None
         instance.save()
         source_image.delete()
-    # @TODO Use a "dirty" flag to mark the deployment as having new uploads, needs refresh
-    instance.deployment.save()
+    mark_deployment_stale(instance.deployment_id, "captures")
 
 
 @final
@@ -953,6 +1419,8 @@ class SourceImage(BaseModel):
 
     path = models.CharField(max_length=255, blank=True)
     public_base_url = models.CharField(max_length=255, blank=True)
+    # Key of the thumbnail in the data source, relative to the public base URL like the path
+    thumbnail_path = models.CharField(max_length=255, blank=True, editable=False)
     timestamp = models.DateTimeField(null=True, blank=True, db_index=True)
     width = models.IntegerField(null=True, blank=True)
     height = models.IntegerField(null=True, blank=True)
@@ -983,11 +1451,20 @@ class SourceImage(BaseModel):
         for all source images will be updated.
 
         @TODO use signed URLs if necessary.
-        @TODO add support for thumbnail URLs here?
         @TODO consider if we ever need to access the original image directly!
         """
         return urllib.parse.urljoin(self.public_base_url or "/", self.path.lstrip("/"))
 
+    def thumbnail_url(self) -> str | None:
+        """
+        Return the public URL for the thumbnail of this image, if it has been created.
+
+        See `create_image_derivatives`.
+        """
+        if not self.thumbnail_path:
+            return None
+        return urllib.parse.urljoin(self.public_base_url or "/", self.thumbnail_path)
+
     # backwards compatibility
     url = public_url
 
@@ -1018,16 +1495,17 @@ class SourceImage(BaseModel):
         return timestamp
 
     def get_dimensions(self) -> tuple[int | None, int | None]:
-        """Calculate the width and height of the original image."""
+        """Read the width and height of the original image from the header of the file."""
         if self.path and self.deployment and self.deployment.data_source:
             config = self.deployment.data_source.config
             try:
-                img = ami.utils.s3.read_image(config=config, key=self.path)
+                self.width, self.height = ami.utils.s3.read_image_dimensions(
+                    config=config, key=self.path, etag=self.checksum
+                )
             except Exception as e:
                 logger.error(f"Could not determine image dimensions for {self.path}: {e}")
             else:
-                self.width, self.height = img.size
-                self.save()
+                SourceImage.objects.filter(pk=self.pk).update(width=self.width, height=self.height)
                 return self.width, self.height
         return None, None
 
@@ -1048,6 +1526,13 @@ class SourceImage(BaseModel):
         if update_calculated_fields:
             self.update_calculated_fields(save=True)
 
+    def delete(self, *args, **kwargs):
+        occurrence_ids = list(self.detections.values_list("occurrence_id", flat=True))
+        result = super().delete(*args, **kwargs)
+        mark_deployment_stale(self.deployment_id, "captures", "detections", "occurrences")
+        update_occurrence_detection_fields_on_commit(occurrence_ids)
+        return result
+
     class Meta:
         ordering = ("deployment", "event", "timestamp")
 
@@ -1059,8 +1544,9 @@ class SourceImage(BaseModel):
 
         indexes = [
             models.Index(fields=["deployment", "timestamp"]),
-            models.Index(fields=["event", "timestamp"]),
-            models.Index(fields=["timestamp"]),
+            # The id is included for keyset pagination, which orders by (timestamp, id)
+            models.Index(fields=["event", "timestamp", "id"]),
+            models.Index(fields=["timestamp", "id"]),
         ]
 
 
@@ -1070,7 +1556,8 @@ def update_detection_counts(qs: models.QuerySet[SourceImage] | None = None) -> i
 
     @TODO Needs testing.
     """
-    qs = qs or SourceImage.objects.all()
+    if qs is None:
+        qs = SourceImage.objects.all()
     subquery = models.Subquery(
         Detection.objects.filter(source_image_id=models.OuterRef("pk"))
         .values("source_image_id")
@@ -1085,51 +1572,241 @@ def update_detection_counts(qs: models.QuerySet[SourceImage] | None = None) -> i
     return num_updated
 
 
+def probe_image_dimensions(
+    images: typing.Iterable[SourceImage], max_workers: int | None = None
+) -> dict[int, tuple[int, int] | None]:
+    """
+    Read the dimensions of many images from their data sources at once and save them.
+
+    Only the header at the start of each file is downloaded, and the images are probed concurrently.
+    Returns the dimensions for each image id, or None if they could not be read.
+    """
+    max_workers = max_workers or settings.IMAGE_DIMENSIONS_MAX_WORKERS
+    images_by_source: dict[int, list[SourceImage]] = collections.defaultdict(list)
+    for image in images:
+        if image.path and image.deployment and image.deployment.data_source:
+            images_by_source[image.deployment.data_source.pk].append(image)
+    if not images_by_source:
+        return {}
+
+    dimensions: dict[int, tuple[int, int] | None] = {}
+    probed_images = []
+    for source_images in images_by_source.values():
+        config = source_images[0].deployment.data_source.config  # type: ignore
+        probed = ami.utils.s3.probe_image_dimensions(
+            config,
+            {image.path for image in source_images},
+            max_workers=max_workers,
+            etags={image.path: image.checksum for image in source_images},
+        )
+        for image in source_images:
+            dimensions[image.pk] = probed[image.path]
+            if probed[image.path]:
+                image.width, image.height = probed[image.path]  # type: ignore
+                probed_images.append(image)
+    SourceImage.objects.bulk_update(probed_images, ["width", "height"], batch_size=1000)
+    logger.info(f"Read the dimensions of {len(probed_images)} of {len(dimensions)} images")
+    return dimensions
+
+
+def create_image_derivatives(
+    images: models.QuerySet[SourceImage],
+    thumbnail_size: int | None = None,
+    batch_size: int | None = None,
+    max_workers: int | None = None,
+) -> int:
+    """
+    Create the missing thumbnails of source images and crops of their detections in the data source.
+
+    Each original image is downloaded once for its thumbnail and all of its crops, and several images
+    are processed in parallel. The derivatives have deterministic keys (see `ami.utils.s3.thumbnail_key`
+    and `ami.utils.s3.crop_key`), so creating them again overwrites the same files.
+    The thumbnail is saved as the `thumbnail_path` of the image and each crop as the `path` of its detection.
+
+    Returns the number of images that derivatives were created for.
+    """
+    thumbnail_size = thumbnail_size or settings.THUMBNAIL_SIZE
+    batch_size = batch_size or settings.DERIVATIVES_BATCH_SIZE
+    max_workers = max_workers or settings.DERIVATIVES_MAX_WORKERS
+
+    detections_without_crops = Detection.objects.filter(path="").exclude(bbox=None)
+    image_ids = list(
+        images.exclude(path="")
+        .exclude(deployment__data_source=None)
+        .filter(
+            ~models.Q(thumbnail_path__startswith=f"{ami.utils.s3.DERIVATIVES_PREFIX}/thumbnails/{thumbnail_size}/")
+            | models.Exists(detections_without_crops.filter(source_image=models.OuterRef("pk")))
+        )
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    logger.info(f"Creating derivatives of {len(image_ids)} images")
+
+    num_created = 0
+    for i in range(0, len(image_ids), batch_size):
+        batch = (
+            SourceImage.objects.filter(pk__in=image_ids[i : i + batch_size])  # noqa: E203
+            .select_related("deployment__data_source")
+            .prefetch_related(models.Prefetch("detections", queryset=detections_without_crops, to_attr="to_crop"))
+        )
+        images_by_source: dict[int, list[SourceImage]] = collections.defaultdict(list)
+        for image in batch:
+            images_by_source[image.deployment.data_source.pk].append(image)  # type: ignore
+
+        updated_images = []
+        updated_detections = []
+        for source_images in images_by_source.values():
+            data_source: S3StorageSource = source_images[0].deployment.data_source  # type: ignore
+            requests = []
+            for image in source_images:
+                request = ami.utils.s3.DerivativesRequest(
+                    key=image.path, etag=image.checksum, thumbnail_size=thumbnail_size
+                )
+                for detection in image.to_crop:  # type: ignore
+                    if len(detection.bbox) == 4:
+                        request.crops[ami.utils.s3.crop_key(image.path, detection.bbox)] = detection.bbox
+                requests.append(request)
+
+            # The results are in the same order as the requests
+            results = ami.utils.s3.create_derivatives(data_source.config, requests, max_workers=max_workers)
+            for image, (_, error) in zip(source_images, results):
+                if error:
+                    continue
+                image.thumbnail_path = ami.utils.s3.thumbnail_key(image.path, thumbnail_size)
+                updated_images.append(image)
+                for detection in image.to_crop:  # type: ignore
+                    if len(detection.bbox) == 4:
+                        detection.path = data_source.public_url(ami.utils.s3.crop_key(image.path, detection.bbox))
+                        updated_detections.append(detection)
+
+        SourceImage.objects.bulk_update(updated_images, ["thumbnail_path"])
+        Detection.objects.bulk_update(updated_detections, ["path"])
+        num_created += len(updated_images)
+        logger.info(f"Created derivatives of {num_created} of {len(image_ids)} images")
+    return num_created
+
+
+def queue_image_derivatives(images: models.QuerySet[SourceImage], batch_size: int | None = None) -> int:
+    """
+    Queue background tasks that create the thumbnails of the images that don't have one yet.
+
+    Returns the number of images that were queued.
+    """
+    batch_size = batch_size or settings.DERIVATIVES_BATCH_SIZE
+    image_ids = list(
+        images.filter(thumbnail_path="")
+        .exclude(path="")
+        .exclude(deployment__data_source=None)
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+    for i in range(0, len(image_ids), batch_size):
+        ami.tasks.create_image_derivatives.delay(image_ids[i : i + batch_size])  # noqa: E203
+    logger.info(f"Queued the creation of derivatives for {len(image_ids)} images")
+    return len(image_ids)
+
+
+def sample_event_captures(event: Event, sample_size: int = 1) -> list[SourceImage]:
+    """
+    Return the first capture of an event and others evenly spread over the rest of the event.
+    """
+    capture_ids = list(event.captures.order_by("timestamp", "pk").values_list("pk", flat=True))
+    if not capture_ids:
+        return []
+    step = max(len(capture_ids) / sample_size, 1)
+    sample_ids = {capture_ids[int(i * step)] for i in range(min(sample_size, len(capture_ids)))}
+    return list(
+        SourceImage.objects.filter(pk__in=sample_ids).select_related("deployment__data_source").order_by("timestamp")
+    )
+
+
+def set_dimensions_for_events(
+    events: typing.Iterable[Event], replace_existing: bool = False, sample_size: int = 1
+) -> dict[int, tuple[int, int] | None]:
+    """
+    Set the width & height of all of the images in each event based on a sample of its images.
+
+    Events with an image that already has dimensions use those. For the other events, a sample of
+    `sample_size` images is read from the data source, with the images of all events probed at once.
+    If the sample has more than one resolution, the event has mixed dimensions: only the images that
+    were read are updated and a warning is logged, since the dimensions of the others are unknown.
+
+    Returns the dimensions set for each event id, or None if they could not be determined.
+    """
+    dimensions: dict[int, tuple[int, int] | None] = {}
+    samples: dict[int, list[SourceImage]] = {}
+    events = list(events)
+    for event in events:
+        # Try retrieving dimensions from deployment
+        width, height = getattr(event.deployment, "assumed_image_dimensions", (None, None))
+        if not width or not height:
+            # Try retrieving dimensions from the first image that has them already
+            image = event.captures.exclude(width__isnull=True, height__isnull=True).first()
+            if image:
+                width, height = image.width, image.height
+        if width and height:
+            dimensions[event.pk] = (width, height)
+        else:
+            samples[event.pk] = sample_event_captures(event, sample_size)
+
+    probed = probe_image_dimensions(image for sample in samples.values() for image in sample)
+    for event_pk, sample in samples.items():
+        sizes = {probed[image.pk] for image in sample if probed.get(image.pk)}
+        if len(sizes) > 1:
+            logger.warning(
+                f"Found images with mixed dimensions in event {event_pk}: {', '.join(f'{w}x{h}' for w, h in sizes)}. "
+                f"Width & height will only be set on the {len(sample)} images that were read."
+            )
+            dimensions[event_pk] = None
+        elif sizes:
+            dimensions[event_pk] = sizes.pop()
+        else:
+            logger.warning(
+                f"Could not determine image dimensions for event {event_pk}. "
+                f"Width & height will not be set on any source images."
+            )
+            dimensions[event_pk] = None
+
+    for event in events:
+        if dimensions[event.pk]:
+            width, height = dimensions[event.pk]  # type: ignore
+            if replace_existing:
+                captures = event.captures.all()
+            else:
+                captures = event.captures.filter(width__isnull=True, height__isnull=True)
+            num_updated = captures.update(width=width, height=height)
+            logger.info(f"Set dimensions for {num_updated} images in event {event.pk} to {width}x{height}")
+    return dimensions
+
+
 def set_dimensions_for_collection(
-    event: Event, replace_existing: bool = False, width: int | None = None, height: int | None = None
+    event: Event,
+    replace_existing: bool = False,
+    width: int | None = None,
+    height: int | None = None,
+    sample_size: int = 1,
 ):
     """
     Set the width & height of all of the images in the event based on one image.
 
     This will look for the first image in the event that already has dimensions.
     If no images have dimensions, the first image be retrieved from the data source.
+    A larger `sample_size` reads more images, to detect events with images of mixed dimensions.
 
-    This is much more practical than fetching each image. However if a deployment
-    does ever have images with mixed dimensions, another method will be needed.
+    This is much more practical than fetching each image.
 
     @TODO consider adding "assumed image dimensions" to the Deployment instance itself.
     """
-
     if not width or not height:
-        # Try retrieving dimensions from deployment
-        width, height = getattr(event.deployment, "assumed_image_dimensions", (None, None))
-
-    if not width or not height:
-        # Try retrieving dimensions from the first image that has them already
-        image = event.captures.exclude(width__isnull=True, height__isnull=True).first()
-        if image:
-            width, height = image.width, image.height
-
-    if not width or not height:
-        image = event.captures.first()
-        if image:
-            width, height = image.get_dimensions()
-
-    if width and height:
-        logger.info(
-            f"Setting dimensions for {event.captures.count()} images in event {event.pk} to " f"{width}x{height}"
-        )
-        if replace_existing:
-            captures = event.captures.all()
-        else:
-            captures = event.captures.filter(width__isnull=True, height__isnull=True)
-        captures.update(width=width, height=height)
+        set_dimensions_for_events([event], replace_existing=replace_existing, sample_size=sample_size)
+        return
 
+    logger.info(f"Setting dimensions for images in event {event.pk} to {width}x{height}")
+    if replace_existing:
+        captures = event.captures.all()
     else:
-        logger.warning(
-            f"Could not determine image dimensions for event {event.pk}. "
-            f"Width & height will not be set on any source images."
-        )
+        captures = event.captures.filter(width__isnull=True, height__isnull=True)
+    captures.update(width=width, height=height)
 
 
 def sample_captures_by_interval(
@@ -1406,6 +2083,11 @@ class Classification(BaseModel):
     def __str__(self) -> str:
         return f"#{self.pk} to Taxon #{self.taxon_id} ({self.score:.2f}) by Algorithm #{self.algorithm_id}"
 
+    def delete(self, *args, **kwargs):
+        # The detection is still there, so its occurrence can be found after the commit
+        update_occurrence_detection_fields_on_commit(detection_ids=[self.detection_id])
+        return super().delete(*args, **kwargs)
+
 
 @final
 class Detection(BaseModel):
@@ -1499,6 +2181,16 @@ class Detection(BaseModel):
             "frame_num",
             "timestamp",
         ]
+        indexes = [
+            models.Index(fields=["timestamp", "id"]),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the occurrence as loaded, so it can be updated if the detection is moved to another one
+        instance._loaded_occurrence_id = instance.__dict__.get("occurrence_id")
+        return instance
 
     def best_classification(self):
         # @TODO where is this used?
@@ -1529,7 +2221,10 @@ class Detection(BaseModel):
         )
         self.occurrence = occurrence
         self.save()
-        occurrence.save()  # Need to save again to update the aggregate values
+        # The update queued by saving the detection only runs once the transaction commits
+        update_occurrence_detection_fields(Occurrence.objects.filter(pk=occurrence.pk))
+        occurrence.refresh_from_db(fields=OCCURRENCE_DETECTION_FIELDS)
+        occurrence.save()  # Need to save again to update the determination
         # Update aggregate values on source image
         # @TODO this should be done async in a task with an eta of a few seconds
         # so it isn't done for every detection in a batch
@@ -1551,6 +2246,12 @@ class Detection(BaseModel):
         # if not self.occurrence:
         #     self.associate_new_occurrence()
 
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        mark_source_images_stale([self.source_image_id], "detections")
+        update_occurrence_detection_fields_on_commit([self.occurrence_id])
+        return result
+
     def __str__(self) -> str:
         return f"#{self.pk} from SourceImage #{self.source_image_id} with Algorithm #{self.detection_algorithm_id}"
 
@@ -1575,6 +2276,17 @@ class Occurrence(BaseModel):
     deployment = models.ForeignKey(Deployment, on_delete=models.SET_NULL, null=True, related_name="occurrences")
     project = models.ForeignKey("Project", on_delete=models.SET_NULL, null=True, related_name="occurrences")
 
+    # Denormalized from the detections, see `update_occurrence_detection_fields`
+    first_appearance_timestamp = models.DateTimeField(null=True, blank=True, editable=False)
+    last_appearance_timestamp = models.DateTimeField(null=True, blank=True, editable=False)
+    detections_count = models.IntegerField(null=True, blank=True, editable=False)
+    best_detection = models.ForeignKey(
+        "Detection", on_delete=models.SET_NULL, null=True, blank=True, related_name="+", editable=False
+    )
+    best_classification = models.ForeignKey(
+        "Classification", on_delete=models.SET_NULL, null=True, blank=True, related_name="+", editable=False
+    )
+
     detections: models.QuerySet[Detection]
     identifications: models.QuerySet[Identification]
 
@@ -1588,10 +2300,6 @@ class Occurrence(BaseModel):
             name += f" ({self.determination.name})"
         return name
 
-    def detections_count(self) -> int | None:
-        # Annotations don't seem to work with nested serializers
-        return self.detections.count()
-
     @functools.cached_property
     def first_appearance(self) -> SourceImage | None:
         # @TODO it appears we only need the first timestamp, that could be an annotated value
@@ -1606,32 +2314,15 @@ class Occurrence(BaseModel):
         if last:
             return last.source_image
 
-    def first_appearance_timestamp(self) -> datetime.datetime | None:
-        """
-        Return the timestamp of the first appearance.
-        ONLY if it has been added with a query annotation.
-        """
-        return None
-
     def first_appearance_time(self) -> datetime.time | None:
         """
         Return the time part only of the first appearance.
-        ONLY if it has been added with a query annotation.
-        """
-        return None
-
-    def last_appearance_timestamp(self) -> datetime.datetime | None:
         """
-        Return the timestamp of the last appearance.
-        ONLY if it has been added with a query annotation.
-        """
-        return None
+        return self.first_appearance_timestamp.time() if self.first_appearance_timestamp else None
 
     def duration(self) -> datetime.timedelta | None:
-        first = self.first_appearance
-        last = self.last_appearance
-        if first and last and first.timestamp and last.timestamp:
-            return last.timestamp - first.timestamp
+        if self.first_appearance_timestamp and self.last_appearance_timestamp:
+            return self.last_appearance_timestamp - self.first_appearance_timestamp
         else:
             return None
 
@@ -1644,13 +2335,13 @@ class Occurrence(BaseModel):
         return ami.utils.dates.format_timedelta(duration)
 
     def detection_images(self, limit=None):
-        for url in Detection.objects.filter(occurrence=self).values_list("path", flat=True)[:limit]:
+        # Paths may have been loaded for a whole page of occurrences by `prefetch_occurrence_details`
+        paths = getattr(self, "prefetched_detection_paths", None)
+        if paths is None:
+            paths = Detection.objects.filter(occurrence=self).values_list("path", flat=True)
+        for url in paths[:limit]:
             yield urllib.parse.urljoin(_CROPS_URL_BASE, url)
 
-    @functools.cached_property
-    def best_detection(self):
-        return Detection.objects.filter(occurrence=self).order_by("-classifications__score").first()
-
     @functools.cached_property
     def best_prediction(self):
         return self.predictions().first()
@@ -1681,7 +2372,7 @@ class Occurrence(BaseModel):
                     .values("max_score")
                 )
             )
-            .order_by("-created_at")
+            .order_by("-created_at", "-pk")
         )
         return classifications
 
@@ -1698,7 +2389,20 @@ class Occurrence(BaseModel):
         return f"https://app.preview.insectai.org/occurrences/{self.pk}"
 
     def save(self, update_determination=True, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None and not self._state.adding:
+            # The detection fields are kept up to date by `update_occurrence_detection_fields`,
+            # don't overwrite them with the values that were loaded with this instance
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in OCCURRENCE_DETECTION_FIELDS
+            ]
         super().save(*args, **kwargs)
+        if update_fields is not None and set(update_fields) & set(OCCURRENCE_DETECTION_FIELDS):
+            # Saved explicitly, so recalculate them from the detections instead of trusting the instance
+            update_occurrence_detection_fields(Occurrence.objects.filter(pk=self.pk))
+            self.refresh_from_db(fields=OCCURRENCE_DETECTION_FIELDS)
         if update_determination:
             update_occurrence_determination(
                 self,
@@ -1715,8 +2419,141 @@ class Occurrence(BaseModel):
             else:
                 self.save(update_determination=False)
 
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        mark_deployment_stale(self.deployment_id, "occurrences")
+        return result
+
     class Meta:
         ordering = ["-determination_score"]
+        indexes = [
+            models.Index(fields=["determination_score", "id"]),
+            models.Index(fields=["first_appearance_timestamp", "id"]),
+        ]
+
+
+OCCURRENCE_DETECTION_FIELDS = [
+    "first_appearance_timestamp",
+    "last_appearance_timestamp",
+    "detections_count",
+    "best_detection",
+    "best_classification",
+]
+
+
+def update_occurrence_detection_fields(qs: models.QuerySet[Occurrence] | None = None) -> int:
+    """
+    Update the fields that occurrences store about their detections, using a bulk update query.
+
+    These are the first & last detection timestamps, the number of detections, the best detection
+    (the one with the highest classification score) and the best classification
+    (the same prediction as `Occurrence.best_prediction`).
+    """
+    if qs is None:
+        qs = Occurrence.objects.all()
+    detections = Detection.objects.filter(occurrence_id=models.OuterRef("pk"))
+    detection_aggregates = detections.order_by().values("occurrence_id")
+    classifications = Classification.objects.filter(detection__occurrence_id=models.OuterRef("pk"))
+    max_scores_per_algorithm = (
+        Classification.objects.filter(detection__occurrence_id=models.OuterRef(models.OuterRef("pk")))
+        .values("algorithm")
+        .annotate(max_score=models.Max("score"))
+        .values("max_score")
+    )
+    start_time = time.time()
+    num_updated = qs.update(
+        first_appearance_timestamp=models.Subquery(
+            detection_aggregates.annotate(first=models.Min("timestamp")).values("first")
+        ),
+        last_appearance_timestamp=models.Subquery(
+            detection_aggregates.annotate(last=models.Max("timestamp")).values("last")
+        ),
+        detections_count=Coalesce(
+            models.Subquery(detection_aggregates.annotate(count=models.Count("id")).values("count")), 0
+        ),
+        best_detection=Coalesce(
+            models.Subquery(classifications.order_by("-score", "pk").values("detection_id")[:1]),
+            models.Subquery(detections.order_by("frame_num", "timestamp", "pk").values("pk")[:1]),
+        ),
+        best_classification=models.Subquery(
+            classifications.filter(score__in=models.Subquery(max_scores_per_algorithm))
+            .order_by("-created_at", "-pk")
+            .values("pk")[:1]
+        ),
+    )
+    elapsed_time = time.time() - start_time
+    logger.debug(f"Updated detection fields for {num_updated} occurrences in {elapsed_time:.2f} seconds")
+    return num_updated
+
+
+def update_occurrence_detection_fields_on_commit(
+    occurrence_ids: typing.Iterable[int | None] = (), detection_ids: typing.Iterable[int | None] = ()
+) -> None:
+    """
+    Update the detection fields of occurrences, given directly or by their detections, after the transaction commits.
+
+    All of the changes made within a transaction (e.g. the detections removed by a cascading delete)
+    are collected and the affected occurrences are updated with one query.
+    """
+    occurrence_ids = list(filter(None, occurrence_ids))
+    detection_ids = list(filter(None, detection_ids))
+    if not occurrence_ids and not detection_ids:
+        return
+
+    def update(pending: tuple[set[int], set[int]]):
+        pending[0].update(occurrence_ids)
+        pending[1].update(detection_ids)
+
+    _occurrence_detection_updates.add(update)
+
+
+def _flush_occurrence_detection_fields(pending: tuple[set[int], set[int]]) -> None:
+    occurrence_ids, detection_ids = pending
+    update_occurrence_detection_fields(
+        Occurrence.objects.filter(Q(pk__in=occurrence_ids) | Q(detections__in=detection_ids))
+    )
+
+
+_occurrence_detection_updates = _OnCommitBatch(new=lambda: (set(), set()), flush=_flush_occurrence_detection_fields)
+
+
+def prefetch_occurrence_details(occurrences: list[Occurrence]) -> list[Occurrence]:
+    """
+    Load the best identification, best prediction and detection paths for a list of occurrences at once.
+
+    These are attached to each occurrence as if they had been loaded by the cached properties
+    and methods that serializers use, so serializing a page takes a fixed number of queries.
+    """
+    occurrence_ids = [occurrence.pk for occurrence in occurrences]
+    if not occurrence_ids:
+        return occurrences
+
+    best_identifications = {
+        identification.occurrence_id: identification
+        for identification in Identification.objects.filter(occurrence__in=occurrence_ids, withdrawn=False)
+        .select_related("user", "taxon__parent__parent")
+        .order_by("occurrence_id", "-created_at")
+        .distinct("occurrence_id")
+    }
+
+    # The best prediction of each occurrence is stored as its best classification
+    best_predictions = Classification.objects.select_related("algorithm", "taxon__parent__parent").in_bulk(
+        {occurrence.best_classification_id for occurrence in occurrences if occurrence.best_classification_id}
+    )
+
+    detection_paths = collections.defaultdict(list)
+    for occurrence_id, path in (
+        Detection.objects.filter(occurrence__in=occurrence_ids)
+        .order_by("frame_num", "timestamp")
+        .values_list("occurrence_id", "path")
+    ):
+        detection_paths[occurrence_id].append(path)
+
+    for occurrence in occurrences:
+        occurrence.__dict__["best_identification"] = best_identifications.get(occurrence.pk)
+        occurrence.__dict__["best_prediction"] = best_predictions.get(occurrence.best_classification_id)
+        occurrence.prefetched_detection_paths = detection_paths[occurrence.pk]
+    return occurrences
 
 
 def update_occurrence_determination(
@@ -1776,6 +2613,84 @@ def update_occurrence_determination(
         occurrence.save(update_determination=False)
 
 
+# Only saves are handled with signals. Receivers for deletes would turn off Django's fast deletes for
+# these models, so cascading deletes would load every row. Deleting an instance is handled by its `delete`
+# method instead, and code that deletes with a queryset marks the deployments itself.
+
+
+@receiver(post_save, sender=SourceImage)
+def mark_captures_stale(sender, instance: SourceImage, **kwargs):
+    mark_deployment_stale(instance.deployment_id, "captures")
+
+
+@receiver(post_save, sender=Event)
+def mark_events_stale(sender, instance: Event, **kwargs):
+    mark_deployment_stale(instance.deployment_id, "events", "occurrences")
+
+
+@receiver(post_save, sender=Detection)
+def mark_detections_stale(sender, instance: Detection, **kwargs):
+    mark_source_images_stale([instance.source_image_id], "detections")
+    # Update the occurrence the detection was moved from as well
+    update_occurrence_detection_fields_on_commit(
+        [instance.occurrence_id, getattr(instance, "_loaded_occurrence_id", None)]
+    )
+    instance._loaded_occurrence_id = instance.occurrence_id
+
+
+@receiver(post_save, sender=Classification)
+def update_occurrence_best_classification(sender, instance: Classification, **kwargs):
+    update_occurrence_detection_fields_on_commit(detection_ids=[instance.detection_id])
+
+
+@receiver(post_save, sender=Occurrence)
+def mark_occurrences_stale(sender, instance: Occurrence, **kwargs):
+    mark_deployment_stale(instance.deployment_id, "occurrences")
+
+
+def build_tree_paths(parent_ids: dict[int, int | None]) -> dict[int, str]:
+    """
+    Build the materialized path of each taxon from a mapping of taxon IDs to their parent IDs.
+
+    A path lists the IDs of all ancestors of a taxon followed by its own ID, each ending with a slash.
+    Parents that are missing from the mapping, or that would make a cycle, are ignored.
+
+    >>> build_tree_paths({1: None, 2: 1, 3: 2, 4: 1})
+    {1: '1/', 2: '1/2/', 3: '1/2/3/', 4: '1/4/'}
+    >>> sorted(build_tree_paths({1: 2, 2: 1}).items())
+    [(1, '2/1/'), (2, '2/')]
+    """
+    paths: dict[int, str] = {}
+    for taxon_id in parent_ids:
+        # Climb until reaching a taxon with a known path (or the top), then fill in the paths on the way down
+        lineage = [taxon_id]
+        parent_id = parent_ids[taxon_id]
+        while parent_id is not None and parent_id in parent_ids and parent_id not in paths:
+            if parent_id in lineage:
+                # Break the cycle by treating the first taxon seen in it as the top
+                parent_id = None
+                break
+            lineage.append(parent_id)
+            parent_id = parent_ids[parent_id]
+        prefix = paths.get(parent_id, "") if parent_id is not None else ""
+        for ancestor_id in reversed(lineage):
+            if ancestor_id not in paths:
+                prefix = paths[ancestor_id] = f"{prefix}{ancestor_id}/"
+            else:
+                prefix = paths[ancestor_id]
+    return paths
+
+
+def tree_path_ids(tree_path: str) -> list[int]:
+    """
+    Return the IDs of a materialized path, from the top of the tree down.
+
+    >>> tree_path_ids("1/2/3/")
+    [1, 2, 3]
+    """
+    return [int(taxon_id) for taxon_id in tree_path.split("/") if taxon_id]
+
+
 @final
 class TaxaManager(models.Manager):
     def get_queryset(self):
@@ -1805,6 +2720,34 @@ class TaxaManager(models.Manager):
             updated.append(taxon)
         return updated
 
+    def update_tree_paths(self, update_parents: bool = True) -> int:
+        """
+        Rebuild the materialized tree paths of all taxa in bulk, e.g. after importing or reparenting many taxa.
+
+        The cached "parents" lists of the taxa whose path changed are updated as well.
+        Returns the number of taxa that were updated.
+        """
+        Taxon = self.model
+        rows = list(self.get_queryset().order_by().values_list("pk", "parent_id", "tree_path"))
+        paths = build_tree_paths({pk: parent_id for pk, parent_id, _ in rows})
+        changed = [Taxon(pk=pk, tree_path=paths[pk]) for pk, _, tree_path in rows if paths[pk] != tree_path]
+        self.bulk_update(changed, ["tree_path"], batch_size=1000)
+
+        if update_parents and changed:
+            Parents = Taxon.parents.through
+            changed_ids = [taxon.pk for taxon in changed]
+            Parents.objects.filter(from_taxon_id__in=changed_ids).delete()
+            Parents.objects.bulk_create(
+                [
+                    Parents(from_taxon_id=taxon.pk, to_taxon_id=ancestor_id)
+                    for taxon in changed
+                    for ancestor_id in tree_path_ids(taxon.tree_path)[:-1]
+                ],
+                batch_size=1000,
+            )
+        logger.info(f"Updated the tree paths of {len(changed)} taxa")
+        return len(changed)
+
     def update_display_names(self, queryset: models.QuerySet | None = None):
         """Update the display names of all taxa."""
 
@@ -1815,6 +2758,7 @@ class TaxaManager(models.Manager):
             taxa.append(taxon)
 
         self.bulk_update(taxa, ["display_name"])
+        charts.bump_data_version("taxa")
 
     # Method that returns taxa nested in a tree structure
     def tree(self, root: typing.Optional["Taxon"] = None, filter_ranks: list[TaxonRank] = []) -> dict:
@@ -1822,8 +2766,10 @@ class TaxaManager(models.Manager):
 
         root = root or self.root()
 
-        # Fetch all taxa
-        taxa = self.get_queryset().filter(active=True)
+        # Fetch all taxa in one query, inactive ones may still be needed to find the parents of filtered taxa
+        all_taxa = list(self.get_queryset())
+        taxa_by_id = {taxon.pk: taxon for taxon in all_taxa}
+        taxa = [taxon for taxon in all_taxa if taxon.active]
 
         # Build index of taxa by parent
         taxa_by_parent = collections.defaultdict(list)
@@ -1832,12 +2778,13 @@ class TaxaManager(models.Manager):
             if filter_ranks and TaxonRank(taxon.rank) not in filter_ranks:
                 continue
 
-            parent = taxon.parent or root
+            # Taxa without a parent are attached to the root, unless the tree is only a subtree
+            parent = taxon.parent or (root if not root.parent_id else None)
 
             # Attach taxa to the nearest parent with a rank that is not excluded
-            if filter_ranks and TaxonRank(parent.rank) not in filter_ranks:
+            if filter_ranks and parent and TaxonRank(parent.rank) not in filter_ranks:
                 while parent and TaxonRank(parent.rank) not in filter_ranks:
-                    parent = parent.parent
+                    parent = taxa_by_id.get(parent.parent_id) if parent.parent_id else None
 
             if parent != taxon:
                 taxa_by_parent[parent].append(taxon)
@@ -1906,6 +2853,8 @@ class Taxon(BaseModel):
     )
     # @TODO this parents field could be replaced by a cached JSON field with the proper ordering of ranks
     parents = models.ManyToManyField("self", related_name="children", symmetrical=False, blank=True)
+    # IDs of all ancestors and the taxon itself, e.g. "1/5/23/". Used to query a whole subtree with a prefix match.
+    tree_path = models.CharField(max_length=255, blank=True, default="", editable=False)
     # taxonomy = models.JSONField(null=True, blank=True)
     active = models.BooleanField(default=True)
     synonym_of = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True, related_name="synonyms")
@@ -1957,8 +2906,41 @@ class Taxon(BaseModel):
         return self.direct_children.count()
 
     def num_children_recursive(self) -> int:
-        # @TODO how to do this with a single query?
-        return self.children.count() + sum(child.num_children_recursive() for child in self.children.all())
+        return self.descendants().count()
+
+    def descendants(self) -> models.QuerySet["Taxon"]:
+        """
+        Return all taxa below this one in the tree, at any depth.
+
+        Taxa without a tree path yet (e.g. saved before the paths were filled in) follow their children instead,
+        since an empty path would match every taxon.
+        """
+        if not self.tree_path:
+            return Taxon.objects.filter(pk__in=self.descendant_ids_recursive())
+        return Taxon.objects.filter(tree_path__startswith=self.tree_path).exclude(pk=self.pk)
+
+    def descendant_ids_recursive(self) -> list[int]:
+        """
+        Return the IDs of all taxa below this one by following the parent links, one level of the tree at a time.
+        """
+        descendant_ids: list[int] = []
+        level_ids = [self.pk] if self.pk else []
+        while level_ids:
+            level_ids = list(
+                Taxon.objects.filter(parent_id__in=level_ids)
+                .exclude(pk__in=[self.pk, *descendant_ids])
+                .values_list("pk", flat=True)
+            )
+            descendant_ids.extend(level_ids)
+        return descendant_ids
+
+    def get_ancestors(self) -> list["Taxon"]:
+        """
+        Return all taxa above this one in the tree, starting from the top.
+        """
+        ancestor_ids = tree_path_ids(self.tree_path)[:-1]
+        ancestors = Taxon.objects.in_bulk(ancestor_ids)
+        return [ancestors[pk] for pk in ancestor_ids if pk in ancestors]
 
     def occurrences_count(self) -> int:
         # return self.occurrences.count()
@@ -1996,6 +2978,7 @@ class Taxon(BaseModel):
         The image should be from the detection with the highest classification score.
 
         This is used for image thumbnail previews in the species summary view.
+        Use `get_taxa_occurrence_images` to load the images of many taxa at once.
 
         The project ID is an optional filter however
         @TODO important, this should always filter by what the current user has access to.
@@ -2003,49 +2986,26 @@ class Taxon(BaseModel):
         Use the request to generate the full media URLs.
         """
 
-        classification_threshold = classification_threshold or settings.DEFAULT_CONFIDENCE_THRESHOLD
-
-        # Retrieve the URLs using a single optimized query
-        qs = (
-            self.occurrences.prefetch_related(
-                models.Prefetch(
-                    "detections__classifications",
-                    queryset=Classification.objects.filter(score__gte=classification_threshold).order_by("-score"),
-                )
-            )
-            .annotate(max_score=models.Max("detections__classifications__score"))
-            .filter(detections__classifications__score=models.F("max_score"))
-            .order_by("-max_score")
-        )
-        if project_id is not None:
-            # @TODO this should check the user's access instead
-            qs = qs.filter(project=project_id)
-
-        detection_image_paths = qs.values_list("detections__path", flat=True)[:limit]
-
-        # @TODO should this be done in the serializer?
-        # @TODO better way to get distinct values from an annotated queryset?
-        return [get_media_url(path) for path in detection_image_paths if path]
+        return get_taxa_occurrence_images(
+            [self.pk],
+            limit=limit,
+            project_id=project_id,
+            classification_threshold=classification_threshold,
+        )[self.pk]
 
     def list_names(self) -> str:
         return ", ".join(self.lists.values_list("name", flat=True))
 
     def update_parents(self, save=True):
         """
-        Populate the cached "parents" list by recursively following the "parent" field.
+        Populate the cached "parents" list from the ancestors in the tree path.
 
-        @TODO this requires the parents' parents already being up-to-date, which may not always be the case.
-        @TODO parents could instead be a JSON field that is updated by a trigger on the database.
+        Use `Taxon.objects.update_tree_paths()` to update many taxa at once.
         """
 
-        taxon = self
-        parents = [taxon.parent]
-        while parents[-1] is not None:
-            parents.append(parents[-1].parent)
-        parents = parents[:-1]
-        taxon.parents.set(parents)
+        self.parents.set(tree_path_ids(self.tree_path)[:-1])
         if save:
-            taxon.save()
+            self.save()
 
     class Meta:
         ordering = [
@@ -2061,12 +3021,136 @@ class Taxon(BaseModel):
         indexes = [
             # Add index for default ordering
             models.Index(fields=["ordering", "name"]),
+            # Supports prefix matches on the tree path, to select a whole subtree
+            models.Index(fields=["tree_path"], name="main_taxon_tree_path_idx", opclasses=["varchar_pattern_ops"]),
         ]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the parent as loaded, so the tree paths are only updated when it changes
+        instance._loaded_parent_id = instance.__dict__.get("parent_id")
+        return instance
+
     def save(self, *args, **kwargs):
-        """Update the display name before saving."""
+        """Update the display name before saving, and the tree paths after the parent changes."""
         self.display_name = self.get_display_name()
+        parent_changed = not self.tree_path or self.parent_id != getattr(self, "_loaded_parent_id", None)
+        parent_path = ""
+        if parent_changed and self.parent_id:
+            parent_path = Taxon.objects.filter(pk=self.parent_id).values_list("tree_path", flat=True).first() or ""
+            if self.pk and self.pk in tree_path_ids(parent_path):
+                raise ValidationError(f"Cannot move {self} below its own descendant #{self.parent_id}")
         super().save(*args, **kwargs)
+        if parent_changed:
+            self.update_tree_path(parent_path)
+            self._loaded_parent_id = self.parent_id
+
+    def update_tree_path(self, parent_path: str | None = None):
+        """
+        Set the tree path of this taxon from its parent, and move the paths of its descendants along with it.
+        """
+        if parent_path is None:
+            parent_path = ""
+            if self.parent_id:
+                parent_path = Taxon.objects.filter(pk=self.parent_id).values_list("tree_path", flat=True).first() or ""
+        old_path, new_path = self.tree_path, f"{parent_path}{self.pk}/"
+        if old_path == new_path:
+            return
+        if old_path:
+            # Rewrite the start of the paths of the whole subtree in one query
+            Taxon.objects.filter(tree_path__startswith=old_path).update(
+                tree_path=Concat(models.Value(new_path), Substr("tree_path", len(old_path) + 1))
+            )
+        else:
+            Taxon.objects.filter(pk=self.pk).update(tree_path=new_path)
+        self.tree_path = new_path
+
+
+def get_taxa_occurrence_images(
+    taxon_ids: typing.Iterable[int],
+    limit: int | None = 10,
+    project_id: int | None = None,
+    classification_threshold: float | None = None,
+) -> dict[int, list[str]]:
+    """
+    Return the URLs of the representative detection images for each of a list of taxa.
+
+    Each occurrence determined as a taxon, or as any taxon below it, contributes the image of its detection
+    with the highest classification score, and the best `limit` occurrences of each taxon are used. All taxa
+    are loaded in one query, a UNION of the occurrences of each subtree numbered with ROW_NUMBER().
+
+    When filtered by project, the results are cached until the project's data changes.
+    """
+    taxon_ids = list(taxon_ids)
+    classification_threshold = classification_threshold or settings.DEFAULT_CONFIDENCE_THRESHOLD
+    images: dict[int, list[str]] = {taxon_id: [] for taxon_id in taxon_ids}
+    if not taxon_ids:
+        return images
+
+    cache_keys = {}
+    if project_id is not None:
+        version = charts.get_data_version(f"project:{project_id}")
+        cache_keys = {
+            taxon_id: f"taxon:{taxon_id}:occurrence_images:{project_id}:{classification_threshold}:{limit}:{version}"
+            for taxon_id in taxon_ids
+        }
+        cached = cache.get_many(list(cache_keys.values()))
+        for taxon_id, key in cache_keys.items():
+            if key in cached:
+                images[taxon_id] = cached[key]
+        taxon_ids = [taxon_id for taxon_id in taxon_ids if cache_keys[taxon_id] not in cached]
+        if not taxon_ids:
+            return images
+
+    best_classifications = Classification.objects.filter(
+        detection__occurrence=models.OuterRef("pk"),
+        score__gte=classification_threshold,
+    ).order_by("-score", "pk")
+    tree_paths = dict(Taxon.objects.filter(pk__in=taxon_ids).values_list("pk", "tree_path"))
+    querysets = []
+    for taxon_id, tree_path in tree_paths.items():
+        # Filter each taxon's subtree and project before numbering, so the limit only counts matching images
+        qs = Occurrence.objects.order_by()
+        if tree_path:
+            qs = qs.filter(determination__tree_path__startswith=tree_path)
+        else:
+            qs = qs.filter(determination_id__in=[taxon_id, *Taxon(pk=taxon_id).descendant_ids_recursive()])
+        if project_id is not None:
+            # @TODO this should check the user's access instead
+            qs = qs.filter(project=project_id)
+        qs = (
+            qs.annotate(
+                image_taxon_id=models.Value(taxon_id, output_field=models.IntegerField()),
+                best_score=models.Subquery(best_classifications.values("score")[:1]),
+                best_path=models.Subquery(
+                    best_classifications.exclude(detection__path=None).values("detection__path")[:1]
+                ),
+            )
+            .filter(best_score__isnull=False)
+            .exclude(best_path=None)
+        )
+        if limit is not None:
+            qs = qs.annotate(
+                taxon_rank=models.Window(
+                    expression=RowNumber(),
+                    order_by=[models.F("best_score").desc(), models.F("pk").asc()],
+                )
+            ).filter(taxon_rank__lte=limit)
+        querysets.append(qs.values_list("image_taxon_id", "best_path", "best_score", "pk"))
+
+    if querysets:
+        qs = querysets[0].union(*querysets[1:], all=True).order_by("image_taxon_id", "-best_score", "pk")
+        for taxon_id, path, _, _ in qs:
+            if path:
+                images[taxon_id].append(get_media_url(path))
+
+    if cache_keys:
+        cache.set_many(
+            {cache_keys[taxon_id]: images[taxon_id] for taxon_id in taxon_ids},
+            timeout=settings.TAXON_IMAGES_CACHE_TIMEOUT,
+        )
+    return images
 
 
 @final
@@ -2084,6 +3168,15 @@ class TaxaList(BaseModel):
         verbose_name_plural = "Taxa Lists"
 
 
+@receiver(post_save, sender=Taxon)
+@receiver(post_delete, sender=Taxon)
+@receiver(post_delete, sender=TaxaList)
+@receiver(m2m_changed, sender=TaxaList.taxa.through)
+def mark_taxa_changed(sender, **kwargs):
+    # Invalidates the taxonomy trees cached for Label Studio
+    charts.bump_data_version("taxa")
+
+
 @final
 class BlogPost(BaseModel):
     """
@@ -2328,3 +3421,279 @@ class SourceImageCollection(BaseModel):
                 name="Starred Images",  # @TODO make this translatable
             )
         return collection
+
+
+def get_summary_stats_thresholds() -> list[float]:
+    """
+    The classification thresholds that summary stats are precalculated for.
+    """
+    return sorted({round(i / 10, 1) for i in range(10)} | {settings.DEFAULT_CONFIDENCE_THRESHOLD})
+
+
+def get_summary_stats_threshold(classification_threshold: float | None) -> float | None:
+    """
+    Return the precalculated threshold matching a requested threshold, or None if there isn't one.
+
+    >>> get_summary_stats_threshold(0.5)
+    0.5
+    >>> get_summary_stats_threshold(0.55) is None
+    True
+    """
+    if classification_threshold is None:
+        classification_threshold = settings.DEFAULT_CONFIDENCE_THRESHOLD
+    for threshold in get_summary_stats_thresholds():
+        if abs(threshold - classification_threshold) < 1e-9:
+            return threshold
+    return None
+
+
+@final
+class SummaryStats(BaseModel):
+    """
+    Precalculated counts for an event, a deployment, a project or everything, at a classification threshold.
+
+    Refreshed in the background after the captures, detections or occurrences of a deployment change
+    (see `refresh_summary_stats`), so views can read counts without aggregating over all occurrences.
+    """
+
+    scope = models.CharField(max_length=255, help_text='e.g. "event:1", "deployment:1", "project:1" or "all"')
+    threshold = models.FloatField()
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, null=True, related_name="summary_stats")
+    deployment = models.ForeignKey(Deployment, on_delete=models.CASCADE, null=True, related_name="summary_stats")
+    event = models.ForeignKey(Event, on_delete=models.CASCADE, null=True, related_name="summary_stats")
+
+    events_count = models.IntegerField(default=0)
+    captures_count = models.IntegerField(default=0)
+    detections_count = models.IntegerField(default=0)
+    detections_max_count = models.IntegerField(null=True)
+    detections_min_count = models.IntegerField(null=True)
+    occurrences_count = models.IntegerField(default=0)
+    taxa_count = models.IntegerField(default=0)
+    taxon_ids = models.JSONField(
+        null=True,
+        blank=True,
+        help_text="The taxa of a deployment, so the taxa of a project can be counted without scanning its occurrences",
+    )
+
+    count_fields = [
+        "events_count",
+        "captures_count",
+        "detections_count",
+        "detections_max_count",
+        "detections_min_count",
+        "occurrences_count",
+        "taxa_count",
+    ]
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["scope", "threshold"], name="unique_summary_stats"),
+        ]
+
+    def __str__(self) -> str:
+        return f"Stats for {self.scope} at {self.threshold}"
+
+    @classmethod
+    def get_for_scope(cls, scope: str, classification_threshold: float | None = None) -> "SummaryStats | None":
+        threshold = get_summary_stats_threshold(classification_threshold)
+        if threshold is None:
+            return None
+        return cls.objects.filter(scope=scope, threshold=threshold).first()
+
+    def counts(self) -> dict[str, int | None]:
+        return {field: getattr(self, field) for field in self.count_fields}
+
+
+def _summary_stats_aggregates(thresholds: list[float]) -> tuple[dict, dict]:
+    captures = {
+        # Named so they don't clash with the detections_count field on SourceImage
+        "num_captures": models.Count("pk"),
+        "num_detections": models.Sum("detections_count"),
+        "max_detections": models.Max("detections_count"),
+        "min_detections": models.Min("detections_count"),
+    }
+    occurrences = {}
+    for i, threshold in enumerate(thresholds):
+        above_threshold = Q(determination_score__gte=threshold)
+        occurrences[f"occurrences_{i}"] = models.Count("pk", filter=above_threshold)
+        occurrences[f"taxa_{i}"] = models.Count("determination", filter=above_threshold, distinct=True)
+    return captures, occurrences
+
+
+def _summary_stats_rows(
+    scope: str, thresholds: list[float], captures: dict, occurrences: dict, **kwargs
+) -> list[SummaryStats]:
+    return [
+        SummaryStats(
+            scope=scope,
+            threshold=threshold,
+            captures_count=captures.get("num_captures") or 0,
+            detections_count=captures.get("num_detections") or 0,
+            detections_max_count=captures.get("max_detections"),
+            detections_min_count=captures.get("min_detections"),
+            occurrences_count=occurrences.get(f"occurrences_{i}") or 0,
+            taxa_count=occurrences.get(f"taxa_{i}") or 0,
+            **kwargs,
+        )
+        for i, threshold in enumerate(thresholds)
+    ]
+
+
+def _save_summary_stats(rows: list[SummaryStats]):
+    SummaryStats.objects.bulk_create(
+        rows,
+        update_conflicts=True,
+        unique_fields=["scope", "threshold"],  # type: ignore
+        update_fields=SummaryStats.count_fields + ["taxon_ids", "project", "deployment", "event", "updated_at"],
+    )
+
+
+def refresh_summary_stats(deployment: Deployment, rollup: bool = True) -> int:
+    """
+    Recalculate the summary stats of a deployment and its events.
+
+    Only the captures and occurrences of the deployment are aggregated, with one grouped query each for
+    its events and one for the deployment itself, covering all thresholds at once. The stats of projects
+    and the overall totals are then added up from the stored stats of each deployment (see
+    `refresh_rollup_summary_stats`). Pass `rollup=False` when refreshing many deployments and
+    call it once afterwards.
+    """
+    thresholds = get_summary_stats_thresholds()
+    capture_aggregates, occurrence_aggregates = _summary_stats_aggregates(thresholds)
+    captures = SourceImage.objects.filter(deployment=deployment)
+    occurrences = Occurrence.objects.filter(deployment=deployment, event__isnull=False)
+    events = Event.objects.filter(deployment=deployment)
+    rows = []
+
+    # Events
+    captures_by_event = {
+        row["event_id"]: row
+        for row in captures.filter(event__isnull=False).values("event_id").annotate(**capture_aggregates)
+    }
+    occurrences_by_event = {
+        row["event_id"]: row for row in occurrences.values("event_id").annotate(**occurrence_aggregates)
+    }
+    event_ids = list(events.values_list("pk", "project_id"))
+    for event_id, project_id in event_ids:
+        rows += _summary_stats_rows(
+            f"event:{event_id}",
+            thresholds,
+            captures_by_event.get(event_id, {}),
+            occurrences_by_event.get(event_id, {}),
+            event_id=event_id,
+            deployment_id=deployment.pk,
+            project_id=project_id,
+            events_count=1,
+        )
+
+    # Deployment, with its taxa so they can be combined with the taxa of other deployments
+    max_score_by_taxon = dict(
+        occurrences.exclude(determination=None)
+        .values("determination_id")
+        .annotate(max_score=models.Max("determination_score"))
+        .values_list("determination_id", "max_score")
+    )
+    deployment_rows = _summary_stats_rows(
+        f"deployment:{deployment.pk}",
+        thresholds,
+        captures.aggregate(**capture_aggregates),
+        occurrences.aggregate(**occurrence_aggregates),
+        deployment_id=deployment.pk,
+        project_id=deployment.project_id,
+        events_count=len(event_ids),
+    )
+    for row in deployment_rows:
+        row.taxon_ids = sorted(
+            taxon_id for taxon_id, score in max_score_by_taxon.items() if score is not None and score >= row.threshold
+        )
+    rows += deployment_rows
+
+    _save_summary_stats(rows)
+    logger.info(f"Refreshed {len(rows)} summary stats for {deployment}")
+    if rollup:
+        refresh_rollup_summary_stats()
+    return len(rows)
+
+
+def refresh_rollup_summary_stats() -> int:
+    """
+    Add up the stored stats of all deployments into the stats of each project and the overall totals.
+
+    This reads one row per deployment and threshold, instead of aggregating over all captures and occurrences.
+    Projects with a deployment that has no stats yet are skipped and their stats are removed, so views
+    count them live until the stats of all of their deployments exist. The same goes for the overall totals.
+    """
+    thresholds = get_summary_stats_thresholds()
+    totals: dict[tuple[int | None, float], dict] = {}
+    project_ids = set(Project.objects.values_list("pk", flat=True))
+    deployment_projects = dict(Deployment.objects.values_list("pk", "project_id"))
+    deployment_thresholds: dict[int, set[float]] = collections.defaultdict(set)
+
+    def add(key: tuple[int | None, float], stats: SummaryStats):
+        total = totals.setdefault(
+            key,
+            {
+                "events_count": 0,
+                "captures_count": 0,
+                "detections_count": 0,
+                "detections_max_count": None,
+                "detections_min_count": None,
+                "occurrences_count": 0,
+                "taxon_ids": set(),
+            },
+        )
+        for field in ["events_count", "captures_count", "detections_count", "occurrences_count"]:
+            total[field] += getattr(stats, field)
+        if stats.detections_max_count is not None:
+            total["detections_max_count"] = max(total["detections_max_count"] or 0, stats.detections_max_count)
+        if stats.detections_min_count is not None:
+            current = total["detections_min_count"]
+            total["detections_min_count"] = (
+                stats.detections_min_count if current is None else min(current, stats.detections_min_count)
+            )
+        total["taxon_ids"].update(stats.taxon_ids or [])
+
+    deployment_stats = SummaryStats.objects.filter(
+        deployment__isnull=False, event__isnull=True, threshold__in=thresholds
+    ).only(*SummaryStats.count_fields, "taxon_ids", "threshold", "deployment_id")
+    for stats in deployment_stats:
+        if stats.deployment_id not in deployment_projects:
+            continue
+        deployment_thresholds[stats.deployment_id].add(stats.threshold)
+        # Use the current project of the deployment, in case it was moved since its stats were saved
+        project_id = deployment_projects[stats.deployment_id]
+        if project_id in project_ids:
+            add((project_id, stats.threshold), stats)
+        add((None, stats.threshold), stats)
+
+    incomplete = {
+        project_id
+        for deployment_id, project_id in deployment_projects.items()
+        if len(deployment_thresholds[deployment_id]) < len(thresholds)
+    }
+    scopes: list[int | None] = [project_id for project_id in project_ids if project_id not in incomplete]
+    stale_scopes = [f"project:{project_id}" for project_id in incomplete if project_id]
+    if incomplete:
+        logger.info(f"Skipping summary stats of projects with deployments that have no stats yet: {incomplete}")
+        stale_scopes.append("all")
+    else:
+        scopes.append(None)
+    SummaryStats.objects.filter(scope__in=stale_scopes).delete()
+
+    rows = []
+    for project_id in scopes:
+        for threshold in thresholds:
+            total = totals.get((project_id, threshold)) or {"taxon_ids": set()}
+            taxon_ids = total.pop("taxon_ids")
+            rows.append(
+                SummaryStats(
+                    scope=f"project:{project_id}" if project_id else "all",
+                    threshold=threshold,
+                    project_id=project_id,
+                    taxa_count=len(taxon_ids),
+                    **total,
+                )
+            )
+    _save_summary_stats(rows)
+    logger.info(f"Refreshed {len(rows)} summary stats for projects and overall totals")
+    return len(rows)
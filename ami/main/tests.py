@@ -1,24 +1,43 @@
+import concurrent.futures
+import dataclasses
 import datetime
+import hashlib
+import io
+import os
+import tempfile
 import uuid
+from unittest import mock
 
-from django.db import connection
-from django.test import TestCase
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, models
+from django.test import TestCase, override_settings
+from PIL import Image
 from rest_framework.test import APIRequestFactory, APITestCase
 from rich import print
 
+import ami.tasks
+import ami.utils.s3
 from ami.main.models import (
+    Classification,
     Deployment,
     Detection,
     Event,
     Occurrence,
     Project,
+    S3StorageSource,
     SourceImage,
     TaxaList,
     Taxon,
     TaxonRank,
+    create_image_derivatives,
     group_images_into_events,
+    queue_image_derivatives,
+    set_dimensions_for_events,
+    update_detection_counts,
 )
 from ami.users.models import User
+from ami.utils.file_cache import FileCache
 
 
 def setup_test_project(reuse=True) -> tuple[Project, Deployment]:
@@ -154,6 +173,52 @@ class TestImageGrouping(TestCase):
 
         assert remaining_events.count() == 0
 
+    def test_regroup_merges_neighbouring_events(self):
+        night = datetime.datetime(2024, 1, 1, 22, 0)
+        for minutes in [0, 10, 20, 150, 160, 170]:
+            SourceImage.objects.create(
+                deployment=self.deployment,
+                timestamp=night + datetime.timedelta(minutes=minutes),
+                path=f"test/merge_{minutes}.jpg",
+            )
+        events = group_images_into_events(deployment=self.deployment, max_time_gap=datetime.timedelta(hours=2))
+        self.assertEqual(len(events), 2)
+
+        # A new capture closes the gap between the two events
+        new_capture = SourceImage.objects.create(
+            deployment=self.deployment,
+            timestamp=night + datetime.timedelta(minutes=85),
+            path="test/merge_85.jpg",
+        )
+        events = group_images_into_events(
+            deployment=self.deployment,
+            max_time_gap=datetime.timedelta(hours=2),
+            start=new_capture.timestamp,
+            end=new_capture.timestamp,
+        )
+        self.assertEqual(len(events), 1)
+        event = events[0]
+        self.assertEqual(event.captures.count(), 7)
+        self.assertEqual(event.start, night)
+        self.assertEqual(event.end, night + datetime.timedelta(minutes=170))
+        self.assertEqual(Event.objects.filter(deployment=self.deployment).count(), 1)
+
+    def test_pruning_empty_events_for_deployment(self):
+        from ami.main.models import delete_empty_events
+
+        other_deployment = Deployment.objects.create(name="Other Deployment", project=self.project)
+        other_event = Event.objects.create(
+            deployment=other_deployment, group_by="2024-01-01", start=datetime.datetime(2024, 1, 1)
+        )
+        event = Event.objects.create(
+            deployment=self.deployment, group_by="2024-01-01", start=datetime.datetime(2024, 1, 1)
+        )
+
+        delete_empty_events(deployment=self.deployment)
+
+        self.assertFalse(Event.objects.filter(pk=event.pk).exists())
+        self.assertTrue(Event.objects.filter(pk=other_event.pk).exists())
+
     def test_setting_image_dimensions(self):
         from ami.main.models import set_dimensions_for_collection
 
@@ -197,6 +262,894 @@ class TestImageGrouping(TestCase):
 #             sync_source_images(deployment.pk)
 
 
+class FakeS3Paginator:
+    def __init__(self, keys: list[str], requests: list[dict]):
+        self.keys = keys
+        self.requests = requests
+
+    def paginate(self, Bucket, Prefix, Delimiter=None, StartAfter="", PageSize=3):
+        self.requests.append({"Prefix": Prefix, "Delimiter": Delimiter, "StartAfter": StartAfter})
+        keys = sorted(key for key in self.keys if key.startswith(Prefix) and key > StartAfter)
+        if Delimiter:
+            names = [key.removeprefix(Prefix) for key in keys]
+            prefixes = sorted({Prefix + name.split("/")[0] + "/" for name in names if "/" in name})
+            contents = [{"Key": Prefix + name, "Size": 1} for name in names if "/" not in name]
+            yield {"CommonPrefixes": [{"Prefix": prefix} for prefix in prefixes], "Contents": contents}
+        else:
+            for i in range(0, len(keys), PageSize):
+                yield {"Contents": [{"Key": key, "Size": 1} for key in keys[i : i + PageSize]]}  # noqa: E203
+
+
+class FakeS3Client:
+    def __init__(self, keys: list[str], objects: dict[str, bytes] | None = None):
+        self.keys = keys
+        self.objects = objects or {}
+        self.requests = []
+
+    def get_paginator(self, name):
+        return FakeS3Paginator(self.keys, self.requests)
+
+    def put_object(self, Bucket, Key, Body):
+        self.keys.append(Key)
+        self.objects[Key] = Body
+        return {}
+
+    def get_object(self, Bucket, Key, Range=None):
+        body = self.objects[Key]
+        if Range:
+            start, end = Range.removeprefix("bytes=").split("-")
+            body = body[int(start) : int(end) + 1]  # noqa: E203
+        self.requests.append({"Key": Key, "Range": Range, "Length": len(body)})
+        return {"Body": io.BytesIO(body), "ETag": f'"{hashlib.md5(self.objects[Key]).hexdigest()}"'}
+
+    def head_object(self, Bucket, Key):
+        self.requests.append({"Key": Key, "Method": "HEAD"})
+        return {"ETag": f'"{hashlib.md5(self.objects[Key]).hexdigest()}"'}
+
+
+class TestIncrementalSync(TestCase):
+    def setUp(self) -> None:
+        self.project, self.deployment = setup_test_project(reuse=False)
+        self.deployment.data_source = S3StorageSource.objects.create(
+            name="Test Source", bucket="test", access_key="", secret_key="", project=self.project
+        )
+        self.deployment.save(update_calculated_fields=False)
+        self.client = FakeS3Client(
+            [f"2024010{night}/2024010{night}22{minute:02d}00.jpg" for night in range(1, 4) for minute in range(5)]
+        )
+        return super().setUp()
+
+    def sync(self, **kwargs) -> int:
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.client), mock.patch(
+            "ami.tasks.regroup_events.delay"
+        ) as regroup, mock.patch("ami.tasks.create_image_derivatives.delay") as derivatives:
+            total = self.deployment.sync_captures(**kwargs)
+        self.regroup = regroup
+        self.derivatives = derivatives
+        return total
+
+    def test_incremental_sync(self):
+        for max_workers in [1, 4]:
+            with self.subTest(max_workers=max_workers):
+                SourceImage.objects.filter(deployment=self.deployment).delete()
+                self.deployment.data_source_watermarks = {}
+                self.client.keys = self.client.keys[:15]
+
+                self.assertEqual(self.sync(max_workers=max_workers), 15)
+                self.assertEqual(self.deployment.captures.count(), 15)
+                # The thumbnails are created in the background
+                self.derivatives.assert_called_once()
+
+                # Nothing new
+                self.assertEqual(self.sync(max_workers=max_workers, incremental=True), 0)
+                self.regroup.assert_not_called()
+
+                # A few more images from the last night, and a new night.
+                # The thumbnails in the same bucket are not imported.
+                self.client.keys += [
+                    "20240103/20240103230000.jpg",
+                    "20240104/20240104220000.jpg",
+                    "derivatives/thumbnails/512/20240101/20240101220000.jpg",
+                ]
+                self.assertEqual(self.sync(max_workers=max_workers, incremental=True), 2)
+                self.assertEqual(self.deployment.captures.count(), 17)
+                # Only the thumbnails of the new captures are queued
+                new_captures = self.deployment.captures.filter(
+                    path__in=["20240103/20240103230000.jpg", "20240104/20240104220000.jpg"]
+                )
+                self.derivatives.assert_called_once_with(sorted(new_captures.values_list("pk", flat=True)))
+                self.regroup.assert_called_once_with(
+                    self.deployment.pk,
+                    start=datetime.datetime(2024, 1, 3, 23, 0).isoformat(),
+                    end=datetime.datetime(2024, 1, 4, 22, 0).isoformat(),
+                )
+                if max_workers > 1:
+                    # Prefixes that were completely listed before are skipped
+                    listed_prefixes = {request["Prefix"] for request in self.client.requests[-3:]}
+                    self.assertNotIn("20240101/", listed_prefixes)
+
+    def test_incremental_sync_of_lagging_prefix(self):
+        # The watermarks of a concurrent listing are kept per prefix
+        self.sync(max_workers=4)
+        self.assertEqual(len(self.deployment.data_source_watermarks), 3)
+
+        # New keys under an older prefix are still found by a single listing
+        self.client.keys += ["20240101/20240101230000.jpg", "20240103/20240103230000.jpg"]
+        self.sync(max_workers=1, incremental=True)
+        self.assertEqual(self.deployment.captures.count(), 17)
+        self.assertEqual(self.derivatives.call_count, 1)
+        self.assertEqual(len(self.derivatives.call_args.args[0]), 2)
+        self.assertEqual(self.deployment.data_source_watermarks, {"": "20240103/20240103230000.jpg"})
+
+        # Nothing new
+        self.assertEqual(self.sync(max_workers=1, incremental=True), 0)
+
+    def test_watermarks_are_reset(self):
+        self.sync(max_workers=1)
+        self.assertTrue(self.deployment.data_source_watermarks)
+
+        # Unrelated changes keep the watermarks
+        self.deployment.name = "Renamed"
+        self.deployment.save(update_calculated_fields=False)
+        self.deployment.refresh_from_db()
+        self.assertTrue(self.deployment.data_source_watermarks)
+
+        deployment = Deployment.objects.get(pk=self.deployment.pk)
+        deployment.data_source_regex = ".*\\.jpg$"
+        deployment.save(update_calculated_fields=False, update_fields=["data_source_regex"])
+        deployment.refresh_from_db()
+        self.assertEqual(deployment.data_source_watermarks, {})
+
+        self.deployment.refresh_from_db()
+        self.sync(max_workers=1)
+        self.assertTrue(self.deployment.data_source_watermarks)
+        self.deployment.data_source.prefix = "other"
+        self.deployment.data_source.save()
+        self.deployment.refresh_from_db()
+        self.assertEqual(self.deployment.data_source_watermarks, {})
+
+    def test_incremental_sync_task(self):
+        self.sync(max_workers=1)
+        with mock.patch("ami.main.models.Deployment.sync_captures") as sync_captures:
+            ami.tasks.sync_source_images(self.deployment.pk, incremental=True)
+        sync_captures.assert_called_once_with(incremental=True)
+
+    def test_timestamps_from_exif(self):
+        exif = Image.Exif()
+        exif[0x0132] = "2024:01:05 22:30:00"  # DateTime
+        image = Image.new("RGB", (64, 48))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", exif=exif.tobytes())
+        self.client.keys = ["20240105/20240105220000.jpg", "20240105/IMG_0001.jpg", "20240105/IMG_0002.jpg"]
+        self.client.objects = {"20240105/IMG_0001.jpg": buffer.getvalue()}
+
+        with self.assertLogs("ami.main.models", level="WARNING") as logs:
+            self.assertEqual(self.sync(max_workers=1), 3)
+        self.assertIn("Could not find timestamps for 1 new files", "\n".join(logs.output))
+        captures = {capture.path: capture.timestamp for capture in self.deployment.captures.all()}
+        self.assertEqual(captures["20240105/20240105220000.jpg"], datetime.datetime(2024, 1, 5, 22, 0))
+        self.assertEqual(captures["20240105/IMG_0001.jpg"], datetime.datetime(2024, 1, 5, 22, 30))
+        self.assertIsNone(captures["20240105/IMG_0002.jpg"])
+
+        # The EXIF data of files that were synced before is not read again
+        self.client.requests.clear()
+        self.sync(max_workers=1)
+        self.assertEqual([request for request in self.client.requests if "Range" in request], [])
+
+    def test_timestamps_from_other_filename_formats(self):
+        # Names without a YYYYMMDDHHMMSS timestamp are still parsed from the filename, before reading EXIF data
+        self.client.keys = ["20240105/20240105220000.jpg", "20240105/20240105-223000.jpg"]
+        self.assertEqual(self.sync(max_workers=1), 2)
+        captures = {capture.path: capture.timestamp for capture in self.deployment.captures.all()}
+        self.assertEqual(captures["20240105/20240105-223000.jpg"], datetime.datetime(2024, 1, 5, 22, 30))
+        self.assertEqual([request for request in self.client.requests if "Range" in request], [])
+
+    def test_regroup_time_range(self):
+        create_captures(deployment=self.deployment, num_nights=3, images_per_night=3, interval_minutes=10)
+        events = group_images_into_events(deployment=self.deployment)
+        last_event = events[-1]
+        new_capture = SourceImage.objects.create(
+            deployment=self.deployment,
+            timestamp=last_event.end + datetime.timedelta(minutes=10),
+            path="test/new.jpg",
+        )
+        regrouped = group_images_into_events(
+            deployment=self.deployment, start=new_capture.timestamp, end=new_capture.timestamp
+        )
+        self.assertEqual([event.pk for event in regrouped], [last_event.pk])
+        new_capture.refresh_from_db()
+        self.assertEqual(new_capture.event, last_event)
+
+
+def create_image_file(width: int, height: int, format: str = "JPEG", exif_size: int = 0) -> bytes:
+    image = Image.new("RGB", (width, height), color="white")
+    buffer = io.BytesIO()
+    if exif_size:
+        exif = Image.Exif()
+        exif[0x010E] = "x" * exif_size  # ImageDescription
+        image.save(buffer, format=format, exif=exif.tobytes())
+    else:
+        image.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+class TestImageDimensions(TestCase):
+    def setUp(self) -> None:
+        self.project, self.deployment = setup_test_project(reuse=False)
+        self.deployment.data_source = S3StorageSource.objects.create(
+            name="Test Source", bucket="test", access_key="", secret_key="", project=self.project
+        )
+        self.deployment.save(update_calculated_fields=False)
+        self.images = create_captures(deployment=self.deployment, num_nights=3, images_per_night=3)
+        self.client = FakeS3Client([], {image.path: create_image_file(640, 480) for image in self.images})
+        return super().setUp()
+
+    def test_read_image_dimensions(self):
+        config = self.deployment.data_source.config
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.client):
+            # The header is further into the file when there is a large EXIF block
+            self.client.objects["large.jpg"] = create_image_file(640, 480, exif_size=40000)
+            self.assertEqual(ami.utils.s3.read_image_dimensions(config, "large.jpg"), (640, 480))
+            self.assertEqual(
+                [request["Range"] for request in self.client.requests], ["bytes=0-16383", "bytes=0-65535"]
+            )
+
+            self.client.objects["image.png"] = create_image_file(64, 48, format="PNG")
+            self.assertEqual(ami.utils.s3.read_image_dimensions(config, "image.png"), (64, 48))
+
+            self.client.objects["not-an-image.jpg"] = b"not an image"
+            with self.assertRaises(OSError):
+                ami.utils.s3.read_image_dimensions(config, "not-an-image.jpg")
+
+    def test_set_dimensions_for_events(self):
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.client):
+            events = group_images_into_events(deployment=self.deployment)
+        # Only the first image of each event is read
+        self.assertEqual(len(self.client.requests), len(events))
+        self.assertEqual(SourceImage.objects.filter(deployment=self.deployment, width=640, height=480).count(), 9)
+
+    def test_mixed_dimensions(self):
+        last_image = self.images[-1]
+        self.client.objects[last_image.path] = create_image_file(320, 240)
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.client), mock.patch(
+            "ami.main.models.set_dimensions_for_events"
+        ):
+            events = group_images_into_events(deployment=self.deployment)
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.client):
+            dimensions = set_dimensions_for_events(events, sample_size=3)
+
+        self.assertEqual(dimensions[events[0].pk], (640, 480))
+        self.assertIsNone(dimensions[events[-1].pk])
+        # Only the images that were read are updated in the event with mixed dimensions
+        last_image.refresh_from_db()
+        self.assertEqual((last_image.width, last_image.height), (320, 240))
+        self.assertEqual(events[-1].captures.filter(width=640).count(), 2)
+        self.assertEqual(events[0].captures.filter(width=640).count(), 3)
+
+
+class TestImageDerivatives(TestCase):
+    def setUp(self) -> None:
+        self.project, self.deployment = setup_test_project(reuse=False)
+        self.deployment.data_source = S3StorageSource.objects.create(
+            name="Test Source",
+            bucket="test",
+            access_key="",
+            secret_key="",
+            public_base_url="https://example.com/test/",
+            project=self.project,
+        )
+        self.deployment.save(update_calculated_fields=False)
+        self.images = create_captures(deployment=self.deployment, num_nights=1, images_per_night=2)
+        self.s3_client = FakeS3Client([], {image.path: create_image_file(1024, 768) for image in self.images})
+        self.detection = Detection.objects.create(source_image=self.images[0], bbox=[10, 20, 110, 220])
+        return super().setUp()
+
+    def test_create_image_derivatives(self):
+        images = SourceImage.objects.filter(deployment=self.deployment)
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.s3_client):
+            self.assertEqual(create_image_derivatives(images, thumbnail_size=512), 2)
+
+            image = SourceImage.objects.get(pk=self.images[0].pk)
+            self.assertEqual(image.thumbnail_path, f"derivatives/thumbnails/512/{image.path}")
+            self.assertEqual(
+                image.thumbnail_url(), f"https://example.com/test/derivatives/thumbnails/512/{image.path}"
+            )
+            thumbnail = Image.open(io.BytesIO(self.s3_client.objects[image.thumbnail_path]))
+            self.assertEqual(thumbnail.size, (512, 384))
+
+            self.detection.refresh_from_db()
+            crop_key = "derivatives/crops/test/0_0/10-20-110-220.jpg"
+            self.assertEqual(self.detection.url(), f"https://example.com/test/{crop_key}")
+            self.assertEqual(Image.open(io.BytesIO(self.s3_client.objects[crop_key])).size, (100, 200))
+
+            # Only missing derivatives are created
+            self.s3_client.requests.clear()
+            self.assertEqual(create_image_derivatives(images, thumbnail_size=512), 0)
+            self.assertEqual(self.s3_client.requests, [])
+            self.assertEqual(create_image_derivatives(images, thumbnail_size=256), 2)
+
+    def test_thumbnail_urls(self):
+        url = f"/api/v2/captures/?deployment={self.deployment.pk}"
+        thumbnail_endpoint = f"/api/v2/captures/{self.images[0].pk}/thumbnail/"
+        # The original image is shown until the thumbnail is created
+        response = self.client.get(url)
+        self.assertEqual(response.json()["results"][0]["thumbnail_url"], self.images[0].public_url())
+
+        # The endpoint only queues the thumbnail, once
+        with mock.patch("ami.tasks.create_image_derivatives.delay") as delay:
+            response = self.client.get(thumbnail_endpoint)
+            self.assertRedirects(response, self.images[0].public_url(), fetch_redirect_response=False)
+            self.client.get(thumbnail_endpoint)
+        delay.assert_called_once_with([self.images[0].pk])
+
+        with mock.patch("ami.utils.s3.get_client", lambda config: self.s3_client):
+            create_image_derivatives(SourceImage.objects.filter(pk=self.images[0].pk))
+        image = SourceImage.objects.get(pk=self.images[0].pk)
+        response = self.client.get(url)
+        self.assertEqual(response.json()["results"][0]["thumbnail_url"], image.thumbnail_url())
+        self.assertEqual(response.json()["results"][1]["thumbnail_url"], self.images[1].public_url())
+        with mock.patch("ami.tasks.create_image_derivatives.delay") as delay:
+            response = self.client.get(thumbnail_endpoint)
+        self.assertRedirects(response, image.thumbnail_url(), fetch_redirect_response=False)
+        delay.assert_not_called()
+
+    def test_queue_image_derivatives(self):
+        self.images[0].thumbnail_path = "derivatives/thumbnails/512/image.jpg"
+        self.images[0].save(update_calculated_fields=False)
+        with mock.patch("ami.tasks.create_image_derivatives.delay") as delay:
+            self.assertEqual(queue_image_derivatives(self.deployment.captures.all(), batch_size=1), 1)
+        delay.assert_called_once_with([self.images[1].pk])
+
+
+class TestFileCache(TestCase):
+    def setUp(self) -> None:
+        self.project, self.deployment = setup_test_project(reuse=False)
+        self.deployment.data_source = S3StorageSource.objects.create(
+            name="Test Source", bucket="test", access_key="", secret_key="", project=self.project
+        )
+        self.deployment.save(update_calculated_fields=False)
+        self.images = create_captures(deployment=self.deployment, num_nights=1, images_per_night=2)
+        self.s3_client = FakeS3Client([], {image.path: create_image_file(640, 480) for image in self.images})
+        for image in self.images:
+            image.checksum = hashlib.md5(self.s3_client.objects[image.path]).hexdigest()
+            image.save(update_calculated_fields=False)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        return super().setUp()
+
+    def tearDown(self) -> None:
+        self.cache_dir.cleanup()
+        return super().tearDown()
+
+    def test_originals_are_downloaded_once(self):
+        images = SourceImage.objects.filter(deployment=self.deployment)
+        with override_settings(S3_CACHE_DIR=self.cache_dir.name), mock.patch(
+            "ami.utils.s3.get_client", lambda config: self.s3_client
+        ):
+            create_image_derivatives(images, thumbnail_size=512)
+            self.assertEqual(len(self.s3_client.requests), 2)
+            cache = ami.utils.s3.get_file_cache()
+            assert cache
+            stats = cache.stats()
+
+            # Later stages read the originals from the local cache
+            self.s3_client.requests.clear()
+            create_image_derivatives(images, thumbnail_size=256)
+            self.assertEqual(images[0].get_dimensions(), (640, 480))
+            self.assertEqual(self.s3_client.requests, [])
+            self.assertEqual(cache.stats()["hits"] - stats["hits"], 3)
+
+            # Without the ETag it is looked up first
+            config = self.deployment.data_source.config
+            self.assertEqual(
+                ami.utils.s3.read_file(config, self.images[0].path), self.s3_client.objects[images[0].path]
+            )
+            self.assertEqual([request.get("Method") for request in self.s3_client.requests], ["HEAD"])
+
+            # A changed file is downloaded again
+            self.s3_client.objects[self.images[0].path] = create_image_file(320, 240)
+            self.assertEqual(ami.utils.s3.read_image(config, self.images[0].path).size, (320, 240))
+
+    def test_eviction(self):
+        cache = FileCache(self.cache_dir.name, max_bytes=130)
+        for i in range(3):
+            cache.set(b"x" * 40, "bucket", f"key-{i}", "etag")
+            os.utime(cache.path("bucket", f"key-{i}", "etag"), (1000 + i, 1000 + i))
+        # Reading a file makes it the most recently used
+        self.assertIsNotNone(cache.get("bucket", "key-0", "etag"))
+
+        cache.set(b"x" * 40, "bucket", "key-3", "etag")
+        self.assertIsNotNone(cache.get("bucket", "key-0", "etag"))
+        self.assertIsNone(cache.get("bucket", "key-1", "etag"))
+        self.assertIsNone(cache.get("bucket", "key-2", "etag"))
+        self.assertIsNotNone(cache.get("bucket", "key-3", "etag"))
+        self.assertEqual(cache.stats()["evictions"], 2)
+
+    def test_temporary_files_are_removed(self):
+        cache = FileCache(self.cache_dir.name, max_bytes=1000)
+        path = cache.path("bucket", "key", "etag")
+        with mock.patch("os.replace", side_effect=OSError("No space left on device")):
+            cache.set(b"x" * 40, "bucket", "key", "etag")
+        self.assertEqual(list(path.parent.iterdir()), [])
+
+        # Files left behind by a process that crashed while writing are removed once they are old
+        recent = path.parent / ".tmp-recent"
+        stale = path.parent / ".tmp-stale"
+        recent.write_bytes(b"x")
+        stale.write_bytes(b"x")
+        os.utime(stale, (1000, 1000))
+        cache.evict()
+        self.assertEqual(list(path.parent.iterdir()), [recent])
+
+
+class TestS3Clients(TestCase):
+    def setUp(self) -> None:
+        ami.utils.s3.clear_clients()
+        self.config = ami.utils.s3.S3Config(
+            endpoint_url="http://localhost:9000",
+            access_key_id="test",
+            secret_access_key="test",
+            bucket_name="test",
+            prefix="",
+        )
+        return super().setUp()
+
+    def test_clients_are_shared(self):
+        stats = ami.utils.s3.client_stats()
+        client = ami.utils.s3.get_client(self.config)
+        self.assertIs(ami.utils.s3.get_client(dataclasses.replace(self.config, bucket_name="other")), client)
+        self.assertIs(ami.utils.s3.get_resource(self.config).meta.client, client)
+        self.assertEqual(client.meta.config.max_pool_connections, settings.S3_MAX_POOL_CONNECTIONS)
+        other_client = ami.utils.s3.get_client(dataclasses.replace(self.config, access_key_id="other"))
+        self.assertIsNot(other_client, client)
+
+        new_stats = ami.utils.s3.client_stats()
+        self.assertEqual(new_stats["clients"], 2)
+        self.assertEqual(new_stats["created"] - stats["created"], 2)
+        self.assertEqual(new_stats["reused"] - stats["reused"], 2)
+
+    def test_clients_are_shared_between_threads(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            clients = list(executor.map(lambda _: ami.utils.s3.get_client(self.config), range(8)))
+        self.assertEqual(len({id(client) for client in clients}), 1)
+
+
+class TestDeploymentCalculatedFields(TestCase):
+    def setUp(self) -> None:
+        from django.core.cache import cache
+
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.project, self.deployment = setup_test_project(reuse=False)
+        # Forget the marks made while creating the deployment
+        self.deployment.stale_marks.all().delete()
+        cache.clear()
+        return super().setUp()
+
+    def test_recompute_stale_fields(self):
+        from ami.tasks import update_deployment_calculated_fields
+
+        # The marks are saved once the transaction commits
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                create_captures(deployment=self.deployment, num_nights=2, images_per_night=2)
+
+        self.assertEqual(update_deployment_calculated_fields(self.deployment.pk), ["captures"])
+        self.deployment.refresh_from_db()
+        self.assertEqual(self.deployment.captures_count, 4)
+        self.assertIsNotNone(self.deployment.first_capture_timestamp)
+        # Fields that were not marked as stale are left alone
+        self.assertIsNone(self.deployment.events_count)
+
+        # Nothing left to do
+        self.assertEqual(update_deployment_calculated_fields(self.deployment.pk), [])
+
+    def test_recompute_is_debounced(self):
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async") as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                create_captures(deployment=self.deployment, num_nights=2, images_per_night=3)
+                group_images_into_events(deployment=self.deployment)
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.args[0], (self.deployment.pk,))
+        self.assertEqual(
+            set(self.deployment.stale_marks.values_list("aggregate", flat=True)),
+            {"captures", "events", "occurrences"},
+        )
+
+    def test_marks_after_savepoint_rollback(self):
+        from django.db import transaction
+
+        from ami.main.models import mark_deployment_stale
+
+        # Marks made after a rolled back savepoint are still saved
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                try:
+                    with transaction.atomic():
+                        mark_deployment_stale(self.deployment.pk, "events")
+                        raise ValueError
+                except ValueError:
+                    pass
+                mark_deployment_stale(self.deployment.pk, "detections")
+        self.assertIn("detections", self.deployment.stale_marks.values_list("aggregate", flat=True))
+
+    def test_marks_without_signals(self):
+        from ami.main.models import Detection, _stale_marks, mark_source_images_stale
+
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+            # The deployments of source images are looked up once, for all of the marks in the transaction
+            with mock.patch.object(_stale_marks, "_flush", wraps=_stale_marks._flush) as flush:
+                with self.captureOnCommitCallbacks(execute=True):
+                    captures = create_captures(deployment=self.deployment, num_nights=1, images_per_night=2)
+                    mark_source_images_stale([capture.pk for capture in captures], "detections")
+            flush.assert_called_once()
+            self.assertEqual(
+                set(self.deployment.stale_marks.values_list("aggregate", flat=True)), {"captures", "detections"}
+            )
+            self.deployment.stale_marks.all().delete()
+
+            # Deleting an instance marks its deployment, without slowing down cascading deletes
+            with self.captureOnCommitCallbacks(execute=True):
+                detection = Detection.objects.create(source_image=captures[0])
+            self.deployment.stale_marks.all().delete()
+            with self.captureOnCommitCallbacks(execute=True):
+                captures[0].delete()
+            self.assertFalse(Detection.objects.filter(pk=detection.pk).exists())
+        self.assertIn("captures", self.deployment.stale_marks.values_list("aggregate", flat=True))
+
+
+class TestSummaryStats(TestCase):
+    def setUp(self) -> None:
+        self.project, self.deployment = setup_test_project(reuse=False)
+        create_taxa(project=self.project)
+        create_captures(deployment=self.deployment, num_nights=2, images_per_night=3)
+        group_images_into_events(deployment=self.deployment)
+        create_occurrences(deployment=self.deployment, num=4)
+        update_detection_counts()
+        return super().setUp()
+
+    def test_refresh_summary_stats(self):
+        from ami.main.models import SummaryStats, refresh_summary_stats
+
+        refresh_summary_stats(self.deployment)
+        event = Event.objects.filter(deployment=self.deployment, occurrences__isnull=False).first()
+        assert event
+
+        with self.assertNumQueries(1):
+            self.assertEqual(event.occurrences_count(), 4)
+        self.assertEqual(event.occurrences_count(classification_threshold=0.95), 0)
+        self.assertEqual(event.taxa_count(), Taxon.objects.filter(occurrences__event=event).distinct().count())
+        self.assertEqual(event.detections_count(), 4)
+
+        project_stats = SummaryStats.get_for_scope(f"project:{self.project.pk}")
+        assert project_stats
+        self.assertEqual(project_stats.events_count, 2)
+        self.assertEqual(project_stats.captures_count, 6)
+        self.assertEqual(project_stats.occurrences_count, 4)
+
+        # Refreshing again updates the existing rows
+        num_rows = SummaryStats.objects.count()
+        Occurrence.objects.filter(event=event).first().delete()
+        refresh_summary_stats(self.deployment)
+        self.assertEqual(SummaryStats.objects.count(), num_rows)
+        self.assertEqual(event.occurrences_count(), 3)
+
+    def test_project_stats_are_added_up(self):
+        from ami.main.models import SummaryStats, refresh_summary_stats
+
+        other = Deployment.objects.create(project=self.project, name="Other deployment")
+        create_captures(deployment=other, num_nights=1, images_per_night=2)
+        group_images_into_events(deployment=other)
+        create_occurrences(deployment=other, num=3)
+        refresh_summary_stats(self.deployment)
+        # The other deployment has no stats yet, so the project and overall totals are still counted live
+        self.assertIsNone(SummaryStats.get_for_scope(f"project:{self.project.pk}"))
+        self.assertIsNone(SummaryStats.get_for_scope("all"))
+
+        # Only the deployment's own captures and occurrences are aggregated
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            refresh_summary_stats(other)
+        unscoped = [
+            query["sql"]
+            for query in queries
+            if ("main_occurrence" in query["sql"] or "main_sourceimage" in query["sql"])
+            and '"deployment_id" = ' not in query["sql"]
+        ]
+        self.assertEqual(unscoped, [])
+
+        project_stats = SummaryStats.get_for_scope(f"project:{self.project.pk}")
+        assert project_stats
+        self.assertEqual(project_stats.events_count, 3)
+        self.assertEqual(project_stats.captures_count, 8)
+        self.assertEqual(project_stats.occurrences_count, 7)
+        self.assertEqual(
+            project_stats.taxa_count,
+            Taxon.objects.filter(occurrences__project=self.project).distinct().count(),
+        )
+        all_stats = SummaryStats.get_for_scope("all")
+        assert all_stats
+        self.assertEqual(all_stats.occurrences_count, Occurrence.objects.filter(event__isnull=False).count())
+
+    def test_summary_view_reads_stats(self):
+        from ami.main.models import refresh_summary_stats
+
+        refresh_summary_stats(self.deployment)
+        response = self.client.get("/api/v2/status/summary/", {"project": self.project.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["occurrences_count"], 4)
+        self.assertEqual(response.json()["captures_count"], 6)
+
+
+class TestChartCache(TestCase):
+    def setUp(self) -> None:
+        from django.core.cache import cache
+
+        cache.clear()
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.project, self.deployment = setup_test_project(reuse=False)
+                create_captures(deployment=self.deployment, num_nights=2, images_per_night=3)
+                group_images_into_events(deployment=self.deployment)
+        return super().setUp()
+
+    def test_charts_are_cached_until_data_changes(self):
+        from ami.main import charts
+        from ami.tasks import update_deployment_calculated_fields
+
+        first = self.project.summary_data()
+        with mock.patch(
+            "ami.main.charts.captures_per_hour", wraps=charts.captures_per_hour, __name__="captures_per_hour"
+        ) as chart:
+            self.assertEqual(self.project.summary_data(), first)
+            chart.assert_not_called()
+
+            with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    for i in range(2):
+                        SourceImage.objects.create(
+                            deployment=self.deployment, timestamp=datetime.datetime.now(), path=f"test/new_{i}.jpg"
+                        )
+            update_deployment_calculated_fields(self.deployment.pk)
+            updated = self.project.summary_data()
+            chart.assert_called_once()
+        self.assertEqual(sum(updated[0]["data"]["y"]), 8)
+
+    def test_event_charts_are_cached(self):
+        from ami.main import charts
+
+        event = self.deployment.events.first()
+        assert event
+        event.summary_data()
+        with mock.patch(
+            "ami.main.charts.event_top_taxa", wraps=charts.event_top_taxa, __name__="event_top_taxa"
+        ) as chart:
+            event.summary_data()
+            chart.assert_not_called()
+            charts.bump_data_version(f"deployment:{self.deployment.pk}")
+            event.summary_data()
+            chart.assert_called_once()
+
+
+class TestKeysetPagination(TestCase):
+    def setUp(self) -> None:
+        self.project, self.deployment = setup_test_project(reuse=False)
+        create_captures(deployment=self.deployment, num_nights=2, images_per_night=4)
+        # Captures with the same timestamp are ordered by id
+        SourceImage.objects.create(
+            deployment=self.deployment, timestamp=self.deployment.captures.last().timestamp, path="test/same.jpg"
+        )
+        SourceImage.objects.create(deployment=self.deployment, timestamp=None, path="test/no_timestamp.jpg")
+        group_images_into_events(deployment=self.deployment)
+        return super().setUp()
+
+    def get_page(self, url, **params):
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()
+        return [row["id"] for row in data["results"]], data
+
+    def test_cursor_pages(self):
+        for ordering in ["timestamp", "-timestamp"]:
+            with self.subTest(ordering=ordering):
+                expected = list(
+                    self.deployment.captures.order_by(
+                        models.F("timestamp").desc(nulls_last=True)
+                        if ordering.startswith("-")
+                        else models.F("timestamp").asc(nulls_last=True),
+                        "-pk" if ordering.startswith("-") else "pk",
+                    ).values_list("pk", flat=True)
+                )
+                params = {"deployment": self.deployment.pk, "ordering": ordering, "limit": 3}
+                ids, data = self.get_page("/api/v2/captures/", cursor="", **params)
+                pages = [ids]
+                self.assertIsNone(data["count"])
+                self.assertIsNone(data["previous"])
+                while data["next"]:
+                    ids, data = self.get_page(data["next"])
+                    pages.append(ids)
+                self.assertEqual([pk for page in pages for pk in page], expected)
+
+                # Going back returns the same pages
+                ids, data = self.get_page(data["previous"])
+                self.assertEqual(ids, pages[-2])
+
+    def test_count_is_optional(self):
+        _ids, data = self.get_page(
+            "/api/v2/captures/", cursor="", deployment=self.deployment.pk, ordering="timestamp", with_count="true"
+        )
+        self.assertEqual(data["count"], self.deployment.captures.count())
+
+    def test_unsupported_ordering(self):
+        response = self.client.get("/api/v2/captures/", {"cursor": "", "ordering": "size"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_seek_to_capture(self):
+        event = self.deployment.events.last()
+        capture = event.captures.order_by("timestamp")[2]
+        response = self.client.get(f"/api/v2/events/{event.pk}/", {"capture": capture.pk})
+        self.assertIsNotNone(response.json()["capture_cursor"])
+        ids, _data = self.get_page(response.json()["captures"])
+        self.assertEqual(ids[0], capture.pk)
+
+    def test_capture_page_offset(self):
+        event = self.deployment.events.last()
+        capture = event.captures.order_by("timestamp")[2]
+        url = f"/api/v2/events/{event.pk}/"
+        # The captures before the subject are only counted when asked for
+        self.assertIsNone(self.client.get(url, {"capture": capture.pk}).json()["capture_page_offset"])
+        response = self.client.get(url, {"capture": capture.pk, "capture_page_offset": "true"})
+        self.assertEqual(response.json()["capture_page_offset"], 2)
+
+
+class TestPaginationCounts(TestCase):
+    def setUp(self) -> None:
+        from django.core.cache import cache
+
+        cache.clear()
+        self.project, self.deployment = setup_test_project(reuse=False)
+        create_captures(deployment=self.deployment, num_nights=2, images_per_night=3)
+        return super().setUp()
+
+    def test_exact_counts_are_cached(self):
+        params = {"deployment": self.deployment.pk, "limit": 2}
+        data = self.client.get("/api/v2/captures/", params).json()
+        self.assertEqual(data["count"], 6)
+        self.assertTrue(data["count_is_exact"])
+
+        SourceImage.objects.create(deployment=self.deployment, path="test/new.jpg")
+        self.assertEqual(self.client.get("/api/v2/captures/", params).json()["count"], 6)
+
+    def test_estimated_counts(self):
+        from django.test import override_settings
+
+        with override_settings(PAGINATION_COUNT_ESTIMATE_THRESHOLD=-1):
+            ids = []
+            url = f"/api/v2/captures/?deployment={self.deployment.pk}&limit=4"
+            while url:
+                data = self.client.get(url).json()
+                ids += [row["id"] for row in data["results"]]
+                url = data["next"]
+            self.assertEqual(len(ids), 6)
+            # The count is exact once the last page is reached
+            self.assertTrue(data["count_is_exact"])
+            self.assertEqual(data["count"], 6)
+
+            data = self.client.get("/api/v2/captures/", {"deployment": self.deployment.pk, "limit": 4}).json()
+            self.assertFalse(data["count_is_exact"])
+
+            # Past the end, the count stays an estimate below the offset
+            data = self.client.get(
+                "/api/v2/captures/", {"deployment": self.deployment.pk, "limit": 4, "offset": 10}
+            ).json()
+            self.assertEqual(data["results"], [])
+            self.assertFalse(data["count_is_exact"])
+            self.assertLessEqual(data["count"], 10)
+            self.assertIsNone(data["next"])
+
+
+class TestOccurrenceDetectionFields(TestCase):
+    def setUp(self) -> None:
+        # Run the updates queued while creating the test data, so the tests start new batches
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.project, self.deployment = setup_test_project(reuse=False)
+                create_taxa(project=self.project)
+                create_captures(deployment=self.deployment, num_nights=1, images_per_night=4)
+                group_images_into_events(deployment=self.deployment)
+                create_occurrences(deployment=self.deployment, num=2)
+        self.occurrence = Occurrence.objects.order_by("pk").first()
+        return super().setUp()
+
+    def test_fields_of_new_occurrence(self):
+        detection = self.occurrence.detections.get()
+        self.assertEqual(self.occurrence.detections_count, 1)
+        self.assertEqual(self.occurrence.first_appearance_timestamp, detection.timestamp)
+        self.assertEqual(self.occurrence.last_appearance_timestamp, detection.timestamp)
+        self.assertEqual(self.occurrence.duration(), datetime.timedelta(0))
+        self.assertEqual(self.occurrence.best_detection, detection)
+        self.assertEqual(self.occurrence.best_classification, self.occurrence.best_prediction)
+
+    def test_fields_follow_detections_and_classifications(self):
+        first = self.occurrence.detections.get()
+        capture = SourceImage.objects.filter(event=first.source_image.event).order_by("-timestamp").first()
+        taxon = self.occurrence.determination
+
+        from ami.main.models import _occurrence_detection_updates as updates
+
+        with mock.patch("ami.tasks.update_deployment_calculated_fields.apply_async"), mock.patch.object(
+            updates, "_flush", wraps=updates._flush
+        ) as flush:
+            with self.captureOnCommitCallbacks(execute=True):
+                second = Detection.objects.create(
+                    source_image=capture, timestamp=capture.timestamp, occurrence=self.occurrence
+                )
+                classification = second.classifications.create(
+                    taxon=taxon, score=0.99, timestamp=datetime.datetime.now()
+                )
+        # The occurrences are updated once, however many rows were saved
+        flush.assert_called_once()
+        self.occurrence.refresh_from_db()
+        self.assertEqual(self.occurrence.detections_count, 2)
+        self.assertEqual(self.occurrence.last_appearance_timestamp, capture.timestamp)
+        self.assertEqual(self.occurrence.best_detection, second)
+        self.assertEqual(self.occurrence.best_classification, classification)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            classification.delete()
+        self.occurrence.refresh_from_db()
+        self.assertEqual(self.occurrence.best_detection, first)
+
+        # Moving a detection updates the occurrence it was moved from as well
+        other = Occurrence.objects.exclude(pk=self.occurrence.pk).get()
+        second = Detection.objects.get(pk=second.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.occurrence = other
+            second.save()
+        self.occurrence.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.occurrence.detections_count, 1)
+        self.assertEqual(other.detections_count, 2)
+
+    def test_save_keeps_detection_fields(self):
+        stale = Occurrence.objects.get(pk=self.occurrence.pk)
+        Occurrence.objects.filter(pk=self.occurrence.pk).update(detections_count=5)
+        # Saving an instance doesn't recalculate the detection fields, or overwrite them with its own values
+        with self.assertNumQueries(1):
+            stale.save(update_determination=False)
+        self.occurrence.refresh_from_db()
+        self.assertEqual(self.occurrence.detections_count, 5)
+
+    def test_bulk_update(self):
+        from ami.main.models import update_occurrence_detection_fields
+
+        expected = list(Occurrence.objects.order_by("pk").values())
+        Occurrence.objects.update(
+            first_appearance_timestamp=None,
+            last_appearance_timestamp=None,
+            detections_count=None,
+            best_detection=None,
+            best_classification=None,
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(update_occurrence_detection_fields(), len(expected))
+        self.assertEqual(list(Occurrence.objects.order_by("pk").values()), expected)
+
+    def test_list_is_not_aggregated(self):
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/api/v2/occurrences/", {"project": self.project.pk, "ordering": "-first_appearance_timestamp"}
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 2)
+        occurrence_queries = [query["sql"] for query in queries if 'FROM "main_occurrence"' in query["sql"]]
+        self.assertTrue(occurrence_queries)
+        for sql in occurrence_queries:
+            self.assertNotIn("GROUP BY", sql)
+
+
 class TestDuplicateFieldsOnChildren(TestCase):
     def setUp(self) -> None:
         from ami.main.models import Deployment, Project
@@ -478,6 +1431,55 @@ class TestTaxonomy(TestCase):
         with self.assertRaises(ValueError):
             self._test_filtered_tree(filter_ranks)
 
+    def test_tree_queries(self):
+        root = Taxon.objects.root()
+        with self.assertNumQueries(1):
+            Taxon.objects.tree(root=root, filter_ranks=[TaxonRank.ORDER, TaxonRank.SPECIES])
+
+    def test_tree_paths(self):
+        order = Taxon.objects.get(name="Lepidoptera")
+        family = Taxon.objects.get(name="Nymphalidae")
+        genus = Taxon.objects.get(name="Vanessa")
+        species = Taxon.objects.get(name="Vanessa cardui")
+        self.assertEqual(species.tree_path, f"{order.pk}/{family.pk}/{genus.pk}/{species.pk}/")
+        with self.assertNumQueries(1):
+            self.assertEqual(species.get_ancestors(), [order, family, genus])
+        with self.assertNumQueries(1):
+            self.assertEqual(family.num_children_recursive(), 4)
+
+        # Moving a taxon moves everything below it
+        genus.parent = order
+        genus.save()
+        species.refresh_from_db()
+        self.assertEqual(species.tree_path, f"{order.pk}/{genus.pk}/{species.pk}/")
+        self.assertEqual(family.num_children_recursive(), 0)
+
+        # A taxon can't be moved below itself
+        order.parent = species
+        with self.assertRaises(ValidationError):
+            order.save()
+
+    def test_update_tree_paths(self):
+        expected = dict(Taxon.objects.values_list("pk", "tree_path"))
+        Taxon.objects.update(tree_path="")
+        self.assertEqual(Taxon.objects.update_tree_paths(), len(expected))
+        self.assertEqual(dict(Taxon.objects.values_list("pk", "tree_path")), expected)
+
+        species = Taxon.objects.get(name="Vanessa cardui")
+        self.assertEqual(
+            set(species.parents.values_list("name", flat=True)), {"Lepidoptera", "Nymphalidae", "Vanessa"}
+        )
+        # Nothing left to update
+        self.assertEqual(Taxon.objects.update_tree_paths(), 0)
+
+    def test_descendants_without_tree_paths(self):
+        family = Taxon.objects.get(name="Nymphalidae")
+        expected = set(family.descendants().values_list("pk", flat=True))
+        self.assertTrue(expected)
+        Taxon.objects.update(tree_path="")
+        family.refresh_from_db()
+        self.assertEqual(set(family.descendants().values_list("pk", flat=True)), expected)
+
 
 class TestTaxonomyViews(TestCase):
     def setUp(self) -> None:
@@ -507,6 +1509,52 @@ class TestTaxonomyViews(TestCase):
             self.assertEqual(response.status_code, 200)
             self.assertEqual(response.json()["count"], Occurrence.objects.filter(project=project).count())
 
+    def test_occurrence_list_queries(self):
+        from django.core.cache import cache
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        def count_queries(project) -> tuple[int, int]:
+            # Don't use a cached total count
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/api/v2/occurrences/", {"project": project.pk, "limit": 100})
+            self.assertEqual(response.status_code, 200)
+            return len(response.json()["results"]), len(queries)
+
+        num_results, num_queries = count_queries(self.project_one)
+        deployment = Deployment.objects.filter(project=self.project_one).first()
+        assert deployment
+        create_occurrences(deployment=deployment, num=5)
+        more_results, more_queries = count_queries(self.project_one)
+
+        self.assertGreater(more_results, num_results)
+        self.assertEqual(more_queries, num_queries)
+
+    def test_occurrence_list_determination_details(self):
+        response = self.client.get("/api/v2/occurrences/", {"project": self.project_one.pk})
+        for row in response.json()["results"]:
+            occurrence = Occurrence.objects.get(pk=row["id"])
+            details = row["determination_details"]
+            self.assertEqual(details["prediction"]["id"], occurrence.best_prediction.pk)
+            self.assertEqual(len(row["detection_images"]), occurrence.detections.count())
+
+    def test_occurrences_for_taxon_subtree(self):
+        family = Taxon.objects.get(name="Nymphalidae")
+        expected = Occurrence.objects.filter(
+            project=self.project_one, determination__in=[family, *family.descendants()]
+        ).count()
+        self.assertGreater(expected, 0)
+        response = self.client.get("/api/v2/occurrences/", {"project": self.project_one.pk, "taxon": family.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], expected)
+
+        # Taxa without tree paths yet still only match their own subtree
+        Taxon.objects.update(tree_path="")
+        response = self.client.get("/api/v2/occurrences/", {"project": self.project_one.pk, "taxon": family.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], expected)
+
     def test_taxa_list(self):
         from ami.main.models import Taxon
 
@@ -540,6 +1588,84 @@ class TestTaxonomyViews(TestCase):
         for project in [self.project_one, self.project_two]:
             self._test_taxa_for_project(project)
 
+    def test_taxa_occurrence_images(self):
+        from django.core.cache import cache
+
+        from ami.main import charts
+        from ami.main.models import get_media_url, get_taxa_occurrence_images
+
+        detections = Detection.objects.filter(occurrence__project=self.project_one).order_by("pk")
+        for i, detection in enumerate(detections):
+            Detection.objects.filter(pk=detection.pk).update(path=f"detections/{i}.jpg")
+            detection.classifications.update(score=0.5 + i / 100)
+        taxa = Taxon.objects.filter(occurrences__project=self.project_one).distinct()
+
+        images = get_taxa_occurrence_images([taxon.pk for taxon in taxa], limit=2, project_id=self.project_one.pk)
+        for taxon in taxa:
+            # The images of a taxon include those of the taxa below it
+            occurrences = Occurrence.objects.filter(
+                project=self.project_one, determination__tree_path__startswith=taxon.tree_path
+            )
+            expected = [
+                get_media_url(path)
+                for path in occurrences.order_by("-detections__classifications__score").values_list(
+                    "detections__path", flat=True
+                )[:2]
+            ]
+            self.assertEqual(images[taxon.pk], expected)
+            self.assertEqual(taxon.occurrence_images(limit=2, project_id=self.project_one.pk), expected)
+
+        # Scores below the threshold are left out
+        images = get_taxa_occurrence_images([taxon.pk for taxon in taxa], classification_threshold=0.99)
+        self.assertEqual(sum(len(urls) for urls in images.values()), 0)
+
+        # Images are cached per project until the project's data changes
+        cache.clear()
+        taxon_ids = [taxon.pk for taxon in taxa]
+        get_taxa_occurrence_images(taxon_ids, project_id=self.project_one.pk)
+        with self.assertNumQueries(0):
+            get_taxa_occurrence_images(taxon_ids, project_id=self.project_one.pk)
+        charts.bump_data_version(f"project:{self.project_one.pk}")
+        with self.assertNumQueries(2):
+            get_taxa_occurrence_images(taxon_ids, project_id=self.project_one.pk)
+
+    def test_taxa_occurrence_images_of_subtree(self):
+        from ami.main.models import get_media_url, get_taxa_occurrence_images
+
+        family = Taxon.objects.get(name="Nymphalidae")
+        species = Taxon.objects.get(name="Vanessa cardui")
+        detections = list(Detection.objects.filter(occurrence__project=self.project_one).order_by("pk"))
+        self.assertGreater(len(detections), 3)
+        # Most occurrences are of the family itself, but the best scoring one is of a species in it
+        for i, detection in enumerate(detections):
+            Detection.objects.filter(pk=detection.pk).update(path=f"detections/{i}.jpg")
+            detection.classifications.update(score=0.5 + i / 100)
+            Occurrence.objects.filter(pk=detection.occurrence_id).update(determination=species if i == 0 else family)
+        Detection.objects.filter(pk=detections[0].pk).update(path="detections/best.jpg")
+        Classification.objects.filter(detection=detections[0]).update(score=0.99)
+
+        images = get_taxa_occurrence_images([family.pk], limit=2, project_id=self.project_one.pk)
+        self.assertEqual(images[family.pk][0], get_media_url("detections/best.jpg"))
+        self.assertEqual(len(images[family.pk]), 2)
+
+    def test_taxa_list_occurrence_images_queries(self):
+        from django.core.cache import cache
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v2/taxa/", {"project": self.project_one.pk, "limit": 1})
+        self.assertEqual(response.status_code, 200)
+        num_queries = len(queries)
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/v2/taxa/", {"project": self.project_one.pk, "limit": 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(response.json()["results"]), 1)
+        self.assertEqual(len(queries), num_queries)
+
     def test_taxon_detail(self):
         from ami.main.models import Taxon
 
@@ -0,0 +1,167 @@
+import concurrent.futures
+import dataclasses
+import itertools
+import logging
+import threading
+import time
+import typing
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ami.main.models import SourceImage
+
+from .schemas import PipelineRequest, PipelineResponse, SourceImageRequest
+
+logger = logging.getLogger(__name__)
+
+# Sessions are kept per thread so each worker thread reuses its own keep-alive connections
+_sessions = threading.local()
+
+
+def get_session() -> requests.Session:
+    """
+    Return a requests session for talking to ML backends, with connection pooling and retries.
+    """
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        retries = Retry(
+            total=settings.ML_BACKEND_MAX_RETRIES,
+            backoff_factor=1,
+            status_forcelist=[502, 503, 504],
+            # Inference requests have no side effects, so they are safe to retry
+            allowed_methods=["POST"],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=settings.ML_BACKEND_MAX_IN_FLIGHT,
+            pool_maxsize=settings.ML_BACKEND_MAX_IN_FLIGHT,
+            max_retries=retries,
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _sessions.session = session
+    return session
+
+
+def build_pipeline_request(pipeline_choice: str, images: typing.Iterable[SourceImage]) -> PipelineRequest:
+    return PipelineRequest(
+        pipeline=pipeline_choice,  # type: ignore
+        source_images=[
+            SourceImageRequest(
+                id=str(source_image.pk),
+                url=source_image.public_url(),
+            )
+            for source_image in images
+        ],
+    )
+
+
+def send_pipeline_request(endpoint_url: str, request_data: PipelineRequest) -> PipelineResponse:
+    """
+    Send a request to an ML backend and parse the response.
+
+    This does not touch the database, so it is safe to call from a worker thread.
+    """
+    resp = get_session().post(
+        endpoint_url,
+        json=request_data.dict(),
+        timeout=(settings.ML_BACKEND_CONNECT_TIMEOUT, settings.ML_BACKEND_TIMEOUT),
+    )
+    resp.raise_for_status()
+    return PipelineResponse(**resp.json())
+
+
+class AdaptiveBatchSize:
+    """
+    Choose the number of images per request based on the observed latency of the ML backend.
+
+    Aims for requests that take about `target_seconds`, so small batches are used while the backend
+    is slow (keeping progress updates frequent) and batches grow when the backend is fast.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, target_seconds: float = 10.0):
+        self.size = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.seconds_per_image: float | None = None
+
+    def update(self, num_images: int, elapsed_seconds: float) -> int:
+        if num_images:
+            observed = elapsed_seconds / num_images
+            if self.seconds_per_image is None:
+                self.seconds_per_image = observed
+            else:
+                # Exponential moving average to smooth out noisy requests
+                self.seconds_per_image = 0.7 * self.seconds_per_image + 0.3 * observed
+            ideal = int(self.target_seconds / max(self.seconds_per_image, 1e-6))
+            # Don't change too quickly in either direction
+            ideal = max(self.size // 2, min(ideal, self.size * 2))
+            self.size = max(self.minimum, min(ideal, self.maximum))
+        return self.size
+
+
+@dataclasses.dataclass
+class BatchResult:
+    images: list[SourceImage]
+    results: PipelineResponse | None
+    error: Exception | None
+    elapsed_seconds: float
+
+
+def process_images_pipelined(
+    pipeline_choice: str,
+    endpoint_url: str,
+    images: typing.Iterable[SourceImage],
+    max_in_flight: int | None = None,
+    batch_size: AdaptiveBatchSize | None = None,
+) -> typing.Iterator[BatchResult]:
+    """
+    Send images to the ML backend with several requests in flight at once.
+
+    Results are yielded in the order they complete. While the caller handles one batch
+    (e.g. saving the results to the database), the remaining requests keep running in the background.
+    No more than `max_in_flight` requests are outstanding, and images are only pulled from
+    the `images` iterable as new requests are sent.
+    """
+    max_in_flight = max_in_flight or settings.ML_BACKEND_MAX_IN_FLIGHT
+    batch_size = batch_size or AdaptiveBatchSize(
+        initial=settings.ML_BACKEND_BATCH_SIZE,
+        maximum=settings.ML_BACKEND_MAX_BATCH_SIZE,
+        target_seconds=settings.ML_BACKEND_TARGET_BATCH_SECONDS,
+    )
+    images = iter(images)
+
+    def send(batch: list[SourceImage], request_data: PipelineRequest) -> BatchResult:
+        start = time.time()
+        try:
+            results = send_pipeline_request(endpoint_url, request_data)
+        except Exception as e:
+            return BatchResult(images=batch, results=None, error=e, elapsed_seconds=time.time() - start)
+        return BatchResult(images=batch, results=results, error=None, elapsed_seconds=time.time() - start)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight: set[concurrent.futures.Future] = set()
+
+        def fill():
+            while len(in_flight) < max_in_flight:
+                batch = list(itertools.islice(images, batch_size.size))
+                if not batch:
+                    return
+                # Build the request in this thread, since it may need the database
+                request_data = build_pipeline_request(pipeline_choice, batch)
+                in_flight.add(executor.submit(send, batch, request_data))
+
+        fill()
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                in_flight.remove(future)
+                batch_result = future.result()
+                if not batch_result.error:
+                    batch_size.update(len(batch_result.images), batch_result.elapsed_seconds)
+                fill()
+                yield batch_result
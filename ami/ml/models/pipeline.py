@@ -1,15 +1,17 @@
+import collections
+import itertools
 import logging
+import random
 import typing
 
-import requests
 from django.db import models
 from django.utils.text import slugify
 from django.utils.timezone import now
 from django_pydantic_field import SchemaField
-from rich import print
 
 from ami.base.models import BaseModel
 from ami.base.schemas import ConfigurableStage, default_stages
+from ami.main import charts
 from ami.main.models import (
     Classification,
     Deployment,
@@ -20,9 +22,14 @@ from ami.main.models import (
     TaxaList,
     Taxon,
     TaxonRank,
+    mark_deployment_stale,
+    update_detection_counts,
+    update_occurrence_detection_fields,
+    update_occurrence_determination,
 )
 
-from ..schemas import PipelineRequest, PipelineResponse, SourceImageRequest
+from ..client import build_pipeline_request, process_images_pipelined, send_pipeline_request
+from ..schemas import PipelineResponse
 from .algorithm import Algorithm
 
 logger = logging.getLogger(__name__)
@@ -31,44 +38,34 @@ logger = logging.getLogger(__name__)
 def filter_processed_images(
     images: typing.Iterable[SourceImage],
     pipeline: "Pipeline",
-) -> typing.Iterable[SourceImage]:
+) -> models.QuerySet[SourceImage]:
     """
     Return only images that need to be processed by a given pipeline for the first time (have no detections)
     or have detections that need to be classified by the given pipeline.
+
+    This is done in a single query, and a lazy queryset is returned. An image is skipped only
+    if it has detections from the pipeline and all of them have been classified by the pipeline.
+
+    Detections that haven't been classified by the pipeline are not reclassified on their own yet,
+    their images are processed from scratch.
     """
-    pipeline_algorithms = pipeline.algorithms.all()
+    if not isinstance(images, models.QuerySet):
+        images = SourceImage.objects.filter(pk__in=[image.pk for image in images])
 
-    for image in images:
-        existing_detections = image.detections.filter(detection_algorithm__in=pipeline_algorithms)
-        if not existing_detections.exists():
-            logger.debug(f"Image {image} has no existing detections from pipeline {pipeline}")
-            # If there are no existing detections from this pipeline, send the image
-            yield image
-        elif existing_detections.filter(classifications__isnull=True).exists():
-            # Check if there are detections with no classifications
-            logger.debug(f"Image {image} has existing detections with no classifications from pipeline {pipeline}")
-            yield image
-        else:
-            # If there are existing detections with classifications,
-            # Compare their classification algorithms to the current pipeline's algorithms
-            detections_needing_classification = existing_detections.exclude(
-                classifications__algorithm__in=pipeline_algorithms
+    pipeline_algorithms = pipeline.algorithms.all()
+    existing_detections = Detection.objects.filter(
+        source_image=models.OuterRef("pk"),
+        detection_algorithm__in=pipeline_algorithms,
+    )
+    detections_needing_classification = existing_detections.exclude(
+        models.Exists(
+            Classification.objects.filter(
+                detection=models.OuterRef("pk"),
+                algorithm__in=pipeline_algorithms,
             )
-            if detections_needing_classification.exists():
-                logger.debug(
-                    f"Image {image} has existing detections that haven't been classified by the pipeline: {pipeline}"
-                )
-                logger.warn(
-                    f"Image {image} has existing detections that haven't been classified by the pipeline: {pipeline} "
-                    f"however we do yet have a mechanism to reclassify detections. Processing the image from scratch."
-                )
-                yield image
-            else:
-                # If all detections have been classified by the pipeline, skip the image
-                logger.debug(
-                    f"Image {image} has existing detections classified by the pipeline: {pipeline}, skipping!"
-                )
-                continue
+        )
+    )
+    return images.filter(~models.Exists(existing_detections) | models.Exists(detections_needing_classification))
 
 
 def collect_images(
@@ -78,9 +75,11 @@ def collect_images(
     job_id: int | None = None,
     pipeline: "Pipeline | None" = None,
     skip_processed: bool = True,
-) -> typing.Iterable[SourceImage]:
+) -> models.QuerySet[SourceImage]:
     """
     Collect images from a collection, a list of images or a deployment.
+
+    Returns a lazy queryset, only the number of images is queried here.
     """
     if job_id:
         from ami.jobs.models import Job
@@ -93,26 +92,28 @@ def collect_images(
     if collection:
         images = collection.images.all()
     elif source_images:
-        images = source_images
+        images = SourceImage.objects.filter(pk__in=[image.pk for image in source_images])
     elif deployment:
         images = SourceImage.objects.filter(deployment=deployment)
     else:
         raise ValueError("Must specify a collection, deployment or a list of images")
 
-    total_images = len(images)
+    total_images = images.count()
     if pipeline and skip_processed:
         msg = f"Filtering images that have already been processed by pipeline {pipeline}"
         logger.info(msg)
         if job:
             job.logger.info(msg)
-        images = list(filter_processed_images(images, pipeline))
+        images = filter_processed_images(images, pipeline)
+        num_images = images.count()
     else:
         msg = "NOT filtering images that have already been processed"
         logger.info(msg)
         if job:
             job.logger.info(msg)
+        num_images = total_images
 
-    msg = f"Found {len(images)} out of {total_images} images to process"
+    msg = f"Found {num_images} out of {total_images} images to process"
     logger.info(msg)
     if job:
         job.logger.info(msg)
@@ -120,6 +121,56 @@ def collect_images(
     return images
 
 
+def _reservoir_sample(items: typing.Iterable[int], k: int) -> list[int]:
+    """
+    Choose `k` random items from an iterable of unknown length, holding at most `k` items in memory.
+    """
+    sample = []
+    for i, item in enumerate(items):
+        if i < k:
+            sample.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < k:
+                sample[j] = item
+    # The first items keep their original order unless replaced
+    random.shuffle(sample)
+    return sample
+
+
+def iter_image_ids(
+    images: models.QuerySet[SourceImage],
+    limit: int | None = None,
+    shuffle: bool = False,
+    chunk_size: int = 2000,
+) -> typing.Iterator[int]:
+    """
+    Stream the IDs of images to process using a server-side cursor.
+
+    With a limit, a random sample is chosen with reservoir sampling, so only `limit` IDs
+    are held in memory. Without a limit, the random order is left to the database.
+    """
+    if shuffle and limit:
+        ids = images.order_by().values_list("pk", flat=True).iterator(chunk_size=chunk_size)
+        yield from _reservoir_sample(ids, limit)
+        return
+    if shuffle:
+        images = images.order_by("?")
+    if limit:
+        images = images[:limit]
+    yield from images.values_list("pk", flat=True).iterator(chunk_size=chunk_size)
+
+
+def iter_images(image_ids: typing.Iterable[int], chunk_size: int = 100) -> typing.Iterator[SourceImage]:
+    """
+    Load images from a stream of IDs a chunk at a time, keeping the order of the IDs.
+    """
+    image_ids = iter(image_ids)
+    while chunk := list(itertools.islice(image_ids, chunk_size)):
+        images = SourceImage.objects.select_related("deployment").in_bulk(chunk)
+        yield from (images[pk] for pk in chunk if pk in images)
+
+
 def process_images(
     pipeline_choice: str,
     endpoint_url: str,
@@ -141,21 +192,8 @@ def process_images(
         job = Job.objects.get(pk=job_id)
         job.logger.info(f"Sending {len(images)} images to ML backend {pipeline_choice}")
 
-    request_data = PipelineRequest(
-        pipeline=pipeline_choice,  # type: ignore
-        source_images=[
-            SourceImageRequest(
-                id=str(source_image.pk),
-                url=source_image.public_url(),
-            )
-            for source_image in images
-        ],
-    )
-
-    resp = requests.post(endpoint_url, json=request_data.dict())
-    resp.raise_for_status()
-    results = resp.json()
-    results = PipelineResponse(**results)
+    request_data = build_pipeline_request(pipeline_choice, images)
+    results = send_pipeline_request(endpoint_url, request_data)
 
     if job:
         job.logger.debug(f"Results: {results}")
@@ -169,12 +207,82 @@ def process_images(
     return results
 
 
+def _get_or_create_algorithms(names: typing.Iterable[str]) -> tuple[dict[str, Algorithm], list[Algorithm]]:
+    """
+    Look up all algorithms referenced in a batch of results by name, creating any that are missing.
+
+    Returns a mapping of name to algorithm and the list of newly created algorithms.
+    """
+    names = set(names)
+    algorithms = {algo.name: algo for algo in Algorithm.objects.filter(name__in=names)}
+    created = []
+    for name in names - algorithms.keys():
+        algorithms[name], _created = Algorithm.objects.get_or_create(name=name)
+        if _created:
+            created.append(algorithms[name])
+    return algorithms, created
+
+
+def _get_or_create_taxa(names: typing.Iterable[str]) -> tuple[dict[str, Taxon], list[Taxon]]:
+    """
+    Look up all taxa referenced in a batch of results by name, bulk-creating any that are missing.
+
+    Returns a mapping of name to taxon and the list of newly created taxa.
+    """
+    names = set(names)
+    taxa = {taxon.name: taxon for taxon in Taxon.objects.filter(name__in=names)}
+    missing = names - taxa.keys()
+    if not missing:
+        return taxa, []
+
+    new_taxa = []
+    for name in missing:
+        taxon = Taxon(name=name, rank=TaxonRank.UNKNOWN)
+        # bulk_create skips Taxon.save(), which is where the display name is normally set
+        taxon.display_name = taxon.get_display_name()
+        new_taxa.append(taxon)
+    Taxon.objects.bulk_create(new_taxa, ignore_conflicts=True)
+
+    created = list(Taxon.objects.filter(name__in=missing))
+    # bulk_create also skips setting the tree path. New taxa have no parent, so they are at the top of the tree.
+    without_path = [taxon for taxon in created if not taxon.tree_path]
+    for taxon in without_path:
+        taxon.tree_path = f"{taxon.pk}/"
+    Taxon.objects.bulk_update(without_path, ["tree_path"])
+    # bulk_create skips the signals that invalidate the cached taxonomy trees
+    charts.bump_data_version("taxa")
+    taxa.update({taxon.name: taxon for taxon in created})
+    for name in missing - taxa.keys():
+        # A conflict on another unique field (display name) prevented the bulk insert,
+        # fall back to the regular path so the error surfaces as it did before.
+        taxa[name], _created = Taxon.objects.get_or_create(name=name, defaults={"rank": TaxonRank.UNKNOWN})
+        if _created:
+            created.append(taxa[name])
+    return taxa, created
+
+
+def _top_prediction(classifications: list[Classification]) -> Classification:
+    """
+    Pick the prediction that `Occurrence.best_prediction` would return for a new occurrence,
+    without querying the database: the most recent of the top scoring classifications per algorithm.
+    """
+    max_scores = collections.defaultdict(float)
+    for classification in classifications:
+        max_scores[classification.algorithm_id] = max(max_scores[classification.algorithm_id], classification.score)
+    top_scores = set(max_scores.values())
+    return [classification for classification in classifications if classification.score in top_scores][-1]
+
+
 def save_results(results: PipelineResponse, job_id: int | None = None) -> list[models.Model]:
     """
     Save results from ML pipeline API.
 
+    All lookups (algorithms, taxa, taxa lists, source images & existing detections) are resolved
+    once for the whole batch and new detections, classifications & occurrences are bulk inserted.
+    Derived fields are then recalculated once per affected source image & occurrence,
+    rather than once per row.
+
     @TODO break into task chunks.
-    @TODO rewrite this
     """
     created_objects = []
     job = None
@@ -183,7 +291,6 @@ def save_results(results: PipelineResponse, job_id: int | None = None) -> list[m
     if _created:
         logger.warning(f"Pipeline choice returned by the ML backend was not recognized! {pipeline}")
         created_objects.append(pipeline)
-    algorithms_used = set()
 
     if job_id:
         from ami.jobs.models import Job
@@ -191,120 +298,172 @@ def save_results(results: PipelineResponse, job_id: int | None = None) -> list[m
         job = Job.objects.get(pk=job_id)
         job.logger.info("Saving results")
 
-    # collection_name = f"Images processed by {results.pipeline} pipeline"
-    # if job_id:
-    #     from ami.jobs.models import Job
-
-    #     job = Job.objects.get(pk=job_id)
-    #     collection_name = f"Images processed by {results.pipeline} pipeline for job {job.name}"
-
-    # collection = SourceImageCollection.objects.create(name=collection_name)
-    # source_image_ids = [source_image.id for source_image in results.source_images]
-    # source_images = SourceImage.objects.filter(pk__in=source_image_ids)
-    # collection.images.set(source_images)
-    source_images = set()
-
     for detection_resp in results.detections:
-        # @TODO use bulk create, or optimize this in some way
-        print(detection_resp)
         assert detection_resp.algorithm, "No detection algorithm was specified in the returned results."
-        detection_algo, _created = Algorithm.objects.get_or_create(
-            name=detection_resp.algorithm,
+        for classification_resp in detection_resp.classifications:
+            assert classification_resp.algorithm, "No classification algorithm was specified in the returned results."
+
+    # Resolve everything referenced by the results up front
+    algorithms, new_algorithms = _get_or_create_algorithms(
+        [detection_resp.algorithm for detection_resp in results.detections]  # type: ignore
+        + [
+            classification_resp.algorithm  # type: ignore
+            for detection_resp in results.detections
+            for classification_resp in detection_resp.classifications
+        ]
+    )
+    created_objects.extend(new_algorithms)
+    algorithms_used = set()
+
+    taxa, new_taxa = _get_or_create_taxa(
+        classification_resp.classification
+        for detection_resp in results.detections
+        for classification_resp in detection_resp.classifications
+    )
+    created_objects.extend(new_taxa)
+
+    source_image_ids = {int(detection_resp.source_image_id) for detection_resp in results.detections}
+    source_images = SourceImage.objects.select_related("event", "deployment", "project").in_bulk(source_image_ids)
+    missing_images = source_image_ids - source_images.keys()
+    if missing_images:
+        raise SourceImage.DoesNotExist(f"Results reference unknown source images: {sorted(missing_images)}")
+
+    # Existing detections keyed by (source image, detection algorithm, bounding box)
+    existing_detections = {
+        (detection.source_image_id, detection.detection_algorithm_id, tuple(detection.bbox)): detection
+        for detection in Detection.objects.filter(
+            source_image_id__in=source_image_ids,
+            detection_algorithm__in=[algorithms[detection_resp.algorithm] for detection_resp in results.detections],
         )
+        .select_related("occurrence")
+        .order_by("-pk")  # Match the first detection found in the original per-row lookup
+        if detection.bbox
+    }
+
+    detections = []  # One entry per detection in the response
+    new_detections = []
+    updated_detections = []
+    for detection_resp in results.detections:
+        source_image = source_images[int(detection_resp.source_image_id)]
+        detection_algo = algorithms[detection_resp.algorithm]  # type: ignore
         algorithms_used.add(detection_algo)
-        if _created:
-            created_objects.append(detection_algo)
-
-        # @TODO hmmmm what to do
-        source_image = SourceImage.objects.get(pk=detection_resp.source_image_id)
-        source_images.add(source_image)
-        existing_detection = Detection.objects.filter(
-            source_image=source_image,
-            detection_algorithm=detection_algo,
-            bbox=list(detection_resp.bbox.dict().values()),
-        ).first()
-        if existing_detection:
-            if not existing_detection.path:
-                existing_detection.path = detection_resp.crop_image_url or ""
-                existing_detection.save()
-                print("Updated existing detection", existing_detection)
-            detection = existing_detection
+        bbox = list(detection_resp.bbox.dict().values())
+        key = (source_image.pk, detection_algo.pk, tuple(bbox))
+
+        detection = existing_detections.get(key)
+        if detection:
+            detection.source_image = source_image  # Avoid a lookup per detection later on
+            if not detection.path and detection_resp.crop_image_url:
+                detection.path = detection_resp.crop_image_url
+                updated_detections.append(detection)
         else:
-            new_detection = Detection.objects.create(
+            detection = Detection(
                 source_image=source_image,
-                bbox=list(detection_resp.bbox.dict().values()),
+                bbox=bbox,
                 timestamp=source_image.timestamp,
                 path=detection_resp.crop_image_url or "",
                 detection_time=detection_resp.timestamp,
                 detection_algorithm=detection_algo,
             )
-            new_detection.save()
-            print("Created new detection", new_detection)
-            created_objects.append(new_detection)
-            detection = new_detection
-
-        for classification in detection_resp.classifications:
-            print(classification)
-
-            assert classification.algorithm, "No classification algorithm was specified in the returned results."
-            classification_algo, _created = Algorithm.objects.get_or_create(
-                name=classification.algorithm,
-            )
+            # Duplicate boxes within the same response are saved once, as before
+            existing_detections[key] = detection
+            new_detections.append(detection)
+        detections.append(detection)
+
+    Detection.objects.bulk_create(new_detections)
+    Detection.objects.bulk_update(updated_detections, ["path"])
+    created_objects.extend(new_detections)
+
+    # One taxa list per classification algorithm
+    taxa_lists = {}
+    taxa_per_list = collections.defaultdict(set)
+    new_classifications = []
+    for detection, detection_resp in zip(detections, results.detections):
+        for classification_resp in detection_resp.classifications:
+            classification_algo = algorithms[classification_resp.algorithm]  # type: ignore
             algorithms_used.add(classification_algo)
-            if _created:
-                created_objects.append(classification_algo)
+            taxon = taxa[classification_resp.classification]
 
-            taxa_list, _created = TaxaList.objects.get_or_create(
-                name=f"Taxa returned by {classification_algo.name}",
-            )
-            if _created:
-                created_objects.append(taxa_list)
-
-            taxon, _created = Taxon.objects.get_or_create(
-                name=classification.classification,
-                defaults={"name": classification.classification, "rank": TaxonRank.UNKNOWN},
-            )
-            if _created:
-                created_objects.append(taxon)
-
-            taxa_list.taxa.add(taxon)
+            if classification_algo.pk not in taxa_lists:
+                taxa_list, _created = TaxaList.objects.get_or_create(
+                    name=f"Taxa returned by {classification_algo.name}",
+                )
+                if _created:
+                    created_objects.append(taxa_list)
+                taxa_lists[classification_algo.pk] = taxa_list
+            taxa_per_list[classification_algo.pk].add(taxon)
 
             # @TODO this is asking for trouble
             # shouldn't we be able to get the detection from the classification?
             # also should filter by the correct detection algorithm
             # or do we use the bbox as a unique identifier?
             # then it doesn't matter what detection algorithm was used
-
-            new_classification = Classification()
-            new_classification.detection = detection
-            new_classification.taxon = taxon
-            new_classification.algorithm = classification_algo
-            new_classification.score = max(classification.scores)
-            new_classification.timestamp = now()  # @TODO get timestamp from API response
-            # @TODO add reference to job or pipeline?
-
-            new_classification.save()
-            created_objects.append(new_classification)
-
-            # Create a new occurrence for each detection (no tracking yet)
-            # @TODO remove when we implement tracking
-            if not detection.occurrence:
-                occurrence = Occurrence.objects.create(
-                    event=source_image.event,
-                    deployment=source_image.deployment,
-                    project=source_image.project,
-                    determination=taxon,
-                    determination_score=new_classification.score,
+            new_classifications.append(
+                Classification(
+                    detection=detection,
+                    taxon=taxon,
+                    algorithm=classification_algo,
+                    score=max(classification_resp.scores),
+                    timestamp=now(),  # @TODO get timestamp from API response
+                    # @TODO add reference to job or pipeline?
                 )
-                detection.occurrence = occurrence
-                detection.save()
-            detection.occurrence.save()
+            )
+
+    for algo_pk, taxa_list in taxa_lists.items():
+        taxa_list.taxa.add(*taxa_per_list[algo_pk])
+
+    Classification.objects.bulk_create(new_classifications)
+    created_objects.extend(new_classifications)
+
+    # Create a new occurrence for each classified detection (no tracking yet)
+    # @TODO remove when we implement tracking
+    classifications_per_detection = collections.defaultdict(list)
+    for classification in new_classifications:
+        classifications_per_detection[classification.detection].append(classification)
+
+    new_detection_pks = {detection.pk for detection in new_detections}
+    new_occurrences = {}
+    occurrences_to_update = {}
+    for detection, classifications in classifications_per_detection.items():
+        if detection.occurrence:
+            occurrences_to_update[detection.occurrence.pk] = detection.occurrence
+            continue
+        source_image = detection.source_image
+        top_prediction = _top_prediction(classifications)
+        occurrence = Occurrence(
+            event=source_image.event,
+            deployment=source_image.deployment,
+            project=source_image.project,
+            determination=top_prediction.taxon,
+            determination_score=top_prediction.score,
+        )
+        new_occurrences[detection] = occurrence
+    if new_occurrences:
+        Occurrence.objects.bulk_create(new_occurrences.values())
+        for detection, occurrence in new_occurrences.items():
+            detection.occurrence = occurrence
+            if detection.pk not in new_detection_pks:
+                # Older predictions for this detection may exist, so let the database decide
+                occurrences_to_update[occurrence.pk] = occurrence
+        Detection.objects.bulk_update(new_occurrences.keys(), ["occurrence"])
+
+    # Recalculate the determination of each pre-existing occurrence once, now that all of its predictions exist
+    for occurrence in occurrences_to_update.values():
+        update_occurrence_determination(occurrence, current_determination=occurrence.determination, save=True)
+
+    # Bulk inserts skip the signals that update the detection fields stored on occurrences
+    update_occurrence_detection_fields(
+        Occurrence.objects.filter(pk__in={detection.occurrence.pk for detection in detections if detection.occurrence})
+    )
 
     # Update precalculated counts on source images
-    for source_image in source_images:
-        source_image.save()
+    update_detection_counts(SourceImage.objects.filter(pk__in=source_image_ids))
+    # Bulk inserts skip the signals that mark deployment totals as out of date
+    mark_deployment_stale(
+        [source_image.deployment_id for source_image in source_images.values()], "detections", "occurrences"
+    )
 
-    registered_algos = pipeline.algorithms.all()
+    registered_algos = set(pipeline.algorithms.all())
     for algo in algorithms_used:
         # This is important for tracking what objects were processed by which algorithms
         # to avoid reprocessing, and for tracking provenance.
@@ -358,7 +517,7 @@ class Pipeline(BaseModel):
         deployment: Deployment | None = None,
         job_id: int | None = None,
         skip_processed: bool = True,
-    ) -> typing.Iterable[SourceImage]:
+    ) -> models.QuerySet[SourceImage]:
         return collect_images(
             collection=collection,
             source_images=source_images,
@@ -378,6 +537,16 @@ class Pipeline(BaseModel):
             job_id=job_id,
         )
 
+    def process_images_pipelined(self, images: typing.Iterable[SourceImage], **kwargs):
+        if not self.endpoint_url:
+            raise ValueError("No endpoint URL configured for this pipeline")
+        return process_images_pipelined(
+            endpoint_url=self.endpoint_url,
+            pipeline_choice=self.slug,
+            images=images,
+            **kwargs,
+        )
+
     def save_results(self, *args, **kwargs):
         return save_results(*args, **kwargs)
 
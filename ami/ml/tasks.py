@@ -1,5 +1,8 @@
 import logging
 
+import requests
+from celery.exceptions import Retry
+
 from ami.tasks import default_soft_time_limit, default_time_limit
 from config import celery_app
 
@@ -7,31 +10,84 @@ logger = logging.getLogger(__name__)
 
 
 # @TODO can the timeout be dynamic based on the number of images?
-@celery_app.task(soft_time_limit=default_soft_time_limit, time_limit=default_time_limit)
-def process_and_save_images(pipeline_choice: str, endpoint_url: str, image_ids: list[int], job_id: int | None):
+@celery_app.task(
+    bind=True,
+    max_retries=3,
+    default_retry_delay=30,
+    soft_time_limit=default_soft_time_limit,
+    time_limit=default_time_limit,
+)
+def process_and_save_images(
+    self, pipeline_choice: str, endpoint_url: str, image_ids: list[int], job_id: int | None
+) -> dict:
+    """
+    Process one shard of the images in a job and save the results.
+
+    Returns a summary of the shard for the chord callback that finishes the job.
+    The job progress is also updated as each shard completes.
+
+    Results are saved without writing to the job's log, since the shards of a job run concurrently
+    and the job is only updated in `Job.record_shard_result` while holding a row lock.
+    """
     from ami.jobs.models import Job
     from ami.main.models import SourceImage
-    from ami.ml.models.pipeline import process_images, save_results
-
-    job = None
-    try:
-        job = Job.objects.get(pk=job_id)
-        job.logger.info(f"Processing {len(image_ids)} images for job {job}")
-    except Job.DoesNotExist as e:
-        logger.error(f"Job {job_id} not found: {e}")
-        pass
+    from ami.ml.client import process_images_pipelined
+    from ami.ml.models.pipeline import Pipeline, filter_processed_images, save_results
 
     images = SourceImage.objects.filter(pk__in=image_ids)
-    results = process_images(
-        pipeline_choice=pipeline_choice,
-        endpoint_url=endpoint_url,
-        images=images,
-        job_id=job_id,
-    )
+    summary = {
+        "images": len(image_ids),
+        "detections": 0,
+        "classifications": 0,
+        "objects_created": 0,
+        "errors": [],
+        "failed": False,
+        # The deployments whose charts are regenerated once the job is finished
+        "deployments": [],
+    }
+    logger.info(f"Processing shard of {len(image_ids)} images for job {job_id}")
 
     try:
-        save_results(results=results, job_id=job_id)
+        summary["deployments"] = list(
+            images.exclude(deployment=None).values_list("deployment_id", flat=True).distinct()
+        )
+        pipeline = Pipeline.objects.filter(slug=pipeline_choice).first()
+        if self.request.retries and pipeline:
+            # Skip the images of the batches that were saved before the retry,
+            # saving their results again would add duplicate classifications to their detections
+            images = filter_processed_images(images, pipeline)
+        for batch in process_images_pipelined(
+            pipeline_choice=pipeline_choice,
+            endpoint_url=endpoint_url,
+            images=images,
+        ):
+            if batch.error or not batch.results:
+                if isinstance(batch.error, requests.RequestException) and self.request.retries < self.max_retries:
+                    # Retry the rest of the shard, the images that were already saved are skipped
+                    raise self.retry(exc=batch.error)
+                summary["errors"].append(f"Failed to process image batch of {len(batch.images)}: {batch.error}")
+                continue
+            summary["detections"] += len(batch.results.detections)
+            summary["classifications"] += len([c for d in batch.results.detections for c in d.classifications])
+            try:
+                objects = save_results(results=batch.results)
+            except Exception as e:
+                logger.error(f"Failed to save results for job {job_id}: {e}")
+                summary["errors"].append(f"Failed to save results: {e}")
+            else:
+                summary["objects_created"] += len(objects)
+    except Retry:
+        raise
     except Exception as e:
-        logger.error(f"Failed to save results for job {job_id}: {e}")
-        raise e
-        # self.retry(exc=e, countdown=2)
+        # Return a failed summary instead of raising, otherwise the chord callback that finishes the job never runs
+        logger.exception(f"Failed to process shard of {len(image_ids)} images for job {job_id}: {e}")
+        summary["errors"].append(f"Failed to process shard of {len(image_ids)} images: {e}")
+        summary["failed"] = True
+
+    if job_id:
+        try:
+            Job.record_shard_result(job_id, summary)
+        except Job.DoesNotExist as e:
+            logger.error(f"Job {job_id} not found: {e}")
+
+    return summary
@@ -1,11 +1,18 @@
 import datetime
-
-from django.test import TestCase
+import threading
+import time
+from unittest import mock
+
+import requests
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rich import print
 
-from ami.main.models import Classification, Detection, Project, SourceImage, SourceImageCollection
+from ami.main.models import Classification, Detection, Occurrence, Project, SourceImage, SourceImageCollection
+from ami.ml.client import AdaptiveBatchSize, process_images_pipelined
 from ami.ml.models import Algorithm, Pipeline
-from ami.ml.models.pipeline import collect_images, save_results
+from ami.ml.models.pipeline import collect_images, filter_processed_images, iter_image_ids, iter_images, save_results
 from ami.ml.schemas import (
     BoundingBox,
     ClassificationResponse,
@@ -51,6 +58,21 @@ class TestPipeline(TestCase):
         images = list(collect_images(collection=self.image_collection, pipeline=self.pipeline))
         assert len(images) == 2
 
+    def test_iter_image_ids(self):
+        images = SourceImage.objects.filter(pk__in=[image.pk for image in self.test_images])
+        all_ids = {image.pk for image in self.test_images}
+
+        self.assertEqual(set(iter_image_ids(images)), all_ids)
+        self.assertEqual(set(iter_image_ids(images, shuffle=True)), all_ids)
+        for shuffle in (True, False):
+            sample = list(iter_image_ids(images, limit=1, shuffle=shuffle))
+            self.assertEqual(len(sample), 1)
+            self.assertTrue(set(sample) <= all_ids)
+
+        # Images are loaded in the order of the IDs
+        ids = list(reversed(sorted(all_ids)))
+        self.assertEqual([image.pk for image in iter_images(ids, chunk_size=1)], ids)
+
     def fake_pipeline_results(self, source_images: list[SourceImage], pipeline: Pipeline):
         source_image_results = [SourceImageResponse(id=image.pk, url=image.path) for image in source_images]
         detection_results = [
@@ -81,6 +103,37 @@ class TestPipeline(TestCase):
         )
         return fake_results
 
+    @override_settings(ML_BACKEND_BATCH_SIZE=1, ML_BACKEND_MAX_BATCH_SIZE=1, ML_BACKEND_MAX_IN_FLIGHT=1)
+    def test_retried_shard_skips_saved_batches(self):
+        from ami.ml.tasks import process_and_save_images
+
+        requested_ids = []
+
+        def fake_send(endpoint_url, request_data):
+            requested_ids.append([image.id for image in request_data.source_images])
+            if len(requested_ids) == 2:
+                raise requests.ConnectionError("Connection reset")
+            images = SourceImage.objects.filter(pk__in=requested_ids[-1])
+            results = self.fake_pipeline_results(list(images), self.pipeline)
+            results.detections = [d for d in results.detections if str(d.source_image_id) in requested_ids[-1]]
+            return results
+
+        kwargs = {
+            "pipeline_choice": self.pipeline.slug,
+            "endpoint_url": "http://ml-backend/",
+            "image_ids": [image.pk for image in self.test_images],
+            "job_id": None,
+        }
+        with mock.patch("ami.ml.client.send_pipeline_request", fake_send):
+            # The retry runs straight away when the task is applied eagerly
+            process_and_save_images.apply(kwargs=kwargs)
+
+        # The image that was saved before the retry is not processed again
+        self.assertEqual(len(requested_ids), 3)
+        self.assertEqual(requested_ids[2], requested_ids[1])
+        for image in self.test_images:
+            self.assertEqual(Classification.objects.filter(detection__source_image=image).count(), 1)
+
     def test_save_results(self):
         saved_objects = save_results(self.fake_pipeline_results(self.test_images, self.pipeline))
 
@@ -89,6 +142,48 @@ class TestPipeline(TestCase):
             self.assertEqual(image.detections_count, 1)
         print(saved_objects)
 
+        # The detection fields stored on the new occurrences are filled in
+        for occurrence in Occurrence.objects.filter(detections__source_image__in=self.test_images):
+            self.assertEqual(occurrence.detections_count, 1)
+            self.assertIsNotNone(occurrence.first_appearance_timestamp)
+            self.assertEqual(occurrence.best_classification, occurrence.best_prediction)
+
+    def test_save_results_query_count(self):
+        """
+        The number of queries should not grow with the number of detections in the results.
+        """
+
+        def results_with_detections(num_detections: int) -> PipelineResponse:
+            results = self.fake_pipeline_results(self.test_images, self.pipeline)
+            template = results.detections[0]
+            results.detections = [
+                template.copy(
+                    update={
+                        "source_image_id": image.pk,
+                        "bbox": BoundingBox(x1=float(i), y1=float(i), x2=float(i + 1), y2=float(i + 1)),
+                    },
+                    deep=True,
+                )
+                for image in self.test_images
+                for i in range(num_detections)
+            ]
+            return results
+
+        with CaptureQueriesContext(connection) as few:
+            save_results(results_with_detections(1))
+        Classification.objects.all().delete()
+        Detection.objects.all().delete()
+        with CaptureQueriesContext(connection) as many:
+            save_results(results_with_detections(10))
+
+        self.assertEqual(Detection.objects.count(), len(self.test_images) * 10)
+        self.assertEqual(Classification.objects.count(), len(self.test_images) * 10)
+        for image in self.test_images:
+            image.refresh_from_db()
+            self.assertEqual(image.detections_count, 10)
+        # The first batch also creates the taxon & taxa list, so it may use a few more queries
+        self.assertLessEqual(len(many), len(few))
+
     def test_skip_existing_results(self):
         images = list(collect_images(collection=self.image_collection, pipeline=self.pipeline))
         total_images = len(images)
@@ -148,6 +243,19 @@ class TestPipeline(TestCase):
         remaining_images_to_process = len(images_again)
         self.assertEqual(remaining_images_to_process, total_images)
 
+    def test_skip_existing_with_unclassified_detection(self):
+        save_results(self.fake_pipeline_results(self.test_images, self.pipeline))
+        # Add a detection from the pipeline's detector that was never classified
+        unclassified_image = self.test_images[0]
+        Detection.objects.create(
+            source_image=unclassified_image,
+            detection_algorithm=self.algorithms["detector"],
+            bbox=[0.5, 0.5, 1.0, 1.0],
+        )
+        with self.assertNumQueries(1):
+            images_again = list(filter_processed_images(self.image_collection.images.all(), self.pipeline))
+        self.assertEqual(images_again, [unclassified_image])
+
     def test_unknown_algorithm_returned_by_backend(self):
         fake_results = self.fake_pipeline_results(self.test_images, self.pipeline)
 
@@ -235,3 +343,57 @@ class TestPipeline(TestCase):
         images_again = list(collect_images(collection=self.image_collection, pipeline=self.pipeline))
         remaining_images_to_process = len(images_again)
         self.assertEqual(remaining_images_to_process, 0)
+
+
+class TestPipelinedClient(TestCase):
+    def setUp(self):
+        self.images = [SourceImage.objects.create(path=f"test-2024010100{i:02d}00.jpg") for i in range(10)]
+
+    def test_adaptive_batch_size(self):
+        batch_size = AdaptiveBatchSize(initial=4, maximum=32, target_seconds=10)
+        # A fast backend should get bigger batches, but not more than double at a time
+        self.assertEqual(batch_size.update(num_images=4, elapsed_seconds=1), 8)
+        self.assertEqual(batch_size.update(num_images=8, elapsed_seconds=2), 16)
+        self.assertEqual(batch_size.update(num_images=16, elapsed_seconds=4), 32)
+        self.assertEqual(batch_size.update(num_images=32, elapsed_seconds=8), 32)
+        # A slow backend should get smaller batches
+        self.assertLess(batch_size.update(num_images=32, elapsed_seconds=120), 32)
+
+    def test_process_images_pipelined(self):
+        in_flight = 0
+        max_seen_in_flight = 0
+        lock = threading.Lock()
+
+        def fake_send(endpoint_url, request_data):
+            nonlocal in_flight, max_seen_in_flight
+            with lock:
+                in_flight += 1
+                max_seen_in_flight = max(max_seen_in_flight, in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight -= 1
+            return PipelineResponse(
+                pipeline=request_data.pipeline,
+                total_time=0.0,
+                source_images=[
+                    SourceImageResponse(id=image.id, url=image.url) for image in request_data.source_images
+                ],
+                detections=[],
+            )
+
+        with mock.patch("ami.ml.client.send_pipeline_request", fake_send):
+            batches = list(
+                process_images_pipelined(
+                    pipeline_choice="test-pipeline",
+                    endpoint_url="http://ml-backend/",
+                    images=self.images,
+                    max_in_flight=2,
+                    batch_size=AdaptiveBatchSize(initial=3, maximum=3),
+                )
+            )
+
+        processed = [image for batch in batches for image in batch.images]
+        self.assertCountEqual(processed, self.images)
+        self.assertEqual(len(batches), 4)
+        self.assertTrue(all(batch.error is None for batch in batches))
+        self.assertLessEqual(max_seen_in_flight, 2)
@@ -1,3 +1,4 @@
+import datetime
 import logging
 
 from django.apps import apps
@@ -16,12 +17,12 @@ default_soft_time_limit = two_days
 
 # @TODO use shared_task decorator instead of celery_app?
 @celery_app.task(soft_time_limit=two_days, time_limit=two_days + one_hour)
-def sync_source_images(deployment_id: int) -> int:
+def sync_source_images(deployment_id: int, incremental: bool = False) -> int:
     from ami.main.models import Deployment
 
     deployment = Deployment.objects.get(id=deployment_id)
-    logger.info(f"Importing source images for {deployment}")
-    return deployment.sync_captures()
+    logger.info(f"Importing {'new ' if incremental else ''}source images for {deployment}")
+    return deployment.sync_captures(incremental=incremental)
 
 
 @celery_app.task(soft_time_limit=two_days, time_limit=two_days + one_hour)
@@ -57,6 +58,15 @@ def model_bulk_update(Model: models.Model, instances: list, fields: list) -> Non
     Model.objects.bulk_update(instances, fields)
 
 
+@celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
+def create_image_derivatives(source_image_ids: list[int]) -> int:
+    from ami.main import models as main_models
+
+    logger.info(f"Creating thumbnails & crops for {len(source_image_ids)} source images")
+    images = main_models.SourceImage.objects.filter(pk__in=source_image_ids)
+    return main_models.create_image_derivatives(images)
+
+
 # Task to write tasks to Label Studio
 @celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
 def write_tasks(label_studio_config_id: int) -> int:
@@ -85,16 +95,73 @@ def populate_collection(collection_id: int) -> None:
         logger.error(f"SourceImageCollection with id {collection_id} not found")
 
 
+@celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
+def update_deployment_calculated_fields(deployment_id: int) -> list[str]:
+    """
+    Recompute the calculated fields of a deployment that were marked as stale.
+
+    Scheduled by `mark_deployment_stale`, which coalesces many changes into a single run.
+    """
+    from ami.main import charts
+    from ami.main.models import (
+        Deployment,
+        pop_deployment_warm_charts,
+        pop_stale_deployment_aggregates,
+        refresh_summary_stats,
+    )
+
+    aggregates = pop_stale_deployment_aggregates(deployment_id)
+    if not aggregates:
+        return []
+    try:
+        deployment = Deployment.objects.get(pk=deployment_id)
+    except Deployment.DoesNotExist:
+        logger.warning(f"Deployment with id {deployment_id} not found, not updating its calculated fields")
+        return []
+    logger.info(f"Updating {', '.join(aggregates)} fields for {deployment}")
+    deployment.update_calculated_fields(save=True, only=aggregates)
+    refresh_summary_stats(deployment)
+    charts.bump_data_version(f"deployment:{deployment.pk}", f"project:{deployment.project_id}")
+    if pop_deployment_warm_charts(deployment_id):
+        warm_chart_cache.delay(deployment_id)
+    return aggregates
+
+
+@celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
+def warm_chart_cache(deployment_id: int) -> None:
+    """
+    Generate the cached charts of a deployment's project and events, so the next page load is fast.
+    """
+    from ami.main.models import Deployment
+
+    deployment = Deployment.objects.select_related("project").get(pk=deployment_id)
+    if deployment.project:
+        deployment.project.summary_data()
+    for event in deployment.events.all():
+        event.summary_data()
+    logger.info(f"Warmed chart cache for {deployment}")
+
+
 # Task to group images into events
 @celery_app.task(soft_time_limit=one_hour, time_limit=one_hour + 60)
-def regroup_events(deployment_id: int) -> None:
+def regroup_events(deployment_id: int, start: str | None = None, end: str | None = None) -> None:
+    """
+    Group the captures of a deployment into events.
+
+    Optionally only the captures in a time range are regrouped (ISO formatted timestamps).
+    """
     from ami.main.models import Deployment, group_images_into_events
 
     deployment = Deployment.objects.get(id=deployment_id)
     if deployment:
         logger.info(f"Grouping captures for {deployment}")
-        events = group_images_into_events(deployment)
-        logger.info(f"{deployment } now has {len(events)} events")
+        events = group_images_into_events(
+            deployment,
+            start=datetime.datetime.fromisoformat(start) if start else None,
+            end=datetime.datetime.fromisoformat(end) if end else None,
+        )
+        # Only the events around the time range are returned when regrouping part of the deployment
+        logger.info(f"Created or updated {len(events)} events for {deployment}")
     else:
         logger.error(f"Deployment with id {deployment_id} not found")
 
@@ -2,8 +2,10 @@ import datetime
 import logging
 import pathlib
 import re
+import typing
 
 import dateutil.parser
+import PIL.Image
 
 logger = logging.getLogger(__name__)
 
@@ -47,7 +49,8 @@ def get_image_timestamp_from_filename(img_path, raise_error=False) -> datetime.d
     if not date:
         try:
             date = dateutil.parser.parse(name, fuzzy=False)  # Fuzzy will interpret "DSC_1974" as 1974-01-01
-        except dateutil.parser.ParserError:
+        except (ValueError, OverflowError):
+            # ParserError is a ValueError, out of range values raise plain ValueError or OverflowError
             pass
 
     if not date and raise_error:
@@ -56,6 +59,110 @@ def get_image_timestamp_from_filename(img_path, raise_error=False) -> datetime.d
         return date
 
 
+_TIMESTAMP_DIGITS = re.compile(r"(\d{14})")
+_FILENAME_PARTS = re.compile(r"\d+|[A-Za-z]+|[^\dA-Za-z]+")
+
+
+def _parse_timestamp_digits(digits: str) -> datetime.datetime | None:
+    """
+    Parse a timestamp in the format `YYYYMMDDHHMMSS`, much faster than `strptime`.
+    """
+    try:
+        return datetime.datetime(
+            int(digits[0:4]),
+            int(digits[4:6]),
+            int(digits[6:8]),
+            int(digits[8:10]),
+            int(digits[10:12]),
+            int(digits[12:14]),
+        )
+    except ValueError:
+        return None
+
+
+class FilenameTimestampParser:
+    r"""
+    Parse the timestamps of many files whose names follow the same pattern, like all of the images of a deployment.
+
+    The pattern of the filenames is learned from the first ones that have a timestamp in the format `YYYYMMDDHHMMSS`
+    (see `get_image_timestamp_from_filename`). The text before the timestamp is generalized to runs of digits,
+    letters and separators, e.g. `84-20220916202959-snapshot.jpg` gives the pattern `^\d+-(\d{14})`.
+    Filenames are then parsed with the learned patterns, which are compiled once and anchored at the start,
+    so a different run of 14 digits later in the name can't be mistaken for the timestamp.
+
+    Filenames that don't match a pattern fall back to `get_image_timestamp_from_filename`, which also
+    guesses other date formats with `dateutil`. Filenames without a timestamp are counted in `num_unparsed`.
+
+    >>> parser = FilenameTimestampParser()
+    >>> timestamps = parser.parse_many(["84-20220916202959-snapshot.jpg", "night/85-20220916203959-snapshot.jpg"])
+    >>> [timestamp.isoformat() for timestamp in timestamps.values()]
+    ['2022-09-16T20:29:59', '2022-09-16T20:39:59']
+    >>> [pattern.pattern for pattern in parser.patterns]
+    ['^\\d+\\-(\\d{14})']
+    >>> parser.parse("night/20220916-204959.jpg").isoformat()
+    '2022-09-16T20:49:59'
+    >>> parser.parse("IMG_0001.jpg") is None, parser.num_parsed, parser.num_unparsed
+    (True, 3, 1)
+    """
+
+    max_patterns = 5
+
+    def __init__(self):
+        self.patterns: list[re.Pattern] = []
+        self.num_parsed = 0
+        self.num_unparsed = 0
+
+    def learn(self, name: str) -> datetime.datetime | None:
+        match = _TIMESTAMP_DIGITS.search(name)
+        timestamp = _parse_timestamp_digits(match.group()) if match else None
+        if match and timestamp and len(self.patterns) < self.max_patterns:
+            prefix = "".join(
+                r"\d+" if part.isdigit() else "[A-Za-z]+" if part.isalpha() else re.escape(part)
+                for part in _FILENAME_PARTS.findall(name[: match.start()])
+            )
+            self.patterns.append(re.compile(rf"^{prefix}(\d{{14}})"))
+        return timestamp
+
+    def parse(self, path: str) -> datetime.datetime | None:
+        # The filename without the extension, like `pathlib.Path(path).stem` but faster
+        name = path.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        timestamp = None
+        for pattern in self.patterns:
+            match = pattern.match(name)
+            if match:
+                timestamp = _parse_timestamp_digits(match.group(1))
+                if timestamp:
+                    break
+        else:
+            timestamp = self.learn(name)
+        if not timestamp:
+            # Slower, but only for the names that don't have a timestamp in the format `YYYYMMDDHHMMSS`
+            timestamp = get_image_timestamp_from_filename(name)
+        if timestamp:
+            self.num_parsed += 1
+        else:
+            self.num_unparsed += 1
+        return timestamp
+
+    def parse_many(self, paths: typing.Iterable[str]) -> dict[str, datetime.datetime | None]:
+        return {path: self.parse(path) for path in paths}
+
+
+def get_image_timestamp_from_exif(image: PIL.Image.Image) -> datetime.datetime | None:
+    """
+    Return the date and time a photo was taken from its EXIF data, if it has any.
+    """
+    exif = image.getexif()
+    # DateTimeOriginal is in the EXIF sub-IFD, DateTime (the last modification) is in the main IFD
+    value = exif.get_ifd(0x8769).get(0x9003) or exif.get(0x0132)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
 def format_timedelta(duration: datetime.timedelta | None) -> str:
     """Format the duration for display.
     @TODO try the humanize library
@@ -0,0 +1,147 @@
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """
+    A cache of files on the local disk, limited to a total size, that can be shared by several processes.
+
+    Entries are stored by a hash of their identity (e.g. the bucket, key and ETag of an S3 object),
+    so a changed file is a new entry and old entries are never read again. Files are written to a temporary
+    file first and renamed into place, so other processes never read a partial file and no locks are needed.
+
+    The least recently used files are evicted when the total size is over `max_bytes`. The modification time of
+    a file is updated whenever it is read, since access times are often not recorded by the file system.
+
+    >>> cache = FileCache(tempfile.mkdtemp(), max_bytes=10)
+    >>> cache.get("bucket", "key", "etag") is None
+    True
+    >>> cache.set(b"12345678", "bucket", "key", "etag")
+    >>> cache.get("bucket", "key", "etag")
+    b'12345678'
+    >>> cache.stats()
+    {'hits': 1, 'misses': 1, 'bytes_read': 8, 'bytes_written': 8, 'evictions': 0}
+    """
+
+    # Check the total size again once this fraction of `max_bytes` has been written by this process
+    check_size_fraction = 0.1
+    # Evict files until the total size is below this fraction of `max_bytes`
+    evict_to_fraction = 0.9
+    # Temporary files older than this were left behind by a process that crashed while writing
+    stale_temp_seconds = 60 * 60
+
+    def __init__(self, directory: str | pathlib.Path, max_bytes: int):
+        self.directory = pathlib.Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._bytes_since_check: int | None = None
+        self._stats = {"hits": 0, "misses": 0, "bytes_read": 0, "bytes_written": 0, "evictions": 0}
+
+    def path(self, *identity: str) -> pathlib.Path:
+        digest = hashlib.sha256("\0".join(identity).encode()).hexdigest()
+        # Spread the files over subdirectories to keep directories small
+        return self.directory / digest[:2] / digest
+
+    def _count(self, **counts: int):
+        with self._lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+    def get(self, *identity: str) -> bytes | None:
+        path = self.path(*identity)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self._count(misses=1)
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process since it was read
+            pass
+        self._count(hits=1, bytes_read=len(data))
+        return data
+
+    def set(self, data: bytes, *identity: str):
+        path = self.path(*identity)
+        temp_name = None
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=path.parent, prefix=".tmp-", delete=False) as f:
+                temp_name = f.name
+                f.write(data)
+            os.replace(temp_name, path)
+        except OSError as e:
+            # The cache is only an optimization, so a full or read-only disk shouldn't fail the caller
+            logger.warning(f"Could not write {path} to the file cache: {e}")
+            if temp_name:
+                try:
+                    os.unlink(temp_name)
+                except OSError:
+                    pass
+            return
+        self._count(bytes_written=len(data))
+        with self._lock:
+            check = (
+                self._bytes_since_check is None
+                or self._bytes_since_check + len(data) > self.max_bytes * self.check_size_fraction
+            )
+            self._bytes_since_check = 0 if check else (self._bytes_since_check or 0) + len(data)
+        if check:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Delete the least recently used files until the total size is under the limit.
+
+        Temporary files that are older than `stale_temp_seconds` are deleted as well.
+        Returns the number of files deleted, not counting temporary files.
+        """
+        files = []
+        total_bytes = 0
+        now = time.time()
+        for path in self.directory.glob("*/*"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if path.name.startswith(".tmp-"):
+                # Recent ones are being written by another process
+                if now - stat.st_mtime > self.stale_temp_seconds:
+                    try:
+                        path.unlink()
+                    except FileNotFoundError:
+                        pass
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+        if total_bytes <= self.max_bytes:
+            return 0
+
+        num_evicted = 0
+        for _, size, path in sorted(files):
+            if total_bytes <= self.max_bytes * self.evict_to_fraction:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            num_evicted += 1
+        self._count(evictions=num_evicted)
+        logger.info(f"Evicted {num_evicted} files from the file cache in {self.directory}")
+        return num_evicted
+
+    def stats(self) -> dict[str, int]:
+        """
+        Return the number of hits & misses, the bytes read & written and the number of files evicted by this process.
+        """
+        with self._lock:
+            return dict(self._stats)
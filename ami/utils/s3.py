@@ -1,7 +1,12 @@
+import concurrent.futures
+import dataclasses
+import datetime
 import io
 import logging
 import pathlib
+import queue
 import re
+import threading
 import typing
 import urllib.parse
 from dataclasses import dataclass
@@ -13,12 +18,16 @@ import botocore.config
 import botocore.exceptions
 import PIL
 import PIL.Image
+from django.conf import settings
 from mypy_boto3_s3.client import S3Client
 from mypy_boto3_s3.paginator import ListObjectsV2Paginator
 from mypy_boto3_s3.service_resource import Bucket, ObjectSummary, S3ServiceResource
 from mypy_boto3_s3.type_defs import BucketTypeDef, ObjectTypeDef
 from rich import print
 
+from .dates import get_image_timestamp_from_exif
+from .file_cache import FileCache
+
 logger = logging.getLogger(__name__)
 
 
@@ -64,36 +73,101 @@ def get_session(config: S3Config) -> boto3.session.Session:
     return session
 
 
-def get_client(config: S3Config) -> S3Client:
+# Clients are thread-safe, so one client (and its connection pool) is shared by all threads for each set of
+# credentials. Resources are not thread-safe, so they are kept per thread but use the shared clients.
+_clients: dict[tuple, S3Client] = {}
+_clients_lock = threading.Lock()
+_resources = threading.local()
+_client_stats = {"created": 0, "reused": 0}
+
+
+def _client_key(config: S3Config) -> tuple:
+    return (config.endpoint_url, config.access_key_id, config.secret_access_key, settings.S3_MAX_POOL_CONNECTIONS)
+
+
+def _create_client(config: S3Config) -> S3Client:
+    # The credentials are taken from the session, so a config without credentials fails without sending requests
     session = get_session(config)
     if config.endpoint_url:
         client: S3Client = session.client(
             service_name="s3",
             endpoint_url=config.endpoint_url,
-            aws_access_key_id=config.access_key_id,
-            aws_secret_access_key=config.secret_access_key,
-            config=botocore.config.Config(signature_version="s3v4"),
+            config=botocore.config.Config(
+                signature_version="s3v4",
+                max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+            ),
         )
     else:
         client: S3Client = session.client(
             service_name="s3",
-            aws_access_key_id=config.access_key_id,
-            aws_secret_access_key=config.secret_access_key,
+            config=botocore.config.Config(max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS),
         )
 
     return client
 
 
+def get_client(config: S3Config) -> S3Client:
+    """
+    Return the shared client for the credentials and endpoint of a config, creating it on first use.
+
+    Reusing the client avoids setting up a new session and a new TLS connection for every request.
+    """
+    key = _client_key(config)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = _create_client(config)
+            _client_stats["created"] += 1
+        else:
+            _client_stats["reused"] += 1
+    return client
+
+
 def get_resource(config: S3Config) -> S3ServiceResource:
-    session = get_session(config)
-    s3 = session.resource(
-        "s3",
-        endpoint_url=config.endpoint_url,
-        # api_version="s3v4",
-    )
+    key = _client_key(config)
+    if not hasattr(_resources, "cache"):
+        _resources.cache = {}
+    s3 = _resources.cache.get(key)
+    if s3 is None or s3.meta.client is not _clients.get(key):
+        session = get_session(config)
+        s3 = session.resource(
+            "s3",
+            endpoint_url=config.endpoint_url,
+            # api_version="s3v4",
+        )
+        # Send the resource's requests over the shared connection pool
+        s3.meta.client = get_client(config)
+        _resources.cache[key] = s3
     return s3
 
 
+def client_stats() -> dict[str, int]:
+    """
+    Return how many clients were created and reused, and the connections opened by their pools.
+    """
+    pools = connections = 0
+    with _clients_lock:
+        clients = list(_clients.values())
+        stats = dict(_client_stats)
+    for client in clients:
+        # The connection pools are internal to botocore, so don't fail if they are not where they used to be
+        manager = getattr(getattr(getattr(client, "_endpoint", None), "http_session", None), "_manager", None)
+        for pool_key in manager.pools.keys() if manager else []:
+            pool = manager.pools.get(pool_key)
+            if pool is not None:
+                pools += 1
+                connections += getattr(pool, "num_connections", 0)
+    return {"clients": len(clients), **stats, "pools": pools, "connections": connections}
+
+
+def clear_clients():
+    """
+    Forget the shared clients, e.g. after the credentials for an endpoint have changed.
+    """
+    with _clients_lock:
+        _clients.clear()
+
+
 def list_buckets(config: S3Config) -> list[BucketTypeDef]:
     s3 = get_client(config)
     return s3.list_buckets().get("Buckets", [])
@@ -172,67 +246,346 @@ def list_files(
         yield obj
 
 
+def _full_prefix(config: S3Config, subdir: str | None = None) -> str:
+    if subdir:
+        return urllib.parse.urljoin(config.prefix, subdir.lstrip("/")).strip("/")
+    else:
+        return config.prefix.strip("/")
+
+
+def list_prefix_key(config: S3Config, subdir: str | None = None) -> str:
+    """
+    The prefix that all of the files listed for a config & subdir share, with a trailing slash.
+    """
+    full_prefix = _full_prefix(config, subdir)
+    return with_trailing_slash(full_prefix) if full_prefix else ""
+
+
+def _filter_objects(
+    objects: typing.Iterable[ObjectTypeDef], regex: re.Pattern | None = None
+) -> typing.Generator[ObjectTypeDef, typing.Any, None]:
+    for obj in objects:
+        assert "Key" in obj, f"Key is missing from object: {obj}"
+        if obj["Key"].endswith("/"):
+            logger.debug(obj["Key"] + " is skipped because it is a folder")
+            continue
+        if obj["Key"].startswith(f"{DERIVATIVES_PREFIX}/"):
+            # Thumbnails & crops are stored in the same bucket as the originals
+            logger.debug(obj["Key"] + " is skipped because it is a derivative image")
+            continue
+        if regex and not regex.match(obj["Key"]):
+            # @TODO can we use JMESPath to filter and return a whole page?
+            logger.debug(obj["Key"] + " is skipped by regex filter")
+            continue
+        logger.debug(f"Yielding {obj['Key']}")
+        yield obj
+
+
+def _list_prefix(
+    client: S3Client,
+    bucket_name: str,
+    prefix: str,
+    regex: re.Pattern | None = None,
+    start_after: str | None = None,
+) -> typing.Generator[ObjectTypeDef, typing.Any, None]:
+    paginator: ListObjectsV2Paginator = client.get_paginator("list_objects_v2")
+    params = {"StartAfter": start_after} if start_after else {}
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, **params):
+        if "Contents" in page:
+            yield from _filter_objects(page["Contents"], regex)
+        else:
+            logger.debug("No Contents in page")
+
+
 def list_files_paginated(
     config: S3Config,
     subdir: str | None = None,
     regex_filter: str | None = None,
+    start_after: str | None = None,
 ) -> typing.Generator[ObjectTypeDef, typing.Any, None]:
     """
     List files in a bucket, with pagination to increase performance.
+
+    Keys are listed in lexicographic order, only keys after `start_after` are listed if it is given.
     """
     client = get_client(config)
-    if subdir:
-        full_prefix = urllib.parse.urljoin(config.prefix, subdir.lstrip("/")).strip("/")
-    else:
-        full_prefix = config.prefix.strip("/")
-    logger.info(f"Scanning {config.bucket_name}/{full_prefix}/")
-    paginator: ListObjectsV2Paginator = client.get_paginator("list_objects_v2")
+    full_prefix = _full_prefix(config, subdir)
+    logger.info(f"Scanning {config.bucket_name}/{full_prefix}/" + (f" after {start_after}" if start_after else ""))
     regex = re.compile(str(regex_filter)) if regex_filter else None
-    for page in paginator.paginate(Bucket=config.bucket_name, Prefix=full_prefix):
-        if "Contents" in page:
-            for obj in page["Contents"]:
-                assert "Key" in obj, f"Key is missing from object: {obj}"
-                if obj["Key"].endswith("/"):
-                    logger.debug(obj["Key"] + " is skipped because it is a folder")
-                    continue
-                if regex and not regex.match(obj["Key"]):
-                    # @TODO can we use JMESPath to filter and return a whole page?
-                    logger.debug(obj["Key"] + " is skipped by regex filter")
-                    continue
-                logger.debug(f"Yielding {obj['Key']}")
-                yield obj
-        else:
-            logger.debug("No Contents in page")
+    yield from _list_prefix(client, config.bucket_name, full_prefix, regex, start_after)
 
 
-def read_file(config: S3Config, key: str) -> bytes:
-    bucket = get_bucket(config)
+def list_prefixes(config: S3Config, subdir: str | None = None) -> tuple[list[str], list[ObjectTypeDef]]:
+    """
+    List the common prefixes (subfolders) directly under the configured prefix.
+
+    Also returns the objects that are directly under the prefix, since they are not in any subfolder.
+    """
+    client = get_client(config)
+    full_prefix = _full_prefix(config, subdir)
+    paginator: ListObjectsV2Paginator = client.get_paginator("list_objects_v2")
+    prefixes = []
+    objects = []
+    for page in paginator.paginate(
+        Bucket=config.bucket_name,
+        Prefix=with_trailing_slash(full_prefix) if full_prefix else "",
+        Delimiter="/",
+    ):
+        prefixes.extend(item["Prefix"] for item in page.get("CommonPrefixes", []))  # type: ignore
+        objects.extend(page.get("Contents", []))
+    return prefixes, objects
+
+
+@dataclass
+class PrefixListed:
+    """Progress message sent when all files under a prefix have been listed."""
+
+    prefix: str
+    num_files: int
+    prefixes_done: int
+    total_prefixes: int
+    last_key: str | None = None
+
+
+def list_files_concurrently(
+    config: S3Config,
+    subdir: str | None = None,
+    regex_filter: str | None = None,
+    max_workers: int = 8,
+    max_queue_size: int = 10000,
+    on_prefix_listed: typing.Callable[[PrefixListed], typing.Any] | None = None,
+    watermarks: dict[str, str] | None = None,
+) -> typing.Generator[ObjectTypeDef, typing.Any, None]:
+    """
+    List files in a bucket, listing each top level prefix (e.g. a folder per night) in parallel.
+
+    The prefixes are listed by a bounded pool of threads that put the objects into a queue,
+    and the objects are yielded from the queue in the calling thread as they arrive.
+    The queue is bounded, so listing pauses while the consumer is busy (e.g. saving a batch).
+    `on_prefix_listed` is called in the calling thread as each prefix is completed.
+
+    If `watermarks` are given (the last key seen under each prefix in a previous listing),
+    only newer keys are listed. This assumes new files are only added to the latest prefixes,
+    as with a folder per night: prefixes that sort before the latest one with a watermark
+    are skipped entirely, and the latest one is listed from its watermark.
+    The objects directly under the base prefix are reported with the base prefix itself.
+    """
+    client = get_client(config)
+    full_prefix = _full_prefix(config, subdir)
+    root_prefix = list_prefix_key(config, subdir)
+    regex = re.compile(str(regex_filter)) if regex_filter else None
+    prefixes, root_objects = list_prefixes(config, subdir)
+    # Don't list the thumbnails & crops when they are under the listed prefix
+    prefixes = [prefix for prefix in prefixes if not prefix.startswith(f"{DERIVATIVES_PREFIX}/")]
+    watermarks = watermarks or {}
+
+    known_prefixes = sorted(prefix for prefix in prefixes if prefix in watermarks)
+    if known_prefixes:
+        num_prefixes = len(prefixes)
+        prefixes = [prefix for prefix in prefixes if prefix >= known_prefixes[-1]]
+        logger.info(f"Skipping {num_prefixes - len(prefixes)} prefixes that were completely listed before")
+    logger.info(f"Scanning {config.bucket_name}/{full_prefix}/ in {len(prefixes)} prefixes with {max_workers} threads")
+
+    root_watermark = watermarks.get(root_prefix)
+    root_objects = [obj for obj in root_objects if not root_watermark or obj["Key"] > root_watermark]
+    yield from _filter_objects(root_objects, regex)
+    if on_prefix_listed and root_objects:
+        on_prefix_listed(
+            PrefixListed(
+                prefix=root_prefix,
+                num_files=len(root_objects),
+                prefixes_done=0,
+                total_prefixes=len(prefixes),
+                last_key=max(obj["Key"] for obj in root_objects),
+            )
+        )
+    if not prefixes:
+        return
+
+    results: queue.Queue = queue.Queue(maxsize=max_queue_size)
+    stop = threading.Event()
+    done_marker = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def list_one_prefix(prefix: str):
+        num_files = 0
+        last_key = None
+        try:
+            for obj in _list_prefix(client, config.bucket_name, prefix, regex, start_after=watermarks.get(prefix)):
+                if not put(obj):
+                    return
+                num_files += 1
+                last_key = obj["Key"]
+        except Exception as e:
+            put(e)
+        else:
+            put((done_marker, prefix, num_files, last_key))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for prefix in prefixes:
+            executor.submit(list_one_prefix, prefix)
+        prefixes_done = 0
+        try:
+            while prefixes_done < len(prefixes):
+                item = results.get()
+                if isinstance(item, Exception):
+                    raise item
+                elif isinstance(item, tuple) and item[0] is done_marker:
+                    prefixes_done += 1
+                    progress = PrefixListed(
+                        prefix=item[1],
+                        num_files=item[2],
+                        prefixes_done=prefixes_done,
+                        total_prefixes=len(prefixes),
+                        last_key=item[3],
+                    )
+                    logger.info(
+                        f"Listed {progress.num_files} files in {progress.prefix} "
+                        f"({progress.prefixes_done}/{progress.total_prefixes} prefixes)"
+                    )
+                    if on_prefix_listed:
+                        on_prefix_listed(progress)
+                else:
+                    yield item
+        finally:
+            # Let the listing threads exit if the consumer stops early or fails
+            stop.set()
+
+
+def _prefixed_key(config: S3Config, key: str) -> str:
     if config.prefix:
         # Use path join to ensure there are no extra or missing slashes
         key = pathlib.Path(config.prefix, key).as_posix()
-    obj = bucket.Object(key)
-    return obj.get()["Body"].read()
+    return key
+
+
+_file_cache: FileCache | None = None
+_file_cache_lock = threading.Lock()
+
+
+def get_file_cache() -> FileCache | None:
+    """
+    Return the local disk cache for files read from S3, or None if it is disabled.
+
+    The cache is shared by all of the threads in a process, and by all of the processes on a node
+    that use the same `S3_CACHE_DIR`. Its `stats()` has the hits & misses of this process.
+    """
+    global _file_cache
+    if not settings.S3_CACHE_DIR or not settings.S3_CACHE_MAX_BYTES:
+        return None
+    with _file_cache_lock:
+        if (
+            _file_cache is None
+            or _file_cache.directory != pathlib.Path(settings.S3_CACHE_DIR)
+            or _file_cache.max_bytes != settings.S3_CACHE_MAX_BYTES
+        ):
+            _file_cache = FileCache(settings.S3_CACHE_DIR, settings.S3_CACHE_MAX_BYTES)
+        return _file_cache
+
+
+def _cache_identity(config: S3Config, key: str, etag: str) -> tuple[str, ...]:
+    return (config.endpoint_url or "", config.bucket_name, key, etag.strip('"'))
+
+
+def read_object(config: S3Config, key: str, etag: str | None = None) -> bytes:
+    """
+    Read a whole file, through the local disk cache if it is enabled.
+
+    Files are cached by their ETag, so a file that has changed is downloaded again. The ETag of a
+    source image is stored as its `checksum`. If it isn't given, it is looked up with a HEAD request,
+    which is still much faster than downloading the file.
+    """
+    client = get_client(config)
+    cache = get_file_cache()
+    if not cache:
+        return client.get_object(Bucket=config.bucket_name, Key=key)["Body"].read()
+
+    if not etag:
+        etag = client.head_object(Bucket=config.bucket_name, Key=key)["ETag"]
+    data = cache.get(*_cache_identity(config, key, etag))
+    if data is None:
+        response = client.get_object(Bucket=config.bucket_name, Key=key)
+        data = response["Body"].read()
+        # Cache the file by the ETag of what was actually downloaded, in case it changed since the ETag was known
+        cache.set(data, *_cache_identity(config, key, response.get("ETag") or etag))
+    return data
+
+
+def read_file(config: S3Config, key: str) -> bytes:
+    return read_object(config, _prefixed_key(config, key))
 
 
 def write_file(config: S3Config, key: str, body: bytes):
-    bucket = get_bucket(config)
-    if config.prefix:
-        # Use path join to ensure there are no extra or missing slashes
-        key = pathlib.Path(config.prefix, key).as_posix()
-    obj = bucket.Object(key)
-    return obj.put(Body=body)
+    client = get_client(config)
+    return client.put_object(Bucket=config.bucket_name, Key=_prefixed_key(config, key), Body=body)
+
+
+def list_keys(config: S3Config, subdir: str | None = None) -> set[str]:
+    """
+    List all of the keys under the configured prefix at once, relative to the prefix.
+
+    Much faster than checking if each file exists with a separate request.
+    """
+    client = get_client(config)
+    prefix = list_prefix_key(config, subdir)
+    logger.info(f"Listing existing keys in {config.bucket_name}/{prefix}")
+    return {obj["Key"].removeprefix(prefix) for obj in _list_prefix(client, config.bucket_name, prefix)}
+
+
+def write_files_concurrently(
+    config: S3Config,
+    files: typing.Iterable[tuple[str, bytes]],
+    max_workers: int = 8,
+) -> typing.Generator[str, typing.Any, None]:
+    """
+    Upload files with several requests in flight at once, sharing one client and its connection pool.
+
+    `files` yields (key, body) pairs, with keys relative to the configured prefix. It is consumed
+    in the calling thread as uploads complete, so it can lazily serialize the files (e.g. from the database).
+    The keys are yielded as each upload completes.
+    """
+    client = get_client(config)
+
+    def put(key: str, body: bytes) -> str:
+        client.put_object(Bucket=config.bucket_name, Key=_prefixed_key(config, key), Body=body)
+        return key
+
+    files = iter(files)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight: set[concurrent.futures.Future] = set()
+
+        def fill():
+            # Keep a few uploads queued for each thread, without reading all of the files into memory
+            while len(in_flight) < max_workers * 2:
+                try:
+                    key, body = next(files)
+                except StopIteration:
+                    return
+                in_flight.add(executor.submit(put, key, body))
+
+        fill()
+        while in_flight:
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                in_flight.remove(future)
+                yield future.result()
+            fill()
 
 
 def file_exists(config: S3Config, key: str) -> bool:
-    bucket = get_bucket(config)
-    if config.prefix:
-        # Use path join to ensure there are no extra or missing slashes
-        key = pathlib.Path(config.prefix, key).as_posix()
-    obj = bucket.Object(key)
+    client = get_client(config)
     try:
-        obj.load()
+        client.head_object(Bucket=config.bucket_name, Key=_prefixed_key(config, key))
     except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "404":
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
             return False
         else:
             raise
@@ -240,21 +593,104 @@ def file_exists(config: S3Config, key: str) -> bool:
         return True
 
 
-def read_image(config: S3Config, key: str) -> PIL.Image.Image:
+def read_image(config: S3Config, key: str, etag: str | None = None) -> PIL.Image.Image:
     """
-    Download an image from S3 and return as a PIL Image.
+    Download an image from S3 (or the local cache) and return as a PIL Image.
     """
-    bucket = get_bucket(config)
-    obj = bucket.Object(key)
     logger.info(f"Fetching image {key} from S3")
     try:
-        img = PIL.Image.open(obj.get()["Body"])
+        img = PIL.Image.open(io.BytesIO(read_object(config, key, etag)))
     except PIL.UnidentifiedImageError:
         logger.error(f"Could not read image {key}")
         raise
     return img
 
 
+def read_range(config: S3Config, key: str, length: int) -> bytes:
+    """
+    Read the first `length` bytes of a file, or the whole file if it is shorter.
+    """
+    client = get_client(config)
+    return client.get_object(Bucket=config.bucket_name, Key=key, Range=f"bytes=0-{length - 1}")["Body"].read()
+
+
+def read_image_dimensions(
+    config: S3Config,
+    key: str,
+    initial_bytes: int = 16 * 1024,
+    max_bytes: int = 1024 * 1024,
+    etag: str | None = None,
+) -> tuple[int, int]:
+    """
+    Return the width & height of an image by reading only the start of the file, which has the header.
+
+    The header is usually in the first few KB, but JPEG files with a large EXIF block (e.g. with a thumbnail)
+    can have it further in, so larger ranges are read until the header is found.
+    If the ETag is given and the whole file is in the local cache already, nothing is downloaded.
+    """
+    cache = get_file_cache()
+    data = cache.get(*_cache_identity(config, key, etag)) if cache and etag else None
+    if data is not None:
+        return PIL.Image.open(io.BytesIO(data)).size
+
+    length = initial_bytes
+    while True:
+        data = read_range(config, key, length)
+        try:
+            # Only the header is parsed when an image is opened, the pixel data is not needed
+            return PIL.Image.open(io.BytesIO(data)).size
+        except OSError:
+            if len(data) < length or length >= max_bytes:
+                # The whole file (or as much as allowed) was read, so this is not a readable image
+                logger.error(f"Could not read image dimensions of {key} from the first {len(data)} bytes")
+                raise
+            length = min(length * 4, max_bytes)
+
+
+def probe_image_dimensions(
+    config: S3Config, keys: typing.Iterable[str], max_workers: int = 8, etags: dict[str, str | None] | None = None
+) -> dict[str, tuple[int, int] | None]:
+    """
+    Read the dimensions of many images at once, with several requests in flight.
+
+    Returns the dimensions for each key, or None if they could not be read.
+    """
+    etags = etags or {}
+
+    def probe(key: str) -> tuple[int, int] | None:
+        try:
+            return read_image_dimensions(config, key, etag=etags.get(key))
+        except Exception as e:
+            logger.error(f"Could not determine image dimensions for {key}: {e}")
+            return None
+
+    keys = list(keys)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(keys, executor.map(probe, keys)))
+
+
+def read_exif_timestamps(
+    config: S3Config, keys: typing.Iterable[str], max_workers: int = 8, length: int = 64 * 1024
+) -> dict[str, datetime.datetime | None]:
+    """
+    Read the date & time that many images were taken from their EXIF data, with several requests in flight.
+
+    Only the start of each file is read, which is where the EXIF data is stored.
+    Returns the timestamp for each key, or None if it could not be read.
+    """
+
+    def read(key: str) -> datetime.datetime | None:
+        try:
+            return get_image_timestamp_from_exif(PIL.Image.open(io.BytesIO(read_range(config, key, length))))
+        except Exception as e:
+            logger.debug(f"Could not read EXIF timestamp of {key}: {e}")
+            return None
+
+    keys = list(keys)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(keys, executor.map(read, keys)))
+
+
 def public_url(config: S3Config, key: str):
     """
     Return public URL for a given key.
@@ -264,41 +700,89 @@ def public_url(config: S3Config, key: str):
     return urllib.parse.urljoin(config.public_base_url, key.lstrip("/"))
 
 
-# Methods to resize all images under a prefix
-def resize_images(config: S3Config, prefix: str, width: int, height: int):
-    bucket = get_bucket(config)
-    objects = bucket.objects.filter(Prefix=with_trailing_slash(prefix)).all()
-    for obj in objects:
-        resize_image(config, obj.key, width, height)
+# Derivative images (thumbnails & crops), stored next to the originals with keys derived from the original key.
+# Keys under this prefix are skipped when listing the originals.
+DERIVATIVES_PREFIX = "derivatives"
 
 
-def resized_key(config: S3Config, key: str, width: int, height: int):
-    path = pathlib.Path(key)
-    new_prefix = f"/resized/{without_trailing_slash(config.prefix)}/{path.parent.name}"
-    new_key = f"{new_prefix}/{path.stem}_{width}x{height}.{path.suffix}"
-    return new_key
+def thumbnail_key(key: str, size: int) -> str:
+    """
+    Return the key of the thumbnail of an image, which fits in a square of `size` pixels.
 
+    >>> thumbnail_key("deployment/20230101/20230101220000.jpg", 512)
+    'derivatives/thumbnails/512/deployment/20230101/20230101220000.jpg'
+    """
+    path = pathlib.PurePosixPath(key.lstrip("/")).with_suffix(".jpg")
+    return f"{DERIVATIVES_PREFIX}/thumbnails/{size}/{path}"
 
-def resize_image(config: S3Config, key: str, width: int, height: int) -> str:
-    client = get_client(config)
-    new_key = resized_key(config, key, width, height)
-    client.put_object(
-        Bucket=config.bucket_name,
-        Key=new_key,
-        Body=resize_image_body(client, config.bucket_name, key, width, height),
-    )
-    return new_key
 
+def crop_key(key: str, bbox: typing.Sequence[float]) -> str:
+    """
+    Return the key of a crop of an image, for a bounding box of (x1, y1, x2, y2) pixel coordinates.
+
+    >>> crop_key("deployment/20230101/20230101220000.jpg", [10.2, 20, 110.8, 220])
+    'derivatives/crops/deployment/20230101/20230101220000/10-20-111-220.jpg'
+    """
+    path = pathlib.PurePosixPath(key.lstrip("/")).with_suffix("")
+    coords = "-".join(str(round(coord)) for coord in bbox)
+    return f"{DERIVATIVES_PREFIX}/crops/{path}/{coords}.jpg"
+
+
+@dataclass
+class DerivativesRequest:
+    """The derivatives to create from one original image, which is only downloaded once for all of them."""
 
-def resize_image_body(client: S3Client, bucket: str, key: str, width: int, height: int) -> bytes:
-    body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
-    image = PIL.Image.open(io.BytesIO(body))
-    image.thumbnail((width, height))
+    key: str
+    # Used to read the original from the local cache
+    etag: str | None = None
+    thumbnail_size: int | None = None
+    # Bounding boxes of the crops to create, by the key of each crop
+    crops: dict[str, typing.Sequence[float]] = dataclasses.field(default_factory=dict)
+
+
+def _encode_jpeg(image: PIL.Image.Image, quality: int) -> bytes:
     buffer = io.BytesIO()
-    image.save(buffer, format="JPEG")
+    image.convert("RGB").save(buffer, format="JPEG", quality=quality)
     return buffer.getvalue()
 
 
+def create_derivatives(
+    config: S3Config,
+    requests: typing.Iterable[DerivativesRequest],
+    max_workers: int = 8,
+    quality: int = 85,
+) -> typing.Generator[tuple[DerivativesRequest, Exception | None], typing.Any, None]:
+    """
+    Create thumbnails & crops of many images at once, with several images processed in parallel.
+
+    The results are yielded in the same order as the requests, with the error if the derivatives of an image
+    could not be created.
+    """
+    client = get_client(config)
+
+    def create(request: DerivativesRequest) -> tuple[DerivativesRequest, Exception | None]:
+        try:
+            image = PIL.Image.open(io.BytesIO(read_object(config, request.key, request.etag)))
+            image.load()
+            for key, bbox in request.crops.items():
+                crop = image.crop(tuple(round(coord) for coord in bbox))
+                client.put_object(Bucket=config.bucket_name, Key=key, Body=_encode_jpeg(crop, quality))
+            if request.thumbnail_size:
+                image.thumbnail((request.thumbnail_size, request.thumbnail_size))
+                client.put_object(
+                    Bucket=config.bucket_name,
+                    Key=thumbnail_key(request.key, request.thumbnail_size),
+                    Body=_encode_jpeg(image, quality),
+                )
+        except Exception as e:
+            logger.error(f"Could not create derivatives of {request.key}: {e}")
+            return request, e
+        return request, None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from executor.map(create, requests)
+
+
 def test():
     # boto3.set_stream_logger(name="botocore")
 
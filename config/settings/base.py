@@ -362,3 +362,70 @@ SPECTACULAR_SETTINGS = {
 # ------------------------------------------------------------------------------
 
 DEFAULT_CONFIDENCE_THRESHOLD = env.float("DEFAULT_CONFIDENCE_THRESHOLD", default=0.29)  # type: ignore[no-untyped-call]
+# Seconds to wait for further changes before recomputing the counts & totals of a deployment
+DEPLOYMENT_RECOMPUTE_DEBOUNCE_SECONDS = env.int(  # type: ignore[no-untyped-call]
+    "DEPLOYMENT_RECOMPUTE_DEBOUNCE_SECONDS", default=30
+)
+# List endpoints estimate their total count from the database statistics above this many results
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = env.int(  # type: ignore[no-untyped-call]
+    "PAGINATION_COUNT_ESTIMATE_THRESHOLD", default=100_000
+)
+# Seconds to cache the exact total counts of list endpoints for
+PAGINATION_COUNT_CACHE_SECONDS = env.int("PAGINATION_COUNT_CACHE_SECONDS", default=60)  # type: ignore[no-untyped-call]
+# Seconds to keep chart data for. Charts are also invalidated whenever the data they are based on changes.
+CHART_CACHE_TIMEOUT = env.int("CHART_CACHE_TIMEOUT", default=60 * 60 * 24 * 7)  # type: ignore[no-untyped-call]
+# Seconds to keep the representative images of each taxon in a project for, they are also invalidated with the charts
+TAXON_IMAGES_CACHE_TIMEOUT = env.int(  # type: ignore[no-untyped-call]
+    "TAXON_IMAGES_CACHE_TIMEOUT", default=60 * 60 * 24
+)
+# Seconds to keep the taxonomy trees for Label Studio for, they are also invalidated whenever taxa change
+TAXONOMY_CACHE_TIMEOUT = env.int("TAXONOMY_CACHE_TIMEOUT", default=60 * 60 * 24 * 7)  # type: ignore[no-untyped-call]
+
+# ML backends
+# ------------------------------------------------------------------------------
+# Seconds to wait for a connection to, and a response from, an ML backend
+ML_BACKEND_CONNECT_TIMEOUT = env.float("ML_BACKEND_CONNECT_TIMEOUT", default=10)  # type: ignore[no-untyped-call]
+ML_BACKEND_TIMEOUT = env.float("ML_BACKEND_TIMEOUT", default=300)  # type: ignore[no-untyped-call]
+ML_BACKEND_MAX_RETRIES = env.int("ML_BACKEND_MAX_RETRIES", default=3)  # type: ignore[no-untyped-call]
+# Number of requests sent to an ML backend concurrently by a single job
+ML_BACKEND_MAX_IN_FLIGHT = env.int("ML_BACKEND_MAX_IN_FLIGHT", default=4)  # type: ignore[no-untyped-call]
+# Images per request. The batch size adapts to aim for requests of roughly the target duration.
+ML_BACKEND_BATCH_SIZE = env.int("ML_BACKEND_BATCH_SIZE", default=4)  # type: ignore[no-untyped-call]
+ML_BACKEND_MAX_BATCH_SIZE = env.int("ML_BACKEND_MAX_BATCH_SIZE", default=32)  # type: ignore[no-untyped-call]
+ML_BACKEND_TARGET_BATCH_SECONDS = env.float(  # type: ignore[no-untyped-call]
+    "ML_BACKEND_TARGET_BATCH_SECONDS", default=10
+)
+# Number of images in each sub-task of a pipeline job that is run in distributed mode
+JOB_SHARD_SIZE = env.int("JOB_SHARD_SIZE", default=100)  # type: ignore[no-untyped-call]
+
+# S3 data sources
+# ------------------------------------------------------------------------------
+# Number of threads used to list the folders of a data source in parallel when syncing captures
+S3_SYNC_MAX_WORKERS = env.int("S3_SYNC_MAX_WORKERS", default=8)  # type: ignore[no-untyped-call]
+# Maximum number of open connections kept by each shared S3 client, should be at least the number of threads using it
+S3_MAX_POOL_CONNECTIONS = env.int("S3_MAX_POOL_CONNECTIONS", default=16)  # type: ignore[no-untyped-call]
+# Local disk cache for the files that workers read from S3 (e.g. original images), shared by the processes on a node.
+# An empty directory disables the cache.
+S3_CACHE_DIR = env("S3_CACHE_DIR", default="/tmp/ami-s3-cache")
+S3_CACHE_MAX_BYTES = env.int("S3_CACHE_MAX_BYTES", default=2 * 1024**3)  # type: ignore[no-untyped-call]
+# Number of images whose dimensions are read from the data source in parallel
+IMAGE_DIMENSIONS_MAX_WORKERS = env.int("IMAGE_DIMENSIONS_MAX_WORKERS", default=8)  # type: ignore[no-untyped-call]
+# Thumbnails of source images fit in a square of this many pixels
+THUMBNAIL_SIZE = env.int("THUMBNAIL_SIZE", default=512)  # type: ignore[no-untyped-call]
+# Number of source images whose thumbnails & crops are created in each batch, and in parallel within a batch
+DERIVATIVES_BATCH_SIZE = env.int("DERIVATIVES_BATCH_SIZE", default=200)  # type: ignore[no-untyped-call]
+DERIVATIVES_MAX_WORKERS = env.int("DERIVATIVES_MAX_WORKERS", default=8)  # type: ignore[no-untyped-call]
+
+# Label Studio
+# ------------------------------------------------------------------------------
+# Number of source images serialized at once when exporting tasks for Label Studio
+LABEL_STUDIO_EXPORT_BATCH_SIZE = env.int(  # type: ignore[no-untyped-call]
+    "LABEL_STUDIO_EXPORT_BATCH_SIZE", default=500
+)
+# Number of tasks uploaded to S3 in parallel, must not be more than S3_MAX_POOL_CONNECTIONS
+LABEL_STUDIO_EXPORT_MAX_WORKERS = env.int(  # type: ignore[no-untyped-call]
+    "LABEL_STUDIO_EXPORT_MAX_WORKERS", default=8
+)
+# Job log lines are written to the database in batches of this size, or after this many seconds
+JOB_LOG_FLUSH_SIZE = env.int("JOB_LOG_FLUSH_SIZE", default=50)  # type: ignore[no-untyped-call]
+JOB_LOG_FLUSH_SECONDS = env.float("JOB_LOG_FLUSH_SECONDS", default=5)  # type: ignore[no-untyped-call]
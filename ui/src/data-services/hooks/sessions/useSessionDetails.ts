@@ -23,7 +23,13 @@ export const useSessionDetails = (
   const fetchUrl = getFetchDetailsUrl({
     collection: API_ROUTES.SESSIONS,
     itemId: id,
-    queryParams: _.pickBy(params, (param) => param !== undefined),
+    queryParams: {
+      ..._.pickBy(params, (param) => param !== undefined),
+      // Ask for the page offset of the capture with the requested subject
+      ...(params.occurrence || params.capture
+        ? { capture_page_offset: 'true' }
+        : {}),
+    },
   })
 
   const { data, isLoading, isFetching, error } = useAuthorizedQuery<